@@ -0,0 +1,675 @@
+"""
+Benchmarks comparing the array-based implementations of various multiplierz
+functions against the previous ones they replaced, on synthetic data.  Each
+benchmark checks that the two give the same output, and returns a dict of
+{name : (previous time, new time)} in seconds, per call.
+
+>>> from multiplierz.benchmarks import benchmark_spectral_filters
+>>> benchmark_spectral_filters(peaks = 10000)
+>>> benchmark_ion_matching(spectra = 200)
+>>> benchmark_fragments(peptides = 1000)
+>>> benchmark_digest_filters(proteins = 500)
+>>> benchmark_mgf_parsing(entries = 2000)
+>>> check_prefetch('example_file.mzML')
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+
+def synthetic_spectrum(peaks = 10000, seed = 0, mz_range = (100, 2000)):
+    """
+    Random centroided spectrum (a list of (mz, intensity) tuples, in m/z
+    order) with log-normally distributed intensities.
+    """
+    rng = np.random.RandomState(seed)
+    mzs = np.sort(rng.uniform(mz_range[0], mz_range[1], peaks)).round(4)
+    ints = rng.lognormal(8, 2, peaks).round(1)
+    return list(zip(mzs.tolist(), ints.tolist()))
+
+def synthetic_peptides(count = 100, seed = 0, length_range = (7, 25)):
+    """
+    Random tryptic-looking peptides (ending in K or R.)
+    """
+    rng = np.random.RandomState(seed)
+    residues = np.array(list('ACDEFGHILMNPQSTVWY'))
+    return [''.join(rng.choice(residues, rng.randint(*length_range) - 1)) + rng.choice(['K', 'R'])
+            for _ in range(count)]
+
+def synthetic_proteins(count = 100, seed = 0, length_range = (100, 800), nonstandard = 0.002):
+    """
+    Random protein sequences; a fraction nonstandard of residues are X, U, B
+    or Z, which have no mass.
+    """
+    rng = np.random.RandomState(seed)
+    residues = np.array(list('ACDEFGHIKLMNPQRSTVWY'))
+    proteins = []
+    for _ in range(count):
+        sequence = rng.choice(residues, rng.randint(*length_range))
+        unknown = rng.rand(len(sequence)) < nonstandard
+        sequence[unknown] = rng.choice(list('XUBZ'), unknown.sum())
+        proteins.append(''.join(sequence))
+    return proteins
+
+def synthetic_ms2(peptide, ions = ('b', 'y'), peaks = 200, seed = 0, jitter = 0.02):
+    """
+    Random MS2 spectrum of peaks (mz, intensity) points, half of which are
+    theoretical ions of the peptide (from fragment_legacy) displaced by up
+    to jitter, and half noise.
+    """
+    from multiplierz.mass_biochem import fragment_legacy
+
+    rng = np.random.RandomState(seed)
+    calc_masses, _ = fragment_legacy(peptide, list(ions), labels = True)
+    signal = rng.choice(calc_masses, min(len(calc_masses), peaks // 2), replace = False)
+    signal = signal + rng.uniform(-jitter, jitter, len(signal))
+    noise = synthetic_spectrum(peaks - len(signal), seed, (100, max(calc_masses) + 100))
+    spectrum = noise + list(zip(signal.round(4).tolist(),
+                                rng.lognormal(10, 1, len(signal)).round(1).tolist()))
+    return sorted(spectrum)
+
+def synthetic_mgf(filename, entries = 1000, peaks = 200, fragment_charges = 0.1, seed = 0):
+    """
+    Writes an MGF of random entries with peaks peaks each; fragment_charges
+    is the fraction of peak lines given a third, fragment charge column
+    (e.g. '2+'.)
+    """
+    rng = np.random.RandomState(seed)
+    with open(filename, 'w') as mgf:
+        for i in range(entries):
+            mgf.write("BEGIN IONS\nTITLE=synthetic.%d.%d.2\nPEPMASS=%.4f\nCHARGE=2+\n"
+                      % (i, i, rng.uniform(400, 1200)))
+            for mz, intensity in synthetic_spectrum(peaks, seed + i):
+                if rng.rand() < fragment_charges:
+                    mgf.write("%s %s %d+\n" % (mz, intensity, rng.randint(1, 4)))
+                else:
+                    mgf.write("%s %s\n" % (mz, intensity))
+            mgf.write("END IONS\n")
+    return filename
+
+# Previous implementations that have no other use, kept here as references
+# for the benchmarks.
+
+def _apply_spectral_process_legacy(mgfFile, functions, outputFile = None):
+    # mgf.apply_spectral_process, before it was streamed; loads the whole file.
+    from multiplierz.mgf import parse_mgf, MGF_Writer
+    
+    mgf = parse_mgf(mgfFile)
+    
+    if not outputFile:
+        outputFile = mgfFile
+        
+    def applyFunctions(spectrum):
+        for args, func in functions:
+            if args:
+                spectrum = func(spectrum, args)
+            else:
+                spectrum = func(spectrum)
+        return spectrum
+        
+    try:
+        header = mgf['header']
+        del mgf['header']
+    except KeyError:
+        header = None
+    with MGF_Writer(outputFile, header) as writer:
+        for entry in list(mgf.values()):
+            entry['spectrum'] = applyFunctions(entry['spectrum'])
+            writer.write(entry['spectrum'], entry['title'],
+                         mass = entry['pepmass'], charge = entry.get('charge', None))
+    
+    return outputFile
+
+def _exclusion_radius_legacy(spectrum, exclusion):
+    # spectral_process.exclusion_radius, before it was array-based.
+    if not exclusion or not float(exclusion):
+        return spectrum
+    exclusion = float(exclusion)
+    
+    acc = []
+    while spectrum:
+        peak = max(spectrum, key = lambda x: x[1])
+        acc.append(peak)
+        spectrum = [x for x in spectrum if not abs(x[0] - peak[0]) < exclusion]
+    
+    return acc    
+
+def _signal_noise_legacy(spectrum, minSN):
+    # spectral_process.signal_noise, before it was array-based.
+    from multiplierz.internalAlgorithms import average
+    
+    if not minSN or not float(minSN):
+        return spectrum
+    
+    minSN = float(minSN)
+    spectrum.sort(key = lambda x: x[1])
+    for i in range(0, len(spectrum)):
+        ints = [x[1] for x in spectrum[i:]]
+        SN = average(ints) / np.std(ints)
+        if SN > minSN:
+            return spectrum[i:]
+    
+    return spectrum
+
+def _fragment_loops_legacy(peptide, mods = [], charges = [1], 
+                           ions = ['b', 'y'], 
+                           neutralPhosLoss = False,
+                           neutralLossDynamics = None,
+                           waterLoss = False,
+                           ammoniaLoss = False,
+                           use_monoisotopic = True,
+                           special_AAs = {}):
+    # mass_biochem.fragment, before it was array-based (less its unfinished
+    # 'by-int' ion type.)
+    import re
+    from collections import defaultdict
+    from multiplierz import protonMass
+    from multiplierz.mass_biochem import (AminoAcidMasses, mod_masses, H2Omass, NH3mass,
+                                          _placeCharge)
+    
+    # Currently only records one neutral loss even if there's more than
+    # one loss-inducing mod.  Simplicity is a virtue?
+
+   
+
+    massType = 0 if use_monoisotopic else 1
+    aminoMasses = dict((aa,AminoAcidMasses[aa][massType]) for aa in list(AminoAcidMasses.keys()))
+    aminoMasses.update(special_AAs)
+    
+    if neutralLossDynamics is None:
+        neutralLossDynamics = {}
+    assert not (neutralPhosLoss and neutralLossDynamics)
+    if neutralPhosLoss:
+        neutralLossDynamics[mod_masses['Phospho']] = 97.9769
+    elif neutralLossDynamics:
+        for key, value in list(neutralLossDynamics.items()):
+            if isinstance(key, str):
+                neutralLossDynamics[mod_masses[key]] = value
+    
+    #assert not neutralPhosLoss, "Not currently set up for phos loss!"
+    #czLoss = 15.010899035
+    cLoss = 17.026000420104097 # NH3+
+    zLoss = 16.018724 # NH2
+    
+    nterminusMass = 0
+    cterminusMass = H2Omass
+    
+    modBySite = defaultdict(list)
+    if isinstance(mods, str):
+        mods = mods.split('; ')
+    for modstr in [x for x in mods if x]:
+        if ':' in modstr:
+            mod = modstr.split(': ')[1].strip()
+            try:
+                modmass = float(mod)
+            except ValueError:
+                modmass = mod_masses[mod]
+            if modstr[:6].lower() == 'n-term':
+                nterminusMass = modmass 
+            elif modstr[:6].lower() == 'c-term':
+                cterminusMass = modmass + protonMass
+            else:
+                site = int(modstr.split(': ')[0][1:])
+                modBySite[site].append(modmass)
+        else:
+            # Fixed mod processing.
+            assert re.match('[A-Za-z0-9\-\. ]* \([A-Z]\)', modstr), modstr
+            mod, loc = modstr.split()
+            try:
+                modmass = float(mod)
+            except ValueError:
+                modmass = mod_masses[mod]
+            loc = loc.strip('()')
+            for site, aa in enumerate(peptide, start = 1):
+                if aa == loc:
+                    modBySite[site].append(modmass)
+        
+    
+    fragmentSetsByIonType = {}
+    if 'b' in ions or 'c' in ions:
+        bfrags = []
+        cfrags = []
+        bmass = nterminusMass
+        presentmods = []
+        for site in range(1, len(peptide)): # 1-indexed.
+            aa = peptide[site-1]
+            mods = modBySite[site]
+            presentmods += mods
+            bmass += AminoAcidMasses[aa][massType] + sum(mod_masses.get(x, x) for x in mods)
+                    
+            neutralLoss = 0
+            for mod in presentmods:
+                if mod in neutralLossDynamics:
+                    neutralLoss -= neutralLossDynamics[mod]            
+
+            if 'b' in ions:
+                bfrags.append(('b'+str(site), bmass))
+            if 'c' in ions:
+                cfrags.append(('c'+str(site), bmass + cLoss))
+
+            if neutralLoss:
+                if 'b' in ions:
+                    bfrags.append(('b%d-%.0f'%(site, abs(neutralLoss)), bmass + neutralLoss))                
+                if 'c' in ions:
+                    cfrags.append(('c%d-%.0f'%(site, abs(neutralLoss)), bmass + neutralLoss + cLoss))
+        if 'b' in ions:
+            fragmentSetsByIonType['b'] = bfrags
+        if 'c' in ions:
+            fragmentSetsByIonType['c'] = cfrags
+    
+    if 'y' in ions or 'z' in ions:
+        yfrags = []
+        zfrags = []
+        ymass = cterminusMass
+        presentmods = []
+        for site in range(len(peptide)-1, 0, -1): # 0-indexed.
+            aa = peptide[site]
+            mods = modBySite[site+1]
+            presentmods += mods
+            ymass += AminoAcidMasses[aa][massType] + sum(mod_masses.get(x, x) for x in mods)
+            
+
+            neutralLoss = 0
+            for mod in presentmods:
+                if mod in neutralLossDynamics:
+                    neutralLoss -= neutralLossDynamics[mod]
+            
+            realsite = len(peptide)-site
+            if 'y' in ions:
+                yfrags.append(('y'+str(realsite), ymass))
+            if 'z' in ions:
+                zfrags.append(('z'+str(realsite), ymass - zLoss))
+
+            if neutralLoss:
+                yfrags.append(('y%d-%.0f'%(realsite, abs(neutralLoss)), ymass + neutralLoss))
+                if 'z' in ions:
+                    zfrags.append(('z%d-%.0f'%(realsite, abs(neutralLoss)), ymass + neutralLoss - zLoss))
+        
+        if 'y' in ions:
+            fragmentSetsByIonType['y'] = yfrags
+        if 'z' in ions:
+            fragmentSetsByIonType['z'] = zfrags
+                
+    # Similar for z and w and whatever, I guess.
+    
+    
+    
+    chargedFragmentSets = {}
+    # Replicate sequences for multiply-charged states.
+    for chg in charges:
+        chg = int(chg)
+        assert chg >= 1, "Positive charge states only!"
+                
+        for iontype in ions:
+            if chg == 1:
+                chgion = iontype
+            else:
+                chgion = iontype + '+'*chg
+            chargedFragmentSets[chgion] = []
+            for site, (prelabel, preion) in enumerate(fragmentSetsByIonType[iontype], start = 1):
+                newion = _placeCharge(preion, chg)
+                if chg == 1:
+                    newlabel = prelabel
+                else:
+                    newlabel = prelabel + '+'*chg
+                chargedFragmentSets[chgion].append((newlabel, newion))
+                
+                
+    
+    # Water-loss duplicates of ALL ions!
+    if waterLoss or ammoniaLoss:
+        for fragtype, labelions in list(chargedFragmentSets.items()):
+            waterlosses = []
+            ammonialosses = []
+            for label, ion in labelions:
+                chg = label.count('+') if '+' in label else 1
+                mass = (ion * chg) - (chg * protonMass)                
+                if waterLoss:
+                    newlabel = list(label)
+                    newlabel.insert(1, '0')
+                    newlabel = ''.join(newlabel)
+                    newmass = mass - H2Omass
+                    newion = (newmass + (chg * protonMass)) / chg
+                    waterlosses.append((newlabel, newion))
+                if ammoniaLoss:
+                    newlabel = list(label)
+                    newlabel.insert(1, '*')
+                    newlabel = ''.join(newlabel)
+                    newmass = mass - NH3mass
+                    newion = (newmass + (chg * protonMass)) / chg
+                    ammonialosses.append((newlabel, newion))
+            chargedFragmentSets[fragtype] += waterlosses
+            chargedFragmentSets[fragtype] += ammonialosses
+    
+    #if 1 not in charges:
+        #for iontype in ions:
+            #del fragmentSetsByIonType[iontype]
+    
+    return chargedFragmentSets
+
+def _generate_labels_legacy(scan, peptide, ions, charge=None, tolerance=0.6, **settings):
+    # mass_biochem.generate_labels, before sorted-array matching; matches
+    # each peak against every ion.
+    from collections import defaultdict
+    from multiplierz.mass_biochem import fragment_legacy
+
+    # initialize defaults and update with optional arguments
+    _settings = dict(show_theor_mz=True, ms2_mz_figs=2, show_mass_error=False,
+                     mass_error_figs=2, mass_error_units='ppm')
+    _settings.update(settings)
+
+    if _settings['mass_error_units'] == 'ppm':
+        calc_error = lambda exp_mz, theor_mz: (abs(theor_mz - exp_mz) / theor_mz) * 1E6
+    else:
+        calc_error = lambda exp_mz, theor_mz: abs(theor_mz - exp_mz)
+
+    if _settings['show_theor_mz'] and _settings['show_mass_error']:
+        label_text = '%%s [%%.%df - %%.%df %s]' % (_settings['ms2_mz_figs'],
+                                                   _settings['mass_error_figs'],
+                                                   _settings['mass_error_units'])
+    elif _settings['show_theor_mz']:
+        label_text = '%%s [%%.%df]' % _settings['ms2_mz_figs']
+    elif _settings['show_mass_error']:
+        label_text = '%%s [%%.%df %s]' % (_settings['mass_error_figs'],
+                                          _settings['mass_error_units'])
+
+    if charge and 'MH' in ions:
+        ions = list(ions)
+        ions.remove('MH')
+
+        for z in range(int(charge), 0, -1):
+            ions.append('MH%s' % ('+'*z))
+
+    calc_masses, label_dict = fragment_legacy(peptide, ions, labels=True)
+
+    scan = sorted(scan)
+
+    match_count = defaultdict(lambda: -1)
+
+    matched_calc = []
+    matched_exp = []
+    matched_int = []
+
+    # for each mass/int peak in the scan
+    for j,(mass,inte) in enumerate(scan):
+        # go through each calculated mass and try to match
+        for i,cmass in enumerate(calc_masses):
+            if abs(mass - cmass) <= tolerance:
+                if match_count[i] > -1:
+                    if matched_int[match_count[i]] < inte:
+                        matched_exp[match_count[i]] = mass
+                        matched_int[match_count[i]] = inte
+                    continue
+
+                matched_calc.append(cmass)
+                matched_exp.append(mass)
+                matched_int.append(inte)
+                match_count[i] = len(matched_int) - 1
+
+    matched_exp.sort()
+    matched_calc.sort()
+
+    if _settings['show_theor_mz'] and _settings['show_mass_error']:
+        return tuple((e, (label_text % (label_dict[c], c, calc_error(e,c))))
+                     for e,c in zip(matched_exp,matched_calc))
+    elif _settings['show_theor_mz']:
+        return tuple((e, (label_text % (label_dict[c], c)))
+                     for e,c in zip(matched_exp,matched_calc))
+    elif _settings['show_mass_error']:
+        return tuple((e, (label_text % (label_dict[c], calc_error(e,c))))
+                     for e,c in zip(matched_exp,matched_calc))
+    else:
+        return tuple((e, label_dict[c])
+                     for e,c in zip(matched_exp,matched_calc))
+
+
+def _time_call(function, args, repeats):
+    # Best of repeats; args are copied for each call, since some functions
+    # modify their input.
+    best = None
+    for _ in range(repeats):
+        callargs = [list(x) if isinstance(x, list) else x for x in args]
+        start = time.perf_counter()
+        result = function(*callargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+def compare(name, previous, new, args, repeats = 3, verbose = True):
+    previousResult, previousTime = _time_call(previous, args, repeats)
+    newResult, newTime = _time_call(new, args, repeats)
+    if list(previousResult) != list(newResult):
+        raise AssertionError("%s: new and previous results differ." % name)
+    if verbose:
+        print("%s: %.4fs -> %.4fs (%.1fx)" % (name, previousTime, newTime,
+                                              previousTime / max(newTime, 1e-9)))
+    return previousTime, newTime
+
+
+def benchmark_spectral_filters(peaks = 10000, exclusion = 0.5, minSN = 1.5,
+                               repeats = 3, seed = 0, verbose = True):
+    """
+    Times spectral_process.exclusion_radius and signal_noise against their
+    previous implementations, on a synthetic spectrum of the given size.
+    """
+    from multiplierz import spectral_process as sp
+
+    spectrum = synthetic_spectrum(peaks, seed)
+    results = {}
+    results['exclusion_radius'] = compare('exclusion_radius', _exclusion_radius_legacy,
+                                          sp.exclusion_radius, [spectrum, exclusion],
+                                          repeats, verbose)
+    results['signal_noise'] = compare('signal_noise', _signal_noise_legacy,
+                                      sp.signal_noise, [spectrum, minSN],
+                                      repeats, verbose)
+    return results
+
+def benchmark_ion_matching(spectra = 200, peaks = 200, ions = ('b', 'y', 'b++', 'y++'),
+                           tolerance = 0.6, repeats = 3, seed = 0, verbose = True):
+    """
+    Times mass_biochem.generate_labels against its previous implementation,
+    called on each of a set of synthetic (spectrum, peptide) pairs, and
+    generate_labels_batch over all of them at once.
+    """
+    from multiplierz import mass_biochem as mb
+
+    peptides = synthetic_peptides(spectra, seed)
+    pairs = [(synthetic_ms2(peptide, ions, peaks, seed + i), peptide)
+             for i, peptide in enumerate(peptides)]
+
+    def previous(pairs):
+        return [_generate_labels_legacy(scan, peptide, list(ions), tolerance = tolerance)
+                for scan, peptide in pairs]
+    def new(pairs):
+        return [mb.generate_labels(scan, peptide, list(ions), tolerance = tolerance)
+                for scan, peptide in pairs]
+    def batch(pairs):
+        return mb.generate_labels_batch(pairs, list(ions), tolerance = tolerance)
+
+    results = {}
+    results['generate_labels'] = compare('generate_labels', previous, new, [pairs],
+                                         repeats, verbose)
+    results['generate_labels_batch'] = compare('generate_labels_batch', previous, batch,
+                                               [pairs], repeats, verbose)
+    return results
+
+def benchmark_fragments(peptides = 1000, repeats = 3, seed = 0, verbose = True):
+    """
+    Times mass_biochem.fragment (with its cache cleared) against its previous
+    implementation, over synthetic peptides with a few modifications, ion
+    types and neutral loss options, and fragment_batch over all of them.
+    """
+    from multiplierz import mass_biochem as mb
+    
+    rng = np.random.RandomState(seed)
+    options = [{'charges' : [1, 2]},
+               {'ions' : ['b', 'c', 'y', 'z'], 'waterLoss' : True},
+               {'neutralPhosLoss' : True, 'ammoniaLoss' : True}]
+    calls = []
+    for i, peptide in enumerate(synthetic_peptides(peptides, seed)):
+        mods = ['Carbamidomethyl (C)']
+        site = rng.randint(len(peptide)) + 1
+        mods.append('%s%d: %s' % (peptide[site - 1], site,
+                                  'Phospho' if peptide[site - 1] in 'STY' else 'Oxidation'))
+        calls.append((peptide, mods, options[i % len(options)]))
+    
+    def previous(calls):
+        return [_fragment_loops_legacy(peptide, mods, **opts) for peptide, mods, opts in calls]
+    def new(calls):
+        mb._fragment_set.cache_clear()
+        return [mb.fragment(peptide, mods, **opts) for peptide, mods, opts in calls]
+    def previous_mzs(calls):
+        return [mz for fragments in previous(calls[::3])
+                for ion in ('b', 'y') for _, mz in fragments[ion]]
+    def batch(calls):
+        return mb.fragment_batch([(peptide, mods) for peptide, mods, _ in calls[::3]])[0].tolist()
+    
+    results = {}
+    results['fragment'] = compare('fragment', previous, new, [calls], repeats, verbose)
+    results['fragment_batch'] = compare('fragment_batch', previous_mzs, batch, [calls],
+                                        repeats, verbose)
+    return results
+
+def benchmark_digest_filters(proteins = 500, missed_cleavages = 2, mass_range = (700, 3500),
+                             repeats = 3, seed = 0, verbose = True):
+    """
+    Times mass_biochem.digest_iter's inline mass filter against digesting
+    and then filtering on each peptide's own mass, over synthetic proteins
+    that include non-standard residues (which exclude only the peptides
+    containing them.)
+    """
+    from multiplierz.mass_biochem import digest, digest_iter, peptide_mass
+    
+    sequences = synthetic_proteins(proteins, seed)
+    def previous(sequences):
+        results = []
+        for protein in sequences:
+            for peptide, _, missed in digest(protein, 'Trypsin', missed_cleavages):
+                try:
+                    mass = peptide_mass(peptide)
+                except KeyError: # Non-standard residue.
+                    continue
+                if mass_range[0] <= mass <= mass_range[1]:
+                    results.append((peptide, missed))
+        return results
+    def new(sequences):
+        return [(peptide, missed) for protein in sequences
+                for peptide, _, _, missed in digest_iter(protein, 'Trypsin', missed_cleavages,
+                                                         min_mass = mass_range[0],
+                                                         max_mass = mass_range[1])]
+    
+    return {'digest_iter' : compare('digest_iter', previous, new, [sequences],
+                                    repeats, verbose)}
+
+def benchmark_mgf_parsing(entries = 2000, peaks = 200, fragment_charges = 0.1,
+                          repeats = 3, seed = 0, verbose = True):
+    """
+    Times the block-based MGF parser (parse_mgf_blocks) against
+    parse_to_generator, on a synthetic MGF in which a fraction
+    fragment_charges of peak lines have a fragment charge column.
+    """
+    from multiplierz.mgf import parse_to_generator, parse_mgf_blocks
+    
+    directory = tempfile.mkdtemp()
+    try:
+        mgffile = synthetic_mgf(os.path.join(directory, 'synthetic.mgf'), entries, peaks,
+                                fragment_charges, seed)
+        def previous(mgffile):
+            return [(x['title'], x['pepmass'], x['charge'], [pt[:2] for pt in x['spectrum']])
+                    for x in parse_to_generator(mgffile)]
+        def new(mgffile):
+            return [(x['title'], x['pepmass'], x['charge'], list(x['spectrum']))
+                    for x in parse_mgf_blocks(mgffile)]
+        
+        return {'parse_mgf_blocks' : compare('parse_mgf_blocks', previous, new, [mgffile],
+                                             repeats, verbose)}
+    finally:
+        shutil.rmtree(directory)
+
+def benchmark_spectral_process(entries = 2000, peaks = 200, fragment_charges = 0.1,
+                               top = 50, repeats = 3, seed = 0, verbose = True):
+    """
+    Times mgf.apply_spectral_process against its previous implementation,
+    keeping the top peaks of each entry of a synthetic MGF (with fragment
+    charges, as in benchmark_mgf_parsing); the output files must match.
+    """
+    from multiplierz.mgf import apply_spectral_process
+    from multiplierz.spectral_process import top_n_peaks
+    
+    directory = tempfile.mkdtemp()
+    try:
+        mgffile = synthetic_mgf(os.path.join(directory, 'synthetic.mgf'), entries, peaks,
+                                fragment_charges, seed)
+        outputfile = os.path.join(directory, 'output.mgf')
+        def run(function):
+            def call(mgffile):
+                function(mgffile, [(top, top_n_peaks)], outputfile)
+                with open(outputfile) as output:
+                    return output.read().splitlines()
+            return call
+        
+        return {'apply_spectral_process' : compare('apply_spectral_process',
+                                                   run(_apply_spectral_process_legacy),
+                                                   run(apply_spectral_process),
+                                                   [mgffile], repeats, verbose)}
+    finally:
+        shutil.rmtree(directory)
+
+def check_prefetch(datafile, size_cap = 200000, centroid = True, verbose = True):
+    """
+    Reads the MS1 scans of a data file through mzMemo.async_mzFile, with
+    prefetch('MS1') and a cache cap of size_cap bytes (small enough that the
+    scans don't all fit), letting the worker read ahead as far as it will
+    before each scan is asked for.  Every scan should then come from the
+    read-ahead; raises AssertionError on any cache miss, or if the scans
+    differ from those read directly.  Returns the cache stats.
+    """
+    from multiplierz.mzAPI import mzFile
+    from multiplierz.mzAPI.mzMemo import async_mzFile
+    
+    data = mzFile(datafile)
+    scanNums = [x[2] for x in sorted(data.scan_info()) if x[3] == 'MS1']
+    direct = [data.scan(scanNum, centroid = centroid) for scanNum in scanNums]
+    data.close()
+    
+    data = async_mzFile(datafile, size_cap = size_cap)
+    try:
+        data.prefetch('MS1', centroid = centroid)
+        scans = []
+        for scanNum in scanNums:
+            while True:
+                stats = data.cache_stats()
+                if (not stats['prefetch_queued'] or
+                    stats['prefetch_unclaimed_bytes'] >= size_cap / 2):
+                    break
+                time.sleep(0.01)
+            scans.append(data.scan(scanNum, centroid = centroid))
+        stats = data.cache_stats()
+    finally:
+        data.close()
+    
+    if verbose:
+        print("prefetch: %s hits, %s misses, %s evictions over %s scans"
+              % (stats['hits'], stats['misses'], stats['evictions'], len(scanNums)))
+    if scans != direct:
+        raise AssertionError("prefetch: scans differ from those read directly.")
+    if stats['misses']:
+        raise AssertionError("prefetch: %s of %s scans were not read ahead."
+                             % (stats['misses'], len(scanNums)))
+    return stats
+
+
+if __name__ == '__main__':
+    benchmark_spectral_filters()
+    benchmark_ion_matching()
+    benchmark_fragments()
+    benchmark_digest_filters()
+    benchmark_mgf_parsing()
+    benchmark_spectral_process()
+    if len(sys.argv) > 1:
+        check_prefetch(sys.argv[1])
@@ -1,10 +1,11 @@
 import gzip
-from multiplierz.mass_biochem import digest
+from multiplierz.mass_biochem import digest, digest_iter
 from multiplierz.internalAlgorithms import gzOptOpen
 import re
 
 __all__ = ['Writer', 'parse_to_dict', 'parse_to_generator', 'write_fasta',
-           'partial_database', 'reverse_database', 'combine', 'pseudo_reverse']
+           'partial_database', 'reverse_database', 'combine', 'pseudo_reverse',
+           'digest_fasta']
 
 
 
@@ -272,3 +273,60 @@ def pseudo_reverse(fasta, output = None, enzyme = 'Trypsin', tag = 'rev_', inclu
 
     return output
 
+
+
+def _digest_proteins(proteins, digest_args):
+    return [(header, list(digest_iter(sequence, *digest_args)))
+            for header, sequence in proteins]
+
+def digest_fasta(fasta, enzyme = 'Trypsin', missed_cleavages = 0,
+                 min_length = None, max_length = None,
+                 min_mass = None, max_mass = None,
+                 processes = 1, chunk_size = 500):
+    """
+    Digests every protein in a FASTA file, giving a generator of (header,
+    peptide, start, end, missed_cleavages) for each product; see
+    mass_biochem.digest_iter for the length and mass filters.  With processes
+    > 1, chunks of chunk_size proteins are digested in that many processes,
+    with the output still in file order.
+    """
+    digest_args = (enzyme, missed_cleavages, min_length, max_length, min_mass, max_mass)
+    
+    def chunks():
+        chunk = []
+        for entry in parse_to_generator(fasta):
+            chunk.append(entry)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    
+    if processes > 1:
+        import multiprocessing
+        from collections import deque
+        pool = multiprocessing.Pool(processes)
+        def results():
+            # At most 2 chunks per process in flight, so that the FASTA
+            # isn't read any further ahead than that.
+            pending = deque()
+            for chunk in chunks():
+                pending.append(pool.apply_async(_digest_proteins, (chunk, digest_args)))
+                if len(pending) >= 2 * processes:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+    else:
+        pool = None
+        def results():
+            for chunk in chunks():
+                yield _digest_proteins(chunk, digest_args)
+    
+    try:
+        for digested in results():
+            for header, products in digested:
+                for peptide, start, end, missed in products:
+                    yield header, peptide, start, end, missed
+    finally:
+        if pool is not None:
+            pool.terminate()
@@ -795,16 +795,56 @@ def peak_pick(scan, tolerance = 0.005, max_charge = 8, min_peaks = 3, correction
     
 def peak_pick_PPM(scan, tolerance = 10, max_charge = 8, min_peaks = 3, correction = None,
                   cleanup = False, recover_peaks = True,
-                  enforce_isotopic_ratios = True):
+                  enforce_isotopic_ratios = True, compatibility = False):
     """
     Scans a scan and gives back a by-charge dict of lists of isotopic sequences
     found in the scan, as well as a list of the unassigned peaks; this is the PPM-based
-    version, which will be a bit slower.
+    version.
     
-    tolerance - MZ range two points can be that are the "same" mass.
-    max_charge - Maximum charge of peptides that are searched for.
+    tolerance - MZ range two points can be that are the "same" mass, in PPM.
+    max_charge - Maximum charge of peptides that are searched for (or a list of charges.)
     min_peaks - Minimum isotopic peaks required for an isotopic feature to be recorded.
     correction - Advanced feature; recalibration factor used for repeated calls on the same file.
+    compatibility - If True, the legacy implementation is also run, and its
+    result is used (with a warning) if the two disagree.
+    """
+
+    if len(scan) > 10000:
+        if all([(scan[i+1][0] - scan[i][0]) < 0.3 for i in range(0, 100)]):
+            raise NotImplementedError("Called scan_features on a profile-mode spectrum.")
+    if cleanup:
+        raise NotImplementedError
+
+    if compatibility:
+        legacyResult = peak_pick_PPM_legacy(list(scan), tolerance, max_charge, min_peaks,
+                                            correction, cleanup, recover_peaks,
+                                            enforce_isotopic_ratios)
+
+    if enforce_isotopic_ratios:
+        ratios = isotopicRatios
+    else:
+        ratios = defaultdict(lambda: (-1000000, 1000000))
+    if isinstance(max_charge, list):
+        chargeFractions = [(x, 1.0/x) for x in max_charge]
+    else:
+        chargeFractions = [(x, 1.0/x) for x in range(1, max_charge+1)]
+    scan.sort()
+
+    result = isotope_sweep(scan, tolerance, chargeFractions, min_peaks,
+                           recover_peaks, ratios, ppm = True)
+    if compatibility:
+        result = check_peak_pick_compatibility('peak_pick_PPM', result, legacyResult[:2])
+    if correction != None:
+        return result[0], result[1], []
+    else:
+        return result
+
+def peak_pick_PPM_legacy(scan, tolerance = 10, max_charge = 8, min_peaks = 3, correction = None,
+                         cleanup = False, recover_peaks = True,
+                         enforce_isotopic_ratios = True):
+    """
+    The original pure-Python implementation of peak_pick_PPM, kept as a
+    reference for peak_pick_PPM(..., compatibility = True).
     """
 
     if len(scan) > 10000:
@@ -970,6 +1010,233 @@ def peak_pick_PPM(scan, tolerance = 10, max_charge = 8, min_peaks = 3, correctio
 
 
 
+# Array-based version of the peak_pick sweep.  The expensive part of the
+# legacy functions is, for every point, re-sorting and walking the whole set
+# of unmatched ("active") points looking for an isotopic partner; here the
+# possible partners of every point are found up front with binary searches
+# over the sorted M/Z array, and the C12/C13 intensity ratio check is applied
+# to all of them at once, leaving the sweep itself with only a handful of
+# candidates to consider per point.  The sweep makes the same decisions in
+# the same order as the legacy code, so the results are the same.
+
+def _isotope_partners(mzs, ints, chargeFractions, tolerance, ppm, lowRat, highRat):
+    # For each point j, returns the candidate (earlier point, charge position)
+    # pairs, ordered by descending intensity of the earlier point (the order
+    # in which the legacy sweep tries them.)
+    count = len(mzs)
+    fractions = np.array([cF for _, cF in chargeFractions])
+    targets = (mzs[None,:] + fractions[:,None]).ravel()
+    if ppm:
+        # Generous bounds, refined by the exact inPPM test below.
+        margin = 2 * tolerance / 1000000.0
+        lows = np.searchsorted(mzs, targets * (1 - margin), side = 'left')
+        highs = np.searchsorted(mzs, targets / (1 - margin), side = 'right')
+    else:
+        lows = np.searchsorted(mzs, targets - 2 * tolerance, side = 'left')
+        highs = np.searchsorted(mzs, targets + 2 * tolerance, side = 'right')
+    counts = highs - lows
+    total = counts.sum()
+    if not total:
+        return [0] * (count + 1), [], []
+
+    pair = np.repeat(np.arange(len(targets)), counts)
+    pJ = lows[pair] + np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    pZ, pI = np.divmod(pair, count)
+    t, m = targets[pair], mzs[pJ]
+    if ppm:
+        keep = np.abs(t - m) < (np.maximum(t, m) / 1000000.0) * tolerance
+    else:
+        keep = np.abs(t - m) < tolerance
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        ratios = ints[pI] / ints[pJ]
+    keep &= (lowRat <= ratios) & (ratios <= highRat) & (pI < pJ)
+    pI, pJ, pZ = pI[keep], pJ[keep], pZ[keep]
+
+    order = np.lexsort((pZ, pI, -ints[pI], pJ))
+    pI, pJ, pZ = pI[order], pJ[order], pZ[order]
+    starts = np.searchsorted(pJ, np.arange(count + 1), side = 'left')
+    return starts.tolist(), pI.tolist(), pZ.tolist()
+
+
+def isotope_sweep(scan, tolerance, chargeFractions, min_peaks, recover_peaks,
+                  isotopicRatios, ppm = True):
+    """
+    Shared engine of peak_pick and peak_pick_PPM; scan must already be
+    sorted.  With ppm, tolerance is in parts-per-million and the sweep
+    follows peak_pick_PPM; otherwise tolerance is in Daltons, following
+    spectral_process.peak_pick.  Returns (envelopes by charge, unassigned),
+    with the unassigned peaks in M/Z order.
+    """
+    points = list(scan)
+    count = len(points)
+    if hasattr(scan, 'mzs'): # mzScan
+        mzs, ints = scan.mzs, scan.intensities
+    else:
+        columns = np.array([pt[:2] for pt in points], dtype = float).reshape(count, 2)
+        mzs, ints = columns[:,0].copy(), columns[:,1].copy()
+    lowC13Rat, highC13Rat = isotopicRatios[0, 1]
+    max_charge = max(z for z, _ in chargeFractions)
+    chargeFracDict = dict(chargeFractions)
+    fractions = [cF for _, cF in chargeFractions]
+    maxFraction = max(fractions)
+
+    starts, candI, candZ = _isotope_partners(mzs, ints, chargeFractions, tolerance,
+                                             ppm, lowC13Rat, highC13Rat)
+    candidatePoints = np.flatnonzero(np.diff(starts)).tolist()
+    mzList, intList = mzs.tolist(), ints.tolist()
+    if ppm:
+        reachFactor = 1 + 2 * tolerance / 1000000.0
+    else:
+        reachMargin = 2 * tolerance
+
+    # Points are active (unmatched, and available to start an envelope) from
+    # when the sweep passes them, unless they're in 'inactive'.  Ties in
+    # intensity between active points go to the earliest activated, as in
+    # the legacy sweep; points reactivated from failed envelopes have their
+    # activation order recorded in 'reactivated'.
+    envelopes = defaultdict(list)
+    inactive = set()
+    dropped = set()
+    reactivated = {}
+    floors = {} # Recovered point index -> M/Z its next point must exceed.
+    activeSets = defaultdict(deque)
+    # Lowest 'next' M/Z of any open envelope; until the sweep comes within
+    # tolerance of it, open envelopes can't be closed or extended, and only
+    # points with candidate partners need to be looked at.
+    nextHead = float('inf')
+    nextCandidate = 0
+    j = 0
+    while True:
+        while (nextCandidate < len(candidatePoints) and
+               candidatePoints[nextCandidate] < j):
+            nextCandidate += 1
+        jump = (candidatePoints[nextCandidate] if nextCandidate < len(candidatePoints)
+                else count)
+        if nextHead != float('inf'):
+            if ppm:
+                jump = min(jump, bisect.bisect_right(mzList, nextHead / reachFactor, j))
+            else:
+                jump = min(jump, bisect.bisect_right(mzList, nextHead - reachMargin, j))
+        if jump >= count:
+            break
+        j = jump
+
+        pmz, pint = mzList[j], intList[j]
+        accounted = False
+        reach = pmz * reachFactor if ppm else pmz + reachMargin
+        for chg, chargeSet in (list(activeSets.items()) if nextHead < reach else ()):
+            if not chargeSet or chargeSet[0][1] >= reach:
+                continue # Nothing to close or extend.
+            while chargeSet:
+                nextMZ = chargeSet[0][1]
+                if ppm:
+                    if not (nextMZ < pmz and
+                            not abs(nextMZ - pmz) < max(nextMZ, pmz) / 1000000.0 * tolerance):
+                        break
+                elif not nextMZ + tolerance < pmz:
+                    break
+                finishedSet = chargeSet.popleft()
+                if len(finishedSet[0]) >= min_peaks:
+                    envelopes[chg].append(finishedSet[0])
+                elif ppm:
+                    if chg < max_charge and recover_peaks:
+                        for seq, old in enumerate(reversed(finishedSet[0])):
+                            inactive.discard(old)
+                            reactivated[old] = (j, 0, seq)
+                elif recover_peaks:
+                    if chg < max_charge:
+                        for seq, old in enumerate(finishedSet[0]):
+                            if mzList[old] + maxFraction > pmz:
+                                inactive.discard(old)
+                                reactivated[old] = (j, 0, seq)
+                                floors[old] = pmz
+                else:
+                    # As in spectral_process.peak_pick, these are dropped.
+                    dropped.update(finishedSet[0])
+
+            if chargeSet:
+                iso = chargeSet[0]
+                nextMZ = iso[1]
+                if ppm:
+                    matched = abs(nextMZ - pmz) < max(nextMZ, pmz) / 1000000.0 * tolerance
+                else:
+                    matched = nextMZ - pmz < tolerance
+                if matched:
+                    isoLen = len(iso[0])
+                    lowRat, highRat = isotopicRatios[isoLen-1, isoLen]
+                    if lowRat <= (iso[2] / pint) <= highRat:
+                        iso[0].append(j)
+                        iso[1] = pmz + chargeFracDict[chg]
+                        iso[2] = pint
+                        chargeSet.rotate(-1)
+                        inactive.add(j)
+                        accounted = True
+                        break
+        if nextHead < reach:
+            nextHead = min([x[0][1] for x in activeSets.values() if x] or [float('inf')])
+
+        if not accounted:
+            best = None
+            for c in range(starts[j], starts[j+1]):
+                i = candI[c]
+                if i in inactive:
+                    continue
+                if i in floors and not mzList[i] + fractions[candZ[c]] > floors[i]:
+                    continue
+                activation = reactivated.get(i, (i, 1, 0))
+                if best is None:
+                    best = i, candZ[c], activation
+                elif intList[i] < intList[best[0]]:
+                    break
+                elif activation < best[2]:
+                    best = i, candZ[c], activation
+            if best is not None:
+                i, zpos, _ = best
+                charge = chargeFractions[zpos][0]
+                activeSets[charge].append([[i, j], pmz + chargeFracDict[charge], pint])
+                nextHead = min(nextHead, activeSets[charge][0][1])
+                inactive.add(i)
+                inactive.add(j)
+                reactivated.pop(i, None)
+                floors.pop(i, None)
+        j += 1
+
+    for charge, things in list(activeSets.items()):
+        for thing in things:
+            if len(thing[0]) >= min_peaks:
+                envelopes[charge].append(thing[0])
+
+    enveloped = set()
+    for chgEnvelopes in envelopes.values():
+        for envelope in chgEnvelopes:
+            enveloped.update(envelope)
+    unassigned = [points[i] for i in range(count)
+                  if i not in enveloped and i not in dropped]
+    envelopes = dict((charge, [[points[i] for i in envelope] for envelope in chgEnvelopes])
+                     for charge, chgEnvelopes in envelopes.items())
+    return envelopes, unassigned
+
+
+def compare_peak_picks(result, legacyResult):
+    """
+    True if two (envelopes, unassigned) results are equivalent; envelopes
+    must match exactly, unassigned peaks only as a set (their order is an
+    artifact of the legacy sweep.)
+    """
+    return (result[0] == legacyResult[0] and
+            sorted(result[1]) == sorted(legacyResult[1]))
+
+def check_peak_pick_compatibility(name, result, legacyResult):
+    if compare_peak_picks(result, legacyResult):
+        return result
+    import warnings
+    warnings.warn("%s: array-based result differs from the legacy function; "
+                  "using the legacy result." % name, RuntimeWarning)
+    return legacyResult
+
+
+
+
 class ProximityIndexedSequence(object):
     # Turns out there's a python recipe to do just about this but better, but
     # now I have a bunch of legacy code that uses this interface!  Ah well.
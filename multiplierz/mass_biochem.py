@@ -21,7 +21,7 @@ import os
 import re
 
 from random import randint, sample
-from functools import reduce
+from functools import reduce, lru_cache
 try:
     from collections import defaultdict, Counter
 except ImportError:
@@ -30,6 +30,8 @@ except ImportError:
     
 from itertools import permutations
 
+import numpy as np
+
 from multiplierz import myData, logger_message, protonMass
 from multiplierz.unimod import UnimodDatabase
 
@@ -364,47 +366,141 @@ def digest(protein, enzyme="Trypsin", missed_cleavages=0):
         F [88, 88]
     '''
 
-    protein = re.sub("\s+","",protein)
-    protein = re.sub("\n+","",protein)
-
-    #Enzyme Specificities
-    # list of enzymes
-    enzSpec = EnzymeSpecification
-
-    digest_array = []
-
-    if enzyme[0] == "[":
-        reg_exp = enzyme
-    else:
-        reg_exp = enzSpec[enzyme]
+    protein, spans, products, contiguous = _cleave(protein, enzyme, missed_cleavages)
+    if contiguous:
+        return [(protein[start:end], (start, end), missed)
+                for start, end, i, missed in products]
+    return [(''.join(protein[a:b] for a, b in spans[i:i + missed + 1]), (start, end), missed)
+            for start, end, i, missed in products]
 
-    expr = re.compile(reg_exp)
 
-    start = 0
-    while True:
-        m = expr.search(protein, start)
-        if m is None:
-            break
-        else:
-            digest_array.append((protein[start:(m.end()-1)], (start, m.end()-1), 0))
-            start = 1 + m.start()
+# Digestion engine.  Enzyme patterns are compiled once into a pair of lookup
+# tables (which residues may precede and follow the cleavage site), so that
+# every site in a protein is found by a single vectorized comparison over
+# its sequence; patterns that aren't a pair of character classes fall back
+# to a compiled regular expression.
 
-    if start != len(protein):
-        digest_array.append((protein[start:], (start, len(protein)), 0))
+_simpleEnzymePattern = re.compile(r'(\[[^\]]+\])(\[[^\]]+\])$')
+_compiledEnzymes = {}
 
-    #Add missed cleavages
+def compile_enzyme(enzyme):
+    """
+    Returns a function giving the (start, end) slice positions of the fully
+    cleaved pieces of a sequence, for an enzyme name from EnzymeSpecification
+    or an enzyme regular expression beginning with [.
+    """
+    if enzyme in _compiledEnzymes:
+        return _compiledEnzymes[enzyme]
+    
+    pattern = enzyme if enzyme[0] == '[' else EnzymeSpecification[enzyme]
+    simple = _simpleEnzymePattern.match(pattern)
+    if simple:
+        before, after = [np.array([bool(re.match(part, chr(c))) for c in range(256)])
+                         for part in simple.groups()]
+        def pieces(sequence):
+            codes = np.frombuffer(sequence.encode('latin-1', 'replace'), dtype = np.uint8)
+            bounds = [0] + (np.nonzero(before[codes[:-1]] & after[codes[1:]])[0] + 1).tolist()
+            if bounds[-1] != len(sequence):
+                bounds.append(len(sequence))
+            return list(zip(bounds[:-1], bounds[1:]))
+    else:
+        # As in the original digest(); with patterns that aren't two
+        # residues long, pieces may skip or overlap residues.
+        expr = re.compile(pattern)
+        def pieces(sequence):
+            spans = []
+            start = 0
+            while True:
+                m = expr.search(sequence, start)
+                if m is None:
+                    break
+                spans.append((start, m.end() - 1))
+                start = 1 + m.start()
+            if start != len(sequence):
+                spans.append((start, len(sequence)))
+            return spans
+    
+    _compiledEnzymes[enzyme] = pieces
+    return pieces
+
+_residueMassTables = {}
+def residue_mass_table(use_monoisotopic = True):
+    """
+    Array of residue (i.e., without water) masses indexed by character
+    code; entries for non-residue characters are NaN.
+    """
+    if use_monoisotopic not in _residueMassTables:
+        table = np.full(256, np.nan)
+        weights = AW if use_monoisotopic else Avg_AW
+        water = 2 * weights['H'] + weights['O']
+        for aa, formula in list(AminoAcidFormulas.items()):
+            table[ord(aa)] = sum(weights[el] * num for el, num in formula.items()) - water
+        _residueMassTables[use_monoisotopic] = table
+    return _residueMassTables[use_monoisotopic]
+
+def _cleave(protein, enzyme, missed_cleavages):
+    # Returns the sequence (whitespace removed), its fully cleaved pieces,
+    # the (start, end, first piece, missed cleavages) of every product, and
+    # whether the pieces are contiguous.  Fully cleaved products come first,
+    # then those with missed cleavages by position, as digest() has always
+    # listed them.
+    if not protein.isalpha():
+        protein = ''.join(protein.split())
+    spans = compile_enzyme(enzyme)(protein)
+    contiguous = all(spans[i][1] == spans[i+1][0] for i in range(len(spans) - 1))
+    products = [(start, end, i, 0) for i, (start, end) in enumerate(spans)]
     if missed_cleavages:
-        dig_all = digest_array[:]
-        for i,p in enumerate(digest_array[:-1]):
-            pep = p[0]
-            start = p[1][0]
-            for j in range(min((len(digest_array) - i - 1), missed_cleavages)):
-                pep += digest_array[i+j+1][0]
-                end = digest_array[i+j+1][1][1]
-                dig_all.append((pep, (start,end),j+1))
-        return dig_all
-
-    return digest_array
+        products += [(spans[i][0], spans[i + missed][1], i, missed)
+                     for i in range(len(spans) - 1)
+                     for missed in range(1, min(missed_cleavages, len(spans) - i - 1) + 1)]
+    return protein, spans, products, contiguous
+
+def digest_iter(protein, enzyme = 'Trypsin', missed_cleavages = 0,
+                min_length = None, max_length = None,
+                min_mass = None, max_mass = None):
+    """
+    Generator of the (peptide, start, end, missed_cleavages) digestion products
+    of a protein sequence, in the same order as digest(); start and end are
+    slice positions in the sequence.  Peptides can be filtered by length and
+    by (unmodified, monoisotopic) mass; peptides containing non-standard
+    residues have no mass, and are excluded by a mass filter.
+    """
+    protein, spans, products, contiguous = _cleave(protein, enzyme, missed_cleavages)
+    
+    if min_mass is not None or max_mass is not None:
+        codes = np.frombuffer(protein.encode('latin-1', 'replace'), dtype = np.uint8)
+        residueMasses = residue_mass_table()[codes]
+        # Residues without a mass are counted separately, so that they only
+        # exclude the peptides that contain them.
+        prefix = np.concatenate([[0], np.nancumsum(residueMasses)]).tolist()
+        unknown = np.concatenate([[0], np.cumsum(np.isnan(residueMasses))]).tolist()
+        water = 2 * AW['H'] + AW['O']
+    else:
+        prefix = None
+    
+    for start, end, i, missed in products:
+        if contiguous or not missed:
+            peptide = protein[start:end]
+        else:
+            peptide = ''.join(protein[a:b] for a, b in spans[i:i + missed + 1])
+        if min_length is not None and len(peptide) < min_length:
+            continue
+        if max_length is not None and len(peptide) > max_length:
+            continue
+        if prefix is not None:
+            if contiguous:
+                if unknown[end] != unknown[start]:
+                    continue
+                mass = prefix[end] - prefix[start] + water
+            else:
+                pieces = spans[i:i + missed + 1]
+                if any(unknown[b] != unknown[a] for a, b in pieces):
+                    continue
+                mass = sum(prefix[b] - prefix[a] for a, b in pieces) + water
+            if not ((min_mass is None or mass >= min_mass) and
+                    (max_mass is None or mass <= max_mass)):
+                continue
+        yield peptide, start, end, missed
 
 
 def fragment_legacy(peptide, ions=('b', 'b++', 'y', 'y++'), labels=True):
@@ -962,6 +1058,154 @@ def peptide_mass(peptide, modifications = None, use_monoisotopic = True,
     
 mw = peptide_mass # Legacy.
 
+
+# Batch peptide masses.  Residue masses are kept in arrays indexed by
+# character code, so a peptide's unmodified mass is a sum over its encoded
+# sequence; modification strings are parsed once and cached, and the
+# SpecialModifications (e.g. N15 labelling) become per-residue mass deltas.
+
+_peptideMassTables = {}
+def _peptide_mass_table(use_monoisotopic, special_aa_formulae = None):
+    # Masses of free amino acids (i.e., including a water, as in
+    # AminoAcidFormulas) by character code; NaN for anything else.
+    key = use_monoisotopic
+    if not special_aa_formulae and key in _peptideMassTables:
+        return _peptideMassTables[key]
+    
+    weights = AW if use_monoisotopic else Avg_AW
+    formulas = dict(AminoAcidFormulas)
+    formulas.update(special_aa_formulae or {})
+    table = np.full(256, np.nan)
+    for aa, formula in list(formulas.items()):
+        table[ord(aa)] = sum(weights[el] * num for el, num in formula.items())
+    if not special_aa_formulae:
+        _peptideMassTables[key] = table
+    return table
+
+_specialModDeltas = {}
+def _special_mod_deltas(name, use_monoisotopic, special_aa_formulae = None):
+    # Per-residue mass change from a SpecialModifications operation, found by
+    # applying it to each residue's formula alone.
+    key = name, use_monoisotopic
+    if not special_aa_formulae and key in _specialModDeltas:
+        return _specialModDeltas[key]
+    
+    weights = AW if use_monoisotopic else Avg_AW
+    formulas = dict(AminoAcidFormulas)
+    formulas.update(special_aa_formulae or {})
+    deltas = np.zeros(256)
+    for aa, formula in list(formulas.items()):
+        before = sum(weights[el] * num for el, num in formula.items())
+        after = SpecialModifications[name](defaultdict(int, formula), defaultdict(int), 0)[0]
+        deltas[ord(aa)] = sum(weights[el] * num for el, num in after.items()) - before
+    if not special_aa_formulae:
+        _specialModDeltas[key] = deltas
+    return deltas
+
+_parsedMods = {}
+def parse_modification(mod, use_monoisotopic = True):
+    """
+    Interprets a modification as peptide_mass does, returning one of
+    ('special', name), ('fixed', sites, mass) for a Mascot-style fixed
+    modification (applied to each occurrence of the sites) or ('mass', mass).
+    Results for strings and numbers are cached.
+    """
+    try:
+        return _parsedMods[mod, use_monoisotopic]
+    except (KeyError, TypeError): # TypeError for unhashable (dict) mods.
+        pass
+    
+    weights = AW if use_monoisotopic else Avg_AW
+    def formula_mass(formula):
+        return sum(weights[atom] * num for atom, num in list(formula.items()))
+    
+    if isinstance(mod, str) and mod in SpecialModifications:
+        parsed = 'special', mod
+    elif isinstance(mod, str) and mascotVarModPattern.match(mod):
+        submod = mod.split()[1]
+        assert submod in ModificationFormulae, ("Could not recognize variable "
+                                                "modfication %s" % mod)
+        parsed = 'mass', formula_mass(ModificationFormulae[submod])
+    elif isinstance(mod, str) and mascotFixModPattern.match(mod):
+        submod, sites = mod.split()
+        assert submod in ModificationFormulae, ("Could not recognize variable "
+                                                "modfication %s" % mod)
+        parsed = 'fixed', sites.strip('()'), formula_mass(ModificationFormulae[submod])
+    elif isinstance(mod, str) and mod in ModificationFormulae:
+        parsed = 'mass', formula_mass(ModificationFormulae[mod])
+    elif isinstance(mod, str) and formula_form.match(mod):
+        parsed = 'mass', formula_mass(parse_chemical_formula(mod))
+    elif isinstance(mod, dict):
+        return 'mass', formula_mass(mod)
+    elif isinstance(mod, float):
+        parsed = 'mass', mod
+    else:
+        try:
+            parsed = 'mass', float(mod)
+        except ValueError:
+            raise IOError("Unrecognized modification type: %s" % str(mod))
+    
+    _parsedMods[mod, use_monoisotopic] = parsed
+    return parsed
+
+def _modification_list(modifications):
+    if not modifications:
+        return []
+    elif isinstance(modifications, str):
+        return [x.strip() for x in modifications.split(';')]
+    return list(modifications)
+
+def peptide_masses(peptides, mods = None, use_monoisotopic = True,
+                   special_aa_formulae = None):
+    """
+    Masses of a list of peptides, as an array; equivalent to calling
+    peptide_mass on each, but much faster for large numbers of peptides.
+    mods, if given, is a list of the modifications of each peptide, in any
+    of the forms peptide_mass accepts (e.g., 'S3: Phospho; M5: Oxidation'.)
+    """
+    peptides = list(peptides)
+    if not peptides:
+        return np.zeros(0)
+    table = _peptide_mass_table(use_monoisotopic, special_aa_formulae)
+    weights = AW if use_monoisotopic else Avg_AW
+    water = 2 * weights['H'] + weights['O']
+    
+    lengths = np.array([len(x) for x in peptides])
+    codes = np.frombuffer(''.join(peptides).encode('latin-1', 'replace'), dtype = np.uint8)
+    residueMasses = table[codes]
+    if np.isnan(residueMasses).any():
+        bad = codes[np.isnan(residueMasses)][0]
+        raise KeyError(chr(bad))
+    
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    masses = np.zeros(len(peptides))
+    nonempty = lengths > 0
+    if nonempty.any():
+        # Summed per peptide (rather than by differences of one running sum
+        # over all of them) to keep full precision.
+        masses[nonempty] = np.add.reduceat(residueMasses, starts[nonempty])
+    masses -= (lengths - 1) * water
+    
+    if mods is None:
+        return masses
+    
+    for i, (peptide, modifications) in enumerate(zip(peptides, mods)):
+        extra = 0
+        for mod in _modification_list(modifications):
+            parsed = parse_modification(mod, use_monoisotopic)
+            if parsed[0] == 'mass':
+                extra += parsed[1]
+            elif parsed[0] == 'fixed':
+                extra += parsed[2] * sum(peptide.count(site) for site in parsed[1])
+            else:
+                deltas = _special_mod_deltas(parsed[1], use_monoisotopic,
+                                             special_aa_formulae)
+                extra += deltas[codes[starts[i]:ends[i]]].sum()
+        masses[i] += extra
+    
+    return masses
+
 def peptide_mz(peptide, mods, charge):
     mass = peptide_mass(peptide, mods)
     return ((mass + (protonMass * charge)) / charge)   
@@ -977,41 +1221,24 @@ def _placeCharge(mass, chg): # Assume uncharged to start.
 
 knownNeutralLosses = {'Phospho':chemicalFormulaMass('H3PO4')}
 
-def fragment(peptide, mods = [], charges = [1], 
-             ions = ['b', 'y'], 
-             neutralPhosLoss = False,
-             neutralLossDynamics = None,
-             waterLoss = False,
-             ammoniaLoss = False,
-             use_monoisotopic = True,
-             special_AAs = {}):
-    # Currently only records one neutral loss even if there's more than
-    # one loss-inducing mod.  Simplicity is a virtue?
+FRAGMENT_CACHE_SIZE = 4096
 
-   
+_fragmentIonTypes = {'b' : 'b', 'c' : 'b', 'y' : 'y', 'z' : 'y'}
+_fragmentOffsets = {'b' : 0, 'c' : 17.026000420104097, # NH3+
+                    'y' : 0, 'z' : -16.018724} # NH2
 
-    massType = 0 if use_monoisotopic else 1
-    aminoMasses = dict((aa,AminoAcidMasses[aa][massType]) for aa in list(AminoAcidMasses.keys()))
-    aminoMasses.update(special_AAs)
-    
-    if neutralLossDynamics is None:
-        neutralLossDynamics = {}
-    assert not (neutralPhosLoss and neutralLossDynamics)
-    if neutralPhosLoss:
-        neutralLossDynamics[mod_masses['Phospho']] = 97.9769
-    elif neutralLossDynamics:
-        for key, value in list(neutralLossDynamics.items()):
-            if isinstance(key, str):
-                neutralLossDynamics[mod_masses[key]] = value
-    
-    #assert not neutralPhosLoss, "Not currently set up for phos loss!"
-    #czLoss = 15.010899035
-    cLoss = 17.026000420104097 # NH3+
-    zLoss = 16.018724 # NH2
-    
+def _fragment_residue_table(massType):
+    table = np.full(256, np.nan)
+    for aa, masses in AminoAcidMasses.items():
+        table[ord(aa)] = masses[massType]
+    return table
+
+_fragmentResidueTables = {}
+
+def _fragment_mod_sites(peptide, mods):
+    # Returns N-terminus mass, C-terminus mass and {site : [mod masses]}.
     nterminusMass = 0
     cterminusMass = H2Omass
-    
     modBySite = defaultdict(list)
     if isinstance(mods, str):
         mods = mods.split('; ')
@@ -1041,135 +1268,301 @@ def fragment(peptide, mods = [], charges = [1],
             for site, aa in enumerate(peptide, start = 1):
                 if aa == loc:
                     modBySite[site].append(modmass)
+    return nterminusMass, cterminusMass, modBySite
+
+def _loss_dynamics(lossDynamics):
+    lossDynamics = dict(lossDynamics)
+    for key, value in list(lossDynamics.items()):
+        if isinstance(key, str):
+            lossDynamics[mod_masses[key]] = value
+    return lossDynamics
+
+def _fragment_matrix(psms, charges, ions, lossDynamics, waterLoss, ammoniaLoss,
+                     use_monoisotopic):
+    # Ions of a list of (peptide, mods) as an array of shape (PSMs, charges,
+    # ion types, variants, sites, 2), the last axis being each ion without
+    # and with its neutral loss; valid (of the same shape) marks the ions
+    # that exist.  Ladders are cumulative sums along the rows of a padded
+    # matrix of residue+mod masses, which adds in the same order as the
+    # previous site-by-site loop did and so gives identical masses.
+    massType = 0 if use_monoisotopic else 1
+    if massType not in _fragmentResidueTables:
+        _fragmentResidueTables[massType] = _fragment_residue_table(massType)
+    for iontype in ions:
+        if iontype not in _fragmentIonTypes:
+            raise ValueError("Unsupported ion type %s" % iontype)
+    
+    lengths = np.array([len(peptide) for peptide, _ in psms], dtype = int)
+    width = max(lengths.max() if len(psms) else 0, 1)
+    codes = np.frombuffer(''.join(peptide for peptide, _ in psms).encode('latin-1', 'replace'),
+                          dtype = np.uint8)
+    residues = _fragmentResidueTables[massType][codes]
+    if np.isnan(residues).any():
+        raise KeyError(chr(codes[np.isnan(residues)][0]))
+    starts = np.cumsum(lengths) - lengths
+    
+    sites = width - 1
+    termini = np.zeros((len(psms), 2))
+    lossChanges = np.zeros((2, len(psms), sites + 1))
+    lossSet = np.zeros((2, len(psms), sites + 1), dtype = bool)
+    for p, (peptide, mods) in enumerate(psms):
+        nterminusMass, cterminusMass, modBySite = _fragment_mod_sites(peptide, mods)
+        termini[p] = nterminusMass, cterminusMass
+        length = len(peptide)
+        for site, sitemods in modBySite.items():
+            if 1 <= site <= length:
+                residues[starts[p] + site - 1] += sum(sitemods)
         
-    
-    fragmentSetsByIonType = {}
-    if 'b' in ions or 'c' in ions:
-        bfrags = []
-        cfrags = []
-        bmass = nterminusMass
-        presentmods = []
-        for site in range(1, len(peptide)): # 1-indexed.
-            aa = peptide[site-1]
-            mods = modBySite[site]
-            presentmods += mods
-            bmass += AminoAcidMasses[aa][massType] + sum(mod_masses.get(x, x) for x in mods)
-                    
+        # Running neutral loss, from each terminus.
+        for direction, order in ((0, sorted(modBySite)),
+                                 (1, sorted(modBySite, reverse = True))):
             neutralLoss = 0
-            for mod in presentmods:
-                if mod in neutralLossDynamics:
-                    neutralLoss -= neutralLossDynamics[mod]            
-
-            if 'b' in ions:
-                bfrags.append(('b'+str(site), bmass))
-            if 'c' in ions:
-                cfrags.append(('c'+str(site), bmass + cLoss))
-
-            if neutralLoss:
-                if 'b' in ions:
-                    bfrags.append(('b%d-%.0f'%(site, abs(neutralLoss)), bmass + neutralLoss))                
-                if 'c' in ions:
-                    cfrags.append(('c%d-%.0f'%(site, abs(neutralLoss)), bmass + neutralLoss + cLoss))
-        if 'b' in ions:
-            fragmentSetsByIonType['b'] = bfrags
-        if 'c' in ions:
-            fragmentSetsByIonType['c'] = cfrags
-    
-    if 'y' in ions or 'z' in ions:
-        yfrags = []
-        zfrags = []
-        ymass = cterminusMass
-        presentmods = []
-        for site in range(len(peptide)-1, 0, -1): # 0-indexed.
-            aa = peptide[site]
-            mods = modBySite[site+1]
-            presentmods += mods
-            ymass += AminoAcidMasses[aa][massType] + sum(mod_masses.get(x, x) for x in mods)
-            
+            for site in order:
+                column = site if direction == 0 else length - site + 1
+                if not 1 <= column < length:
+                    continue
+                changed = False
+                for mod in modBySite[site]:
+                    if mod in lossDynamics:
+                        neutralLoss -= lossDynamics[mod]
+                        changed = True
+                if changed:
+                    lossChanges[direction, p, column] = neutralLoss
+                    lossSet[direction, p, column] = True
+    
+    padded = np.zeros((len(psms), width))
+    reverse = np.zeros((len(psms), width))
+    rows = np.repeat(np.arange(len(psms)), lengths)
+    columns = np.arange(len(codes)) - np.repeat(starts, lengths)
+    padded[rows, columns] = residues
+    reverse[rows, np.repeat(lengths, lengths) - 1 - columns] = residues
+    
+    ladders = np.stack([np.cumsum(np.concatenate([termini[:, :1], padded[:, :-1]], axis = 1),
+                                  axis = 1)[:, 1:],
+                        np.cumsum(np.concatenate([termini[:, 1:], reverse[:, :-1]], axis = 1),
+                                  axis = 1)[:, 1:]])
+    lastSet = np.maximum.accumulate(np.where(lossSet, np.arange(sites + 1), 0), axis = 2)
+    losses = np.take_along_axis(lossChanges, lastSet, axis = 2)[:, :, 1:]
+    
+    directions = [0 if _fragmentIonTypes[iontype] == 'b' else 1 for iontype in ions]
+    offsets = np.array([_fragmentOffsets[iontype] for iontype in ions])
+    # (PSMs, ion types, sites, 2)
+    ionLosses = np.zeros((len(psms), len(ions), sites, 2))
+    ionLosses[..., 1] = losses[directions].transpose(1, 0, 2)
+    masses = (ladders[directions].transpose(1, 0, 2)[..., None] + ionLosses
+              + offsets[None, :, None, None])
+    
+    chg = np.array(charges)[None, :, None, None, None]
+    ionmzs = (masses[:, None] + (chg*protonMass)) / chg
+    variantMasses = [H2Omass] * bool(waterLoss) + [NH3mass] * bool(ammoniaLoss)
+    blocks = [ionmzs]
+    for variantMass in variantMasses:
+        blocks.append((((ionmzs * chg) - (chg * protonMass)) - variantMass
+                       + (chg * protonMass)) / chg)
+    mzs = np.stack(blocks, axis = 3)
+    
+    # Every site of each peptide, and the loss ions where there is a loss.
+    valid = ((np.arange(sites)[None, None, :, None] < (lengths - 1)[:, None, None, None])
+             & ((ionLosses != 0) | np.array([True, False])))
+    valid = np.broadcast_to(valid[:, None, :, None], mzs.shape)
+    return mzs, valid, ionLosses
+
+class FragmentSet(object):
+    """
+    Fragment ions of a peptide, as returned by fragment_ions().  mzs holds
+    the m/z of every ion, grouped by ion type (in the order of types, e.g.
+    ['b', 'y', 'b++', 'y++']); ion i is of type types[kinds[i]], at cleavage
+    site sites[i] (counting from the ion's own terminus), with charge
+    charges[i], neutral loss losses[i] (0 for none) and variant
+    variants[i]: '' for the ion itself, or '0' or '*' for its water- and
+    ammonia-loss forms.
+    
+    Labels (e.g. 'b3', 'y05-98++') are only built when label(), labels()
+    or as_dict() is called.
+    """
 
-            neutralLoss = 0
-            for mod in presentmods:
-                if mod in neutralLossDynamics:
-                    neutralLoss -= neutralLossDynamics[mod]
-            
-            realsite = len(peptide)-site
-            if 'y' in ions:
-                yfrags.append(('y'+str(realsite), ymass))
-            if 'z' in ions:
-                zfrags.append(('z'+str(realsite), ymass - zLoss))
-
-            if neutralLoss:
-                yfrags.append(('y%d-%.0f'%(realsite, abs(neutralLoss)), ymass + neutralLoss))
-                if 'z' in ions:
-                    zfrags.append(('z%d-%.0f'%(realsite, abs(neutralLoss)), ymass + neutralLoss - zLoss))
+    def __init__(self, types, kinds, sites, charges, losses, variants, mzs):
+        self.types = types
+        self.kinds = kinds
+        self.sites = sites
+        self.charges = charges
+        self.losses = losses
+        self.variants = variants
+        self.mzs = mzs
+        self._labels = None
         
-        if 'y' in ions:
-            fragmentSetsByIonType['y'] = yfrags
-        if 'z' in ions:
-            fragmentSetsByIonType['z'] = zfrags
-                
-    # Similar for z and w and whatever, I guess.
-    
-    if 'by-int' in ions:
-        int_frags = []
-        for bsite in range(1, len(peptide)):
-            sub_intfrags = []
-            bMass = b
-    
-    
-    chargedFragmentSets = {}
-    # Replicate sequences for multiply-charged states.
-    for chg in charges:
-        chg = int(chg)
-        assert chg >= 1, "Positive charge states only!"
-                
-        for iontype in ions:
-            if chg == 1:
-                chgion = iontype
-            else:
-                chgion = iontype + '+'*chg
-            chargedFragmentSets[chgion] = []
-            for site, (prelabel, preion) in enumerate(fragmentSetsByIonType[iontype], start = 1):
-                newion = _placeCharge(preion, chg)
-                if chg == 1:
-                    newlabel = prelabel
-                else:
-                    newlabel = prelabel + '+'*chg
-                chargedFragmentSets[chgion].append((newlabel, newion))
-                
-                
-    
-    # Water-loss duplicates of ALL ions!
-    if waterLoss or ammoniaLoss:
-        for fragtype, labelions in list(chargedFragmentSets.items()):
-            waterlosses = []
-            ammonialosses = []
-            for label, ion in labelions:
-                chg = label.count('+') if '+' in label else 1
-                mass = (ion * chg) - (chg * protonMass)                
-                if waterLoss:
-                    newlabel = list(label)
-                    newlabel.insert(1, '0')
-                    newlabel = ''.join(newlabel)
-                    newmass = mass - H2Omass
-                    newion = (newmass + (chg * protonMass)) / chg
-                    waterlosses.append((newlabel, newion))
-                if ammoniaLoss:
-                    newlabel = list(label)
-                    newlabel.insert(1, '*')
-                    newlabel = ''.join(newlabel)
-                    newmass = mass - NH3mass
-                    newion = (newmass + (chg * protonMass)) / chg
-                    ammonialosses.append((newlabel, newion))
-            chargedFragmentSets[fragtype] += waterlosses
-            chargedFragmentSets[fragtype] += ammonialosses
-    
-    #if 1 not in charges:
-        #for iontype in ions:
-            #del fragmentSetsByIonType[iontype]
-    
-    return chargedFragmentSets
+        bounds = np.searchsorted(kinds, np.arange(len(types) + 1)).tolist()
+        self._bounds = dict((iontype, (bounds[i], bounds[i+1]))
+                            for i, iontype in enumerate(types))
+    
+    def __len__(self):
+        return len(self.mzs)
+    
+    def label(self, index):
+        iontype = self.types[self.kinds[index]]
+        label = iontype[0] + self.variants[index] + str(self.sites[index])
+        if self.losses[index]:
+            label += '-%.0f' % abs(self.losses[index])
+        if self.charges[index] > 1:
+            label += '+' * int(self.charges[index])
+        return label
+    
+    def labels(self):
+        if self._labels is None:
+            # Each ion type is a run of equal-length blocks, one per variant,
+            # sharing their site and loss text.
+            variants = self.variants.tolist()
+            sites = self.sites.tolist()
+            losses = self.losses.tolist()
+            self._labels = []
+            for iontype, (start, stop) in sorted(self._bounds.items(), key = lambda x: x[1]):
+                if start == stop:
+                    continue
+                length = variants[start:stop].count(variants[start])
+                tails = [str(site) + ('-%.0f' % abs(loss) if loss else '')
+                         for site, loss in zip(sites[start:start+length],
+                                               losses[start:start+length])]
+                suffix = iontype[1:]
+                for block in range(start, stop, length):
+                    prefix = iontype[0] + variants[block]
+                    self._labels += [prefix + tail + suffix for tail in tails]
+        return self._labels
+    
+    def ions(self, iontype):
+        """
+        Returns the (start, stop) range of the ions of the given type.
+        """
+        return self._bounds[iontype]
+    
+    def as_dict(self):
+        """
+        Returns {ion type : [(label, m/z), ...]}, as given by fragment().
+        """
+        labels = self.labels()
+        mzs = self.mzs.tolist()
+        return dict((iontype, list(zip(labels[start:stop], mzs[start:stop])))
+                    for iontype, (start, stop) in
+                    sorted(self._bounds.items(), key = lambda x: x[1]))
+
+@lru_cache(maxsize = FRAGMENT_CACHE_SIZE)
+def _fragment_set(peptide, mods, charges, ions, lossDynamics,
+                  waterLoss, ammoniaLoss, use_monoisotopic):
+    mzs, valid, ionLosses = _fragment_matrix([(peptide, mods)], charges, ions,
+                                             _loss_dynamics(lossDynamics),
+                                             waterLoss, ammoniaLoss, use_monoisotopic)
+    mzs, valid = mzs[0], valid[0]
+    chargeCount, typeCount, variantCount, siteCount, _ = mzs.shape
+    
+    def column(values):
+        return np.broadcast_to(values, mzs.shape)[valid]
+    
+    variants = [''] + ['0'] * bool(waterLoss) + ['*'] * bool(ammoniaLoss)
+    kinds = np.arange(chargeCount * typeCount).reshape(chargeCount, typeCount)
+    fragments = FragmentSet([iontype + '+'*chg if chg > 1 else iontype
+                             for chg in charges for iontype in ions],
+                            column(kinds[:, :, None, None, None]),
+                            column(np.arange(1, siteCount + 1)[:, None]),
+                            column(np.array(charges, dtype = int)[:, None, None, None, None]),
+                            column(ionLosses[0][:, None]),
+                            np.array(variants)[column(np.arange(variantCount)[:, None, None])],
+                            mzs[valid])
+    for array in (fragments.kinds, fragments.sites, fragments.charges,
+                  fragments.losses, fragments.variants, fragments.mzs):
+        array.flags.writeable = False
+    return fragments
+
+def _fragment_options(charges, ions, neutralPhosLoss, neutralLossDynamics):
+    # Hashable forms of fragment()'s arguments.
+    assert not (neutralPhosLoss and neutralLossDynamics)
+    if neutralPhosLoss:
+        lossDynamics = ((mod_masses['Phospho'], 97.9769),)
+    else:
+        lossDynamics = tuple((neutralLossDynamics or {}).items())
+    
+    charges = [int(chg) for chg in charges]
+    assert all(chg >= 1 for chg in charges), "Positive charge states only!"
+    # Repeated charges or ion types would give the same ion list twice.
+    charges = tuple(sorted(set(charges), key = charges.index))
+    ions = tuple(sorted(set(ions), key = list(ions).index))
+    return charges, ions, lossDynamics
+
+def fragment_ions(peptide, mods = [], charges = [1], 
+                  ions = ['b', 'y'], 
+                  neutralPhosLoss = False,
+                  neutralLossDynamics = None,
+                  waterLoss = False,
+                  ammoniaLoss = False,
+                  use_monoisotopic = True):
+    """
+    Fragment ions of a peptide as a FragmentSet of arrays, with the same
+    arguments as fragment().  Results are cached (for the most recent
+    FRAGMENT_CACHE_SIZE distinct calls), and shared between callers, so
+    should not be modified.
+    """
+    charges, ions, lossDynamics = _fragment_options(charges, ions, neutralPhosLoss,
+                                                    neutralLossDynamics)
+    if not isinstance(mods, str):
+        mods = tuple(mods)
+    return _fragment_set(peptide, mods, charges, ions, lossDynamics,
+                         bool(waterLoss), bool(ammoniaLoss), bool(use_monoisotopic))
 
+def fragment(peptide, mods = [], charges = [1], 
+             ions = ['b', 'y'], 
+             neutralPhosLoss = False,
+             neutralLossDynamics = None,
+             waterLoss = False,
+             ammoniaLoss = False,
+             use_monoisotopic = True,
+             special_AAs = {}):
+    """
+    Returns {ion type : [(label, m/z), ...]} of the b, c, y and/or z ions of
+    a peptide, at each of the given charges (ion types of charge greater than
+    1 are keyed e.g. 'y++'.)  mods is a list or '; '-separated string of
+    modifications ('S3: Phospho', 'M5: 15.9949', 'N-term: 42.0106' or fixed
+    mods such as 'Carbamidomethyl (C)').  Neutral losses of modifications
+    are given by neutralLossDynamics (mod mass or name -> lost mass), or by
+    neutralPhosLoss; waterLoss and ammoniaLoss add the water- and
+    ammonia-loss form of every ion (labelled 'b03', 'y*5', etc.)
+    
+    special_AAs is accepted for compatibility, but residue masses are always
+    those of AminoAcidMasses.
+    """
+    return fragment_ions(peptide, mods, charges, ions, neutralPhosLoss,
+                         neutralLossDynamics, waterLoss, ammoniaLoss,
+                         use_monoisotopic).as_dict()
+
+FRAGMENT_BATCH_SIZE = 1000
+
+def fragment_batch(psms, charges = [1], ions = ['b', 'y'], 
+                   neutralPhosLoss = False,
+                   neutralLossDynamics = None,
+                   waterLoss = False,
+                   ammoniaLoss = False,
+                   use_monoisotopic = True):
+    """
+    Fragment ions of a list of PSMs (peptides, or (peptide, mods) pairs), as
+    one array of m/z values along with an array giving the index of the PSM
+    each ion belongs to.  Within each PSM the ions are in the order of
+    fragment_ions(); other arguments are as for fragment().
+    
+    PSMs are computed together, FRAGMENT_BATCH_SIZE at a time, rather than
+    one by one, and aren't cached.
+    """
+    charges, ions, lossDynamics = _fragment_options(charges, ions, neutralPhosLoss,
+                                                    neutralLossDynamics)
+    lossDynamics = _loss_dynamics(lossDynamics)
+    psms = [(psm, []) if isinstance(psm, str) else tuple(psm) for psm in psms]
+    
+    mzs, owners = [np.zeros(0)], [np.zeros(0, dtype = int)]
+    for start in range(0, len(psms), FRAGMENT_BATCH_SIZE):
+        chunk = psms[start:start + FRAGMENT_BATCH_SIZE]
+        chunkmzs, valid, _ = _fragment_matrix(chunk, charges, ions, lossDynamics,
+                                              waterLoss, ammoniaLoss, use_monoisotopic)
+        mzs.append(chunkmzs[valid])
+        owners.append(np.broadcast_to(np.arange(start, start + len(chunk))
+                                      .reshape((-1,) + (1,) * (valid.ndim - 1)),
+                                      valid.shape)[valid])
+    return np.concatenate(mzs), np.concatenate(owners)
 
 
 def proline_fragments(peptide, *etc, **etcetc):
@@ -1196,31 +1589,8 @@ def proline_fragments(peptide, *etc, **etcetc):
        
 
 
-def generate_labels(scan, peptide, ions, charge=None, tolerance=0.6, **settings):
-    '''Takes an MS2 scan, and a peptide (in modification format as described
-    in the fragment function above) and generates a list of mass-label pairs
-    by matching theoretical ion masses to experimental values within a
-    tolerance.
-
-    - scan should be a list (or other sequence) of mz,intensity pairs to be matched.
-      This should probably NOT be an entire scan--that will result in a lot of
-      likely-erroneous matches (to noise). One option is to use the top 50 most
-      intense ions
-    - peptide should be in fragment-ready format (with modification masses)
-    - ions should be a list or set of ions to look for
-    - tolerance is in Daltons, 0.6 is a common value
-    - settings is a dictionary of optional arguments (default in brackets):
-      - show_theor_mz = [ True ] | False - Display theoretical ion mass
-      - ms2_mz_figs = integer >= 0, default 2 - Significant figures for mass error
-      - show_mass_error = True | [ False ] - Display mass error of ions
-      - mass_error_figs = integer >= 0, default 2 - Significant figures for mass error
-      - mass_error_units = ['ppm'] | 'Da' - Units to display mass error
-
-    Returns a tuple of mass-label pairs--the experimental peaks that matched
-    the theoretical ion masses within tolerance.
-    '''
-
-    # initialize defaults and update with optional arguments
+def _label_format(settings):
+    # Returns (settings, label_text, calc_error) for generate_labels.
     _settings = dict(show_theor_mz=True, ms2_mz_figs=2, show_mass_error=False,
                      mass_error_figs=2, mass_error_units='ppm')
     _settings.update(settings)
@@ -1230,6 +1600,7 @@ def generate_labels(scan, peptide, ions, charge=None, tolerance=0.6, **settings)
     else:
         calc_error = lambda exp_mz, theor_mz: abs(theor_mz - exp_mz)
 
+    label_text = None
     if _settings['show_theor_mz'] and _settings['show_mass_error']:
         label_text = '%%s [%%.%df - %%.%df %s]' % (_settings['ms2_mz_figs'],
                                                    _settings['mass_error_figs'],
@@ -1239,55 +1610,153 @@ def generate_labels(scan, peptide, ions, charge=None, tolerance=0.6, **settings)
     elif _settings['show_mass_error']:
         label_text = '%%s [%%.%df %s]' % (_settings['mass_error_figs'],
                                           _settings['mass_error_units'])
+    return _settings, label_text, calc_error
 
+def _label_ions(ions, charge):
     if charge and 'MH' in ions:
         ions = list(ions)
         ions.remove('MH')
 
         for z in range(int(charge), 0, -1):
             ions.append('MH%s' % ('+'*z))
+    return ions
 
-    calc_masses, label_dict = fragment_legacy(peptide, ions, labels=True)
+def match_ions(peak_mzs, peak_ints, peak_owners, calc_mzs, calc_owners, tolerance):
+    '''Matches theoretical m/z values to peaks within tolerance (in Daltons),
+    where each peak and theoretical value belongs to a spectrum given by its
+    owner index; peaks must be sorted by (owner, m/z, intensity.)
 
+    Returns (calc_indices, peak_indices): each matched theoretical value, in
+    order, with the most intense peak within tolerance of it (the first such
+    peak, in case of a tie.)
+
+    Both sets are merged as sorted arrays, so this takes
+    O((peaks + values) log peaks) rather than O(peaks x values) time.
+    '''
+    peak_mzs = np.asarray(peak_mzs, dtype = float)
+    peak_ints = np.asarray(peak_ints, dtype = float)
+    peak_owners = np.asarray(peak_owners, dtype = int)
+    calc_mzs = np.asarray(calc_mzs, dtype = float)
+    calc_owners = np.asarray(calc_owners, dtype = int)
+    if not len(peak_mzs) or not len(calc_mzs):
+        return np.zeros(0, dtype = int), np.zeros(0, dtype = int)
+
+    # Spectra are laid end to end on one axis, each span wide enough that
+    # tolerance windows can't reach the next; keys only need to be close
+    # enough to find candidates, which are then checked exactly as before.
+    low = min(peak_mzs.min(), calc_mzs.min()) - tolerance
+    span = max(peak_mzs.max(), calc_mzs.max()) + tolerance - low + 1
+    peak_keys = peak_owners * span + (peak_mzs - low)
+    calc_keys = calc_owners * span + (calc_mzs - low)
+    margin = 16 * np.spacing(max(peak_keys[-1], calc_keys.max()) + tolerance)
+    starts = np.searchsorted(peak_keys, calc_keys - tolerance - margin, 'left')
+    stops = np.searchsorted(peak_keys, calc_keys + tolerance + margin, 'right')
+
+    counts = stops - starts
+    calcs = np.repeat(np.arange(len(calc_mzs)), counts)
+    peaks = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+             + np.repeat(starts, counts))
+    close = ((peak_owners[peaks] == calc_owners[calcs])
+             & (np.abs(peak_mzs[peaks] - calc_mzs[calcs]) <= tolerance))
+    calcs, peaks = calcs[close], peaks[close]
+
+    order = np.lexsort((peaks, -peak_ints[peaks], calcs))
+    calcs, peaks = calcs[order], peaks[order]
+    first = np.ones(len(calcs), dtype = bool)
+    first[1:] = calcs[1:] != calcs[:-1]
+    return calcs[first], peaks[first]
+
+def _scan_points(scan):
+    # Scan peaks as (m/z list, intensity list), sorted as sorted(scan) would.
+    if hasattr(scan, 'mzs') and hasattr(scan, 'intensities'):
+        mzs = np.asarray(scan.mzs, dtype = float)
+        ints = np.asarray(scan.intensities, dtype = float)
+        order = np.lexsort((ints, mzs))
+        return mzs[order].tolist(), ints[order].tolist()
     scan = sorted(scan)
+    return [x[0] for x in scan], [x[1] for x in scan]
 
-    match_count = defaultdict(lambda: -1)
-
-    matched_calc = []
-    matched_exp = []
-    matched_int = []
-
-    # for each mass/int peak in the scan
-    for j,(mass,inte) in enumerate(scan):
-        # go through each calculated mass and try to match
-        for i,cmass in enumerate(calc_masses):
-            if abs(mass - cmass) <= tolerance:
-                if match_count[i] > -1:
-                    if matched_int[match_count[i]] < inte:
-                        matched_exp[match_count[i]] = mass
-                        matched_int[match_count[i]] = inte
-                    continue
+def generate_labels_batch(pairs, ions, charge=None, tolerance=0.6, **settings):
+    '''Batch form of generate_labels: pairs is a sequence of (scan, peptide)
+    or (scan, peptide, charge) tuples, and a list of the label tuples of each
+    pair is returned.  Matching for all of the pairs is done at once.
+    '''
+    _settings, label_text, calc_error = _label_format(settings)
+
+    pairs = [tuple(pair) + (charge,) * (3 - len(pair)) for pair in pairs]
+    fragments = {}
+    scans = []
+    peak_mzs, peak_ints, peak_owners = [], [], []
+    calc_mzs, calc_owners = [], []
+    for owner, (scan, peptide, pair_charge) in enumerate(pairs):
+        pair_ions = _label_ions(ions, pair_charge)
+        key = peptide, tuple(pair_ions)
+        if key not in fragments:
+            fragments[key] = fragment_legacy(peptide, pair_ions, labels=True)
+        calc_masses, label_dict = fragments[key]
+
+        mzs, ints = _scan_points(scan)
+        scans.append(mzs)
+        peak_mzs += mzs
+        peak_ints += ints
+        peak_owners += [owner] * len(mzs)
+        calc_mzs += calc_masses
+        calc_owners += [owner] * len(calc_masses)
+
+    calcs, peaks = match_ions(peak_mzs, peak_ints, peak_owners,
+                              calc_mzs, calc_owners, tolerance)
+
+    matched_calc = [[] for _ in pairs]
+    matched_exp = [[] for _ in pairs]
+    for calc, peak in zip(calcs.tolist(), peaks.tolist()):
+        owner = calc_owners[calc]
+        matched_calc[owner].append(calc_mzs[calc])
+        matched_exp[owner].append(peak_mzs[peak])
 
-                matched_calc.append(cmass)
-                matched_exp.append(mass)
-                matched_int.append(inte)
-                match_count[i] = len(matched_int) - 1
+    results = []
+    for owner, (scan, peptide, pair_charge) in enumerate(pairs):
+        label_dict = fragments[peptide, tuple(_label_ions(ions, pair_charge))][1]
+        exp = sorted(matched_exp[owner])
+        calc = sorted(matched_calc[owner])
+        if _settings['show_theor_mz'] and _settings['show_mass_error']:
+            results.append(tuple((e, (label_text % (label_dict[c], c, calc_error(e,c))))
+                                 for e,c in zip(exp,calc)))
+        elif _settings['show_theor_mz']:
+            results.append(tuple((e, (label_text % (label_dict[c], c)))
+                                 for e,c in zip(exp,calc)))
+        elif _settings['show_mass_error']:
+            results.append(tuple((e, (label_text % (label_dict[c], calc_error(e,c))))
+                                 for e,c in zip(exp,calc)))
+        else:
+            results.append(tuple((e, label_dict[c]) for e,c in zip(exp,calc)))
+    return results
 
-    matched_exp.sort()
-    matched_calc.sort()
+def generate_labels(scan, peptide, ions, charge=None, tolerance=0.6, **settings):
+    '''Takes an MS2 scan, and a peptide (in modification format as described
+    in the fragment function above) and generates a list of mass-label pairs
+    by matching theoretical ion masses to experimental values within a
+    tolerance.
 
-    if _settings['show_theor_mz'] and _settings['show_mass_error']:
-        return tuple((e, (label_text % (label_dict[c], c, calc_error(e,c))))
-                     for e,c in zip(matched_exp,matched_calc))
-    elif _settings['show_theor_mz']:
-        return tuple((e, (label_text % (label_dict[c], c)))
-                     for e,c in zip(matched_exp,matched_calc))
-    elif _settings['show_mass_error']:
-        return tuple((e, (label_text % (label_dict[c], calc_error(e,c))))
-                     for e,c in zip(matched_exp,matched_calc))
-    else:
-        return tuple((e, label_dict[c])
-                     for e,c in zip(matched_exp,matched_calc))
+    - scan should be a list (or other sequence) of mz,intensity pairs to be matched.
+      This should probably NOT be an entire scan--that will result in a lot of
+      likely-erroneous matches (to noise). One option is to use the top 50 most
+      intense ions
+    - peptide should be in fragment-ready format (with modification masses)
+    - ions should be a list or set of ions to look for
+    - tolerance is in Daltons, 0.6 is a common value
+    - settings is a dictionary of optional arguments (default in brackets):
+      - show_theor_mz = [ True ] | False - Display theoretical ion mass
+      - ms2_mz_figs = integer >= 0, default 2 - Significant figures for mass error
+      - show_mass_error = True | [ False ] - Display mass error of ions
+      - mass_error_figs = integer >= 0, default 2 - Significant figures for mass error
+      - mass_error_units = ['ppm'] | 'Da' - Units to display mass error
+
+    Returns a tuple of mass-label pairs--the experimental peaks that matched
+    the theoretical ion masses within tolerance.
+    '''
+
+    return generate_labels_batch([(scan, peptide, charge)], ions,
+                                 tolerance=tolerance, **settings)[0]
 
 
 def legacy_mz(peptide, charge=1):
@@ -1,10 +1,10 @@
-from multiplierz.mzAPI import mzFile
-from multiplierz.internalAlgorithms import splitOnFirst
+from multiplierz.mzAPI import mzFile, mzScan
+from multiplierz.internalAlgorithms import splitOnFirst, insert_tag
 from multiplierz import protonMass, __version__, vprint
 import os
+import numpy as np
 from numpy import average, std
 import re
-from six import PY2 as Is_Py2
 
 from multiplierz.mass_biochem import add_protons
 
@@ -90,7 +90,161 @@ def standard_title_parse(title):
     
     return data
 
-def parse_mgf(mgffile, labelType = (lambda x: x), header = False, rawStrings = False):
+# Block-based parsing, for arrays = True in parse_mgf and parse_to_generator.
+# The file is read in large blocks, entries are located with bytes.find(),
+# and the peak lists of all the entries in a block are converted to floats in
+# a single numpy call, then split back up by each entry's line count.  Extra
+# columns (fragment charges) are stripped out first if there are any; entries
+# that still don't fit the two-column layout (e.g., blank lines within the
+# peak list) are parsed line-by-line instead.
+
+MGF_BLOCK_SIZE = 16 * 1024 * 1024
+
+def _parse_header_fields(text, rawStrings):
+    entry = {}
+    for line in text.splitlines():
+        if '=' not in line:
+            continue
+        field, value = line.split('=', 1)
+        if (not rawStrings) and field == 'CHARGE':
+            value = int(value.strip('\n\r+ '))
+        elif (not rawStrings) and field == "PEPMASS":
+            value = float(value.split()[0].strip())
+        else:
+            value = value.strip()
+        entry[field.strip().lower()] = value
+    return entry
+
+def _parse_peak_lines(peaks):
+    # Line-by-line fallback; ignores fragment charge values.
+    points = [tuple(map(float, line.split()[:2])) for line in peaks.splitlines()
+              if line.strip()]
+    if not points:
+        return np.zeros(0), np.zeros(0)
+    points = np.array(points, dtype = float)
+    return points[:,0], points[:,1]
+
+# Matches peak lines with more than two values; substituting the group keeps
+# only the first two (as _parse_peak_lines does.)
+_FIRST_TWO_COLUMNS = re.compile(br'^([ \t]*[^\s]+[ \t]+[^\s]+)[ \t]+[^\s][^\r\n]*', re.M)
+
+def _first_group(match):
+    return match.group(1)
+
+def _two_column(peaks):
+    # True if every line of the peak list has exactly two values.
+    return (b'\n\n' not in peaks and b'\n\r\n' not in peaks
+            and len(peaks.split()) == 2 * peaks.count(b'\n'))
+
+def _convert_together(peakBlocks, counts):
+    # Converts the peak lists in a single call; None unless the result has
+    # exactly two values per line.
+    try:
+        values = np.fromstring(b''.join(peakBlocks), sep = ' ')
+    except ValueError: # Unparseable values (e.g., fragment charges like '2+'.)
+        return None
+    if len(values) != 2 * sum(counts):
+        return None
+    values = values.reshape(-1, 2)
+    results = []
+    position = 0
+    for count in counts:
+        points = values[position:position + count]
+        results.append((points[:,0], points[:,1]))
+        position += count
+    return results
+
+def _convert_peaks(peakBlocks):
+    # Returns (mzs, intensities) arrays for each of the peak list byte
+    # strings given (each ending in a newline.)  All are converted in one
+    # call if that gives two values per line; otherwise those whose lines
+    # all have two values are, and the rest are parsed line-by-line.
+    counts = [peaks.count(b'\n') for peaks in peakBlocks]
+    fast = [i for i, count in enumerate(counts) if count]
+    joined = b''.join(peakBlocks)
+    converted = None
+    if b'\n\n' not in joined and b'\n\r\n' not in joined:
+        converted = _convert_together([peakBlocks[i] for i in fast], [counts[i] for i in fast])
+        if converted is None: # E.g., fragment charge columns.
+            converted = _convert_together([_FIRST_TWO_COLUMNS.sub(_first_group, peakBlocks[i])
+                                           for i in fast], [counts[i] for i in fast])
+    if converted is None:
+        fast = [i for i in fast if _two_column(peakBlocks[i])]
+        converted = _convert_together([peakBlocks[i] for i in fast], [counts[i] for i in fast])
+    
+    results = [None] * len(peakBlocks)
+    for i, points in zip(fast, converted or []):
+        results[i] = points
+    for i, peaks in enumerate(peakBlocks):
+        if results[i] is None:
+            results[i] = _parse_peak_lines(peaks.decode('utf-8'))
+    return results
+
+def _parse_entry_blocks(entries, rawStrings):
+    peakBlocks = []
+    headers = []
+    for entry in entries:
+        # Header fields all come before the peak list.
+        peakStart = entry.find(b'\n', entry.rfind(b'=')) + 1 if b'=' in entry else 0
+        headers.append(_parse_header_fields(entry[:peakStart].decode('utf-8'), rawStrings))
+        peaks = entry[peakStart:]
+        if peaks and not peaks.endswith(b'\n'):
+            peaks += b'\n'
+        peakBlocks.append(peaks)
+    
+    for header, (mzs, intensities) in zip(headers, _convert_peaks(peakBlocks)):
+        header['spectrum'] = mzScan.from_arrays(mzs, intensities, mode = 'c',
+                                                sort = False)
+        yield header
+
+def parse_mgf_blocks(mgffile, rawStrings = False, topMatter = None,
+                     block_size = MGF_BLOCK_SIZE):
+    """
+    Generator of the entries of an MGF file, as in parse_to_generator, but
+    with each spectrum as an array-backed mzScan; much faster for large
+    files.  If topMatter is a dict, it's filled with any header fields
+    found before the first entry.
+    """
+    begin, end = b'BEGIN IONS', b'END IONS'
+    started = False
+    remainder = b''
+    with open(mgffile, 'rb') as mgf:
+        while True:
+            block = mgf.read(block_size)
+            text = remainder + block
+            if not started:
+                first = text.find(begin)
+                if first == -1 and block:
+                    remainder = text
+                    continue
+                if topMatter is not None:
+                    for line in text[:first if first != -1 else len(text)].decode('utf-8').splitlines():
+                        field, _, value = line.partition('=')
+                        if field in MGFTopMatter:
+                            topMatter[field.lower()] = value.strip()
+                started = True
+            
+            entries = []
+            position = 0
+            while True:
+                start = text.find(begin, position)
+                if start == -1:
+                    break
+                stop = text.find(end, start)
+                if stop == -1:
+                    break
+                entries.append(text[text.find(b'\n', start) + 1 : stop])
+                position = stop + len(end)
+            for entry in _parse_entry_blocks(entries, rawStrings):
+                yield entry
+            
+            if not block:
+                break
+            remainder = text[position:]
+
+
+def parse_mgf(mgffile, labelType = (lambda x: x), header = False, rawStrings = False,
+              arrays = False):
     """
     Loads a Mascot Generic Format file and returns it in dict form.
 
@@ -105,8 +259,19 @@ def parse_mgf(mgffile, labelType = (lambda x: x), header = False, rawStrings = F
     If raw_strings is set to True, the charge, pepmass, etc are returned
     as strings taken directly from the file, without conversion to numerical
     types.
+    
+    With arrays set to True, the file is read by the faster block-based
+    parser, and each spectrum is an mzScan rather than a list of tuples.
     """
 
+    if arrays:
+        data = {}
+        if header:
+            data['header'] = {}
+        for entry in parse_mgf_blocks(mgffile, rawStrings,
+                                      topMatter = data.get('header')):
+            data[labelType(entry.get('title'))] = entry
+        return data
 
     f = open(mgffile, "r")
 
@@ -158,58 +323,187 @@ def parse_mgf(mgffile, labelType = (lambda x: x), header = False, rawStrings = F
 
     return data    
 
+def parse_entry(lines):
+    """
+    Parses the lines of a single MGF entry (from BEGIN IONS to END IONS) into
+    an entry dict, as found in the output of parse_mgf.
+    """
+    entry = {}
+    spectrum = []
+    for line in lines:
+        if 'BEGIN IONS' in line:
+            continue
+        elif 'END IONS' in line:
+            break
+        elif '=' in line:
+            field, value = line.split('=', 1)
+            
+            if field == 'CHARGE':
+                value = int(value.strip('\n\r+ .0'))
+            elif field == "PEPMASS":
+                value = float(value.split()[0].strip())
+            else:
+                value = value.strip()
+                
+            entry[field.strip().lower()] = value
+        elif line.strip():
+            # Ignores fragment charge values.
+            spectrum.append(tuple(map(float, line.split()[:2])))
+    entry['spectrum'] = spectrum
+    return entry
+
+
+MGF_INDEX_VERSION = 1
+
+def _title_scan(title):
+    # Scan number from a multiplierz-standard title, if present.
+    match = re.search(r'\|SCAN:([^|]+)', title)
+    return match.group(1) if match else None
+
+def _scan_key(scan):
+    try:
+        return int(scan)
+    except ValueError:
+        return scan
+
+def index_mgf(filename):
+    """
+    Scans through an MGF file, and returns a list of (title, scan, offset,
+    length) for each entry; offset and length are the byte position and size
+    of the entry from its BEGIN IONS line through END IONS.  scan is taken
+    from the SCANS field, or from the title if it's in the multiplierz
+    standard format, or is None.
+    """
+    entries = []
+    offset = 0
+    with open(filename, 'rb') as mgf:
+        for line in mgf:
+            if line.startswith(b'BEGIN IONS'):
+                start = offset
+                title = scan = None
+            elif line.startswith(b'TITLE='):
+                title = line[6:].strip().decode('utf-8')
+            elif line.startswith(b'SCANS='):
+                scan = line[6:].strip().decode('utf-8')
+            elif line.startswith(b'END IONS'):
+                if scan is None and title is not None:
+                    scan = _title_scan(title)
+                entries.append((title, scan, start, offset + len(line) - start))
+            offset += len(line)
+    return entries
+
 class MGF(object):
     """
     Opens a file pointer into a Mascot Generic Format file indexed by entry
     title, exposing a dict-like interface.
+    
+    The index (the byte offset and length of each entry, by title and by
+    scan number) is saved next to the MGF as filename + '.idx', and reused
+    on later opens as long as the MGF's size and modification time are
+    unchanged.
     """    
-    def __init__(self, filename):
-        file_end = os.path.getsize(filename)
+    def __init__(self, filename, save_index = True):
+        self.filename = filename
+        self.index_file = filename + '.idx'
         self.fileptr = open(filename, 'rb')
-        self.entry_index = {}
         
-        titles = re.compile(b"TITLE=.*$", flags = re.M)
-        for i in range(0, file_end, 5000):
-            self.fileptr.seek(i)
-            text = self.fileptr.read(5500)
-            for match in titles.finditer(text):
-                pos, stoppos = match.start(), match.end()
-                title_text = text[pos + 6 : stoppos].strip()
-                if Is_Py2:
-                    self.entry_index[title_text] = pos + i
-                else:
-                    self.entry_index[str(title_text, 'utf-8')] = pos + i
+        stat = os.stat(filename)
+        self.signature = '%d\t%r' % (stat.st_size, stat.st_mtime)
+        entries = self._read_index()
+        if entries is None:
+            entries = index_mgf(filename)
+            if save_index:
+                self._write_index(entries)
         
-        print("Read file of size %d" % len(self.entry_index))
+        self.entry_index = {}
+        self.scan_index = {}
+        for title, scan, offset, length in entries:
+            if title is not None:
+                self.entry_index[title] = offset, length
+            if scan is not None:
+                self.scan_index[_scan_key(scan)] = offset, length
         
+        vprint("Read file of size %d" % len(self.entry_index))
+    
+    def _read_index(self):
+        # Returns None if there's no index or it's out of date.
+        try:
+            with open(self.index_file, 'r') as index:
+                if index.readline() != 'MGFIndex\t%d\n' % MGF_INDEX_VERSION:
+                    return None
+                if index.readline().rstrip('\n') != self.signature:
+                    return None
+                entries = []
+                for line in index:
+                    offset, length, scan, title = line.rstrip('\n').split('\t', 3)
+                    entries.append((title or None, scan or None, int(offset), int(length)))
+                return entries
+        except (IOError, OSError, ValueError):
+            return None
+    
+    def _write_index(self, entries):
+        try:
+            with open(self.index_file, 'w') as index:
+                index.write('MGFIndex\t%d\n' % MGF_INDEX_VERSION)
+                index.write(self.signature + '\n')
+                for title, scan, offset, length in entries:
+                    index.write('%d\t%d\t%s\t%s\n' % (offset, length, scan or '', title or ''))
+        except (IOError, OSError):
+            pass # E.g., read-only directory; the index is simply rebuilt next time.
+    
+    def _read_entry(self, position):
+        offset, length = position
+        self.fileptr.seek(offset)
+        return parse_entry(self.fileptr.read(length).decode('utf-8').splitlines())
+    
     def __getitem__(self, title):
-        pos = self.entry_index[title]
-        self.fileptr.seek(pos)
-        
-        entry = {}
-        spectrum = []
-        for line in self.fileptr:
-            if 'END IONS' in line:
-                entry['spectrum'] = spectrum
-                break
-            elif '=' in line:
-                field, value = line.split('=', 1)
-                
-                if field == 'CHARGE':
-                    value = int(value.strip('\n\r+ .0'))
-                elif field == "PEPMASS":
-                    value = float(value.split()[0].strip())
-                else:
-                    value = value.strip()
-                    
-                entry[field.strip().lower()] = value
-                if field == 'TITLE':
-                    key = value.strip()    
-            elif any(line):
-                # Ignores fragment charge values.
-                spectrum.append(tuple(map(float, line.split()[:2])))   
+        return self._read_entry(self.entry_index[title])
+    
+    def scan(self, scan):
+        """
+        Returns the entry for the given scan number.
+        """
+        return self._read_entry(self.scan_index[_scan_key(scan)])
+    
+    def get_entries(self, titles = None, scans = None):
+        """
+        Returns the entries for a list of titles (or scan numbers), in the
+        order given; the entries are read in file order, which is much faster
+        than looking up each one separately for large files.
+        """
+        if scans is not None:
+            positions = [self.scan_index[_scan_key(x)] for x in scans]
+        else:
+            positions = [self.entry_index[x] for x in titles]
         
-        return entry
+        entries = {}
+        for position in sorted(set(positions)):
+            entries[position] = self._read_entry(position)
+        return [entries[x] for x in positions]
+    
+    def __contains__(self, title):
+        return title in self.entry_index
+    
+    def __len__(self):
+        return len(self.entry_index)
+    
+    def __iter__(self):
+        return iter(self.entry_index)
+    
+    def keys(self):
+        return list(self.entry_index.keys())
+    
+    def scans(self):
+        return list(self.scan_index.keys())
+    
+    def close(self):
+        self.fileptr.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *etc):
+        self.close()
         
     
     
@@ -223,7 +517,8 @@ class MGF(object):
         #for line in mgf:
 
 
-def parse_to_generator(mgffile, labelType = (lambda x: x), header = False, rawStrings = False):
+def parse_to_generator(mgffile, labelType = (lambda x: x), header = False, rawStrings = False,
+                       arrays = False):
     """
     Reads in a Mascot Generic Format file as a generator of entries.
     
@@ -237,8 +532,15 @@ def parse_to_generator(mgffile, labelType = (lambda x: x), header = False, rawSt
     
     If raw_strings is set to True, the charge, pepmass, etc are returned
     as 
+    
+    With arrays set to True, the file is read by the faster block-based
+    parser, and each spectrum is an mzScan rather than a list of tuples.
     """
 
+    if arrays:
+        for entry in parse_mgf_blocks(mgffile, rawStrings):
+            yield entry
+        return
 
     f = open(mgffile, "r")
     topMatter = True
@@ -423,7 +725,8 @@ def extract(datafile, outputfile = None, default_charge = 2, centroid = True,
             isobaric_labels = None, label_tolerance = 0.01,
             channel_corrections = None,
             prec_info_file = None,
-            region_based_labels = False):
+            region_based_labels = False,
+            processes = 1):
     """
     Converts a mzAPI-compatible data file to MGF.
     
@@ -434,6 +737,10 @@ def extract(datafile, outputfile = None, default_charge = 2, centroid = True,
     deisotope_and_reduce_charge deisotopes and charge-reduces each MS2
     spectrum, which generally improves results from peptide database search
     algorithms. However, it should be disabled for very low-resolution scans.
+    
+    With processes > 1, the scans are split into chunks (each starting at
+    an MS1 scan) that are extracted in that many worker processes; the
+    output is the same as with a single process.
     """
     
     for key, val in [('tolerance', 0.01),
@@ -451,16 +758,21 @@ def extract(datafile, outputfile = None, default_charge = 2, centroid = True,
                                                     % outputfile)    
     
     data = mzFile(datafile)
-    from multiplierz.mgf.extraction import _extractor_
-    extractor = _extractor_(data, datafile, default_charge, centroid,
-                            scan_type, deisotope_and_reduce_charge, derive_precursor_via,
-                            maximum_precursor_mass, long_ms1,
-                            deisotope_and_reduce_MS1_args, deisotope_and_reduce_MS2_args,
-                            min_mz, precursor_tolerance, isobaric_labels, label_tolerance,
-                            channel_corrections, prec_info_file, region_based_labels)
+    from multiplierz.mgf.extraction import _extractor_, run_parallel
+    extractor_args = (default_charge, centroid,
+                      scan_type, deisotope_and_reduce_charge, derive_precursor_via,
+                      maximum_precursor_mass, long_ms1,
+                      deisotope_and_reduce_MS1_args, deisotope_and_reduce_MS2_args,
+                      min_mz, precursor_tolerance, isobaric_labels, label_tolerance,
+                      channel_corrections, prec_info_file, region_based_labels)
+    extractor = _extractor_(data, datafile, *extractor_args)
     writer = MGF_Writer(outputfile)
     
-    for scan, title, mz, charge in extractor.run():
+    if processes > 1:
+        entries = run_parallel(extractor, datafile, extractor_args, processes)
+    else:
+        entries = extractor.run()
+    for scan, title, mz, charge in entries:
         writer.write(scan, title, mass = mz, charge = charge)
     writer.close()
     
@@ -475,38 +787,92 @@ def extract(datafile, outputfile = None, default_charge = 2, centroid = True,
 
 
 
-def apply_spectral_process(mgfFile, functions, outputFile = None):
+# Functions from spectral_process that take mzScan spectra directly (and
+# return them), rather than needing a list of tuples.
+def _array_processes():
+    from multiplierz import spectral_process
+    return set([spectral_process.top_n_peaks, spectral_process.intensity_threshold,
+                spectral_process.mz_range, spectral_process.exclusion_radius,
+                spectral_process.signal_noise])
+
+def _apply_functions(spectrum, functions, arrayFunctions):
+    for args, func in functions:
+        if func not in arrayFunctions and isinstance(spectrum, mzScan):
+            spectrum = spectrum.tolist()
+        if args:
+            spectrum = func(spectrum, args)
+        else:
+            spectrum = func(spectrum)
+    return spectrum
+
+def _process_entries(entries, functions):
+    arrayFunctions = _array_processes()
+    for entry in entries:
+        entry['spectrum'] = _apply_functions(entry['spectrum'], functions, arrayFunctions)
+    return entries
+
+def _chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def apply_spectral_process(mgfFile, functions, outputFile = None,
+                           processes = 1, chunk_size = 200):
     """
     Takes an MGF file name and a list of functions together with their
     arguments, and applies each function; compatible with the 
     functions from spectral_process.py that act on scan spectra.
-    """
     
-    mgf = parse_mgf(mgfFile)
+    The MGF is streamed through rather than loaded, so memory use doesn't
+    depend on the file size.  With processes > 1, chunks of chunk_size
+    entries are processed in a pool of that many processes (the functions
+    must then be picklable, i.e. not lambdas); entries are written in their
+    original order either way.
+    """
     
     if not outputFile:
         outputFile = mgfFile
-        
-    def applyFunctions(spectrum):
-        for args, func in functions:
-            if args:
-                spectrum = func(spectrum, args)
-            else:
-                spectrum = func(spectrum)
-        return spectrum
-        
-    try:
-        header = mgf['header']
-        del mgf['header']
-    except KeyError:
-        header = None
-    with MGF_Writer(outputFile, header) as writer:
-        for entry in list(mgf.values()):
-            entry['spectrum'] = applyFunctions(entry['spectrum'])
-            writer.write(entry['spectrum'], entry['title'],
-                         mass = entry['pepmass'], charge = entry.get('charge', None))
+    # Written to a temporary file first, since it may replace the input.
+    tempFile = outputFile + '.partial'
+    
+    entries = parse_to_generator(mgfFile, arrays = True)
+    if processes > 1:
+        results = _pool_process(_chunked(entries, chunk_size), functions, processes)
+    else:
+        results = (_process_entries(chunk, functions)
+                   for chunk in _chunked(entries, chunk_size))
+    
+    with MGF_Writer(tempFile) as writer:
+        for chunk in results:
+            for entry in chunk:
+                writer.write(entry['spectrum'], entry['title'],
+                             mass = entry['pepmass'], charge = entry.get('charge', None))
+    os.replace(tempFile, outputFile)
     
     return outputFile
+
+def _pool_process(chunks, functions, processes):
+    # Like pool.imap, but with at most 2 chunks per process in flight, so
+    # that the input isn't read ahead any further than that.
+    import multiprocessing
+    from collections import deque
+    
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_process_entries, (chunk, functions)))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
     
     
     
@@ -536,7 +902,7 @@ def split_MGF(mgffile, splits = None, size_in_MB = None):
         out_count = 0
         split_size = (count / len(splits)) + 1
         out = MGF_Writer(splits[splitnum])
-        for entry in parse_to_generator(mgffile):
+        for entry in parse_to_generator(mgffile, arrays = True):
             out.add(entry)
             out_count += 1
             if out_count > split_size:
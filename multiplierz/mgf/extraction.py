@@ -3,6 +3,7 @@ from multiplierz.spectral_process import centroid as centroid_func # Distinct fr
 from multiplierz.mass_biochem import remove_protons
 from multiplierz.internalAlgorithms import floatrange, aggregate_points
 from multiplierz.mgf import standard_title_write
+from multiplierz.mzAPI import ScanCache
 from collections import defaultdict
 from numpy.linalg import solve     
 import os
@@ -14,6 +15,7 @@ import re
 RAW_CAL_MASS = 445.120025
 calibrant_tolerance = 0.003
 MS1_LENGTH = 0.5
+MS1_CACHE_BYTES = 64 * 1024 * 1024
 
 def compile_correction_matrix(channel_corrections, labels):
     assert labels, "No isobaric tag specified, but correction matrix given."
@@ -79,7 +81,7 @@ class _extractor_(object):
         else:
             self.correction_matrix = None
         self.calibrant = RAW_CAL_MASS
-        self.MS1_scan_batch = {}
+        self.MS1_scan_batch = ScanCache(MS1_CACHE_BYTES)
         
         if ('tolerance' not in self.deisoreduce_MS2_args
             or not self.deisoreduce_MS2_args['tolerance']):
@@ -127,13 +129,13 @@ class _extractor_(object):
         self.scanInfo = self.data.scan_info()
         self.ms1_list = sorted([x[2] for x in self.scanInfo if x[3] == 'MS1'])
         
+        scan_type = self.scan_type
         if self.filename.lower().endswith('.raw'): # May also exist for WIFF?
             self.filters = dict(self.data.filters())
             
             # For RAW files only, there's the option to filter by a given
             # scan type.  (It would be more efficient in many cases to
             # actually split files in a single run, though.)
-            scan_type = self.scan_type
             if scan_type and isinstance(scan_type, str):
                 typestr = "@%s" % scan_type.lower()
                 self.scanInfo = [x for x in self.scanInfo if x[3] == 'MS1' or
@@ -234,6 +236,15 @@ class _extractor_(object):
         else:
             return scan
     
+    def get_MS1(self, scanNum, centroid):
+        # Each MS1 is used for several consecutive long MS1s; keep the
+        # recently read ones around.
+        scan = self.MS1_scan_batch.get((scanNum, centroid))
+        if scan is None:
+            scan = self.data.scan(scanNum, centroid = centroid)
+            self.MS1_scan_batch.put((scanNum, centroid), scan)
+        return scan
+    
     def get_long_MS1_byProfile(self, scanNum):
         # This seems to take a really long time.  Profile-mode scans are heavy!
         ms1_index = bisect.bisect_left(self.ms1_list, scanNum)
@@ -241,17 +252,7 @@ class _extractor_(object):
                        in [-1, 0, 1]
                        if ms1_index + i >= 0 and ms1_index + i < len(self.ms1_list)]
 
-        ms1s = []
-        for scannum in scannumbers:
-            if scannum in self.MS1_scan_batch:
-                ms1s.append(self.MS1_scan_batch[scannum])
-            else:
-                scan = self.data.scan(scannum, centroid = False)
-                self.MS1_scan_batch[scannum] = scan
-                ms1s.append(scan)
-        to_del = [k for k in self.MS1_scan_batch if k <= scannumbers[0]]
-        for scannum in to_del:
-            del self.MS1_scan_batch[scannum]
+        ms1s = [self.get_MS1(scannum, centroid = False) for scannum in scannumbers]
         
         # MS1 profile scans aren't consistent across the entire MZ range,
         # apparently dependent upon whether there is signal in a particular
@@ -283,19 +284,7 @@ class _extractor_(object):
         ms1_index = bisect.bisect_left(self.ms1_list, scanNum)
         scannumbers = self.ms1_list[ms1_index-1:ms1_index+2]
 
-        ms1s = []
-        for scannum in scannumbers:
-            if scannum in self.MS1_scan_batch:
-                ms1s.append(self.MS1_scan_batch[scannum])
-            else:
-                scan = self.data.scan(scannum, centroid = True)
-                self.MS1_scan_batch[scannum] = scan
-                ms1s.append(scan)
-                
-        if len(self.MS1_scan_batch) > 100:
-            to_del = [k for k in self.MS1_scan_batch if k <= scannumbers[0]]
-            for scannum in to_del:
-                del self.MS1_scan_batch[scannum]
+        ms1s = [self.get_MS1(scannum, centroid = True) for scannum in scannumbers]
             
         long_ms1 = []
         inds = [0]*len(ms1s)
@@ -329,19 +318,7 @@ class _extractor_(object):
         ms1_index = bisect.bisect_left(self.ms1_list, scanNum)
         scannumbers = self.ms1_list[ms1_index-1:ms1_index+2]
 
-        ms1s = []
-        for scannum in scannumbers:
-            if scannum in self.MS1_scan_batch:
-                ms1s.append(self.MS1_scan_batch[scannum])
-            else:
-                scan = self.data.scan(scannum, centroid = True)
-                self.MS1_scan_batch[scannum] = scan
-                ms1s.append(scan)
-                
-        if len(self.MS1_scan_batch) > 100:
-            to_del = [k for k in self.MS1_scan_batch if k <= scannumbers[0]]
-            for scannum in to_del:
-                del self.MS1_scan_batch[scannum]                
+        ms1s = [self.get_MS1(scannum, centroid = True) for scannum in scannumbers]                
         
         agg_points = aggregate_points(list(chain(*ms1s)), MAX_WIDTH = 0.005)
         long_ms1 = []
@@ -386,13 +363,15 @@ class _extractor_(object):
                                             for c, xs in list(envelopes.items())], [])    
         
     
-    def run(self):
+    def run(self, scanInfo = None):
         self.inconsistent_precursors = 0
         self.scans_written = 0
         
         self.lastMS1ScanName = None
         self.possible_precursors = None
-        for time, mz, scanNum, scanLevel, scanMode in self.scanInfo:
+        if scanInfo is None:
+            scanInfo = self.scanInfo
+        for time, mz, scanNum, scanLevel, scanMode in scanInfo:
             scanName = scanNum if isinstance(scanNum, int) else time
             
             if scanLevel == 'MS1':
@@ -515,5 +494,94 @@ class _extractor_(object):
 
 
 
+# Parallel extraction.  The scan list is split into chunks that each begin
+# at an MS1, so every MS2 in a chunk has its precursor MS1 in the same chunk;
+# each worker process opens its own mzFile and extractor.  The only other
+# state carried from scan to scan is the RAW lock-mass calibrant, so each
+# worker first runs through the MS1 cycle preceding its chunk (discarding the
+# output) to pick up the calibrant, and the chunk is re-run serially if that
+# doesn't match what the preceding chunk actually ended on.  The output is
+# therefore identical to a serial run.
+
+EXTRACTION_CHUNK_SCANS = 1000
 
+def extraction_chunks(scanInfo, chunk_scans = EXTRACTION_CHUNK_SCANS):
+    """
+    Splits scanInfo into a list of (warmup, chunk) pairs, where each chunk
+    starts at an MS1 scan (except possibly the first) and has roughly
+    chunk_scans scans, and warmup is the MS1 cycle just before the chunk.
+    """
+    cycles = []
+    for info in scanInfo:
+        if info[3] == 'MS1' or not cycles:
+            cycles.append([])
+        cycles[-1].append(info)
+    
+    chunks = []
+    warmup = []
+    current = []
+    for cycle in cycles:
+        if current and len(current) + len(cycle) > chunk_scans:
+            chunks.append((warmup, current))
+            warmup = previous
+            current = []
+        current += cycle
+        previous = cycle
+    if current:
+        chunks.append((warmup, current))
+    return chunks
 
+
+_worker_extractor = None
+
+def _init_extraction_worker(datafile, extractor_args):
+    global _worker_extractor
+    from multiplierz.mzAPI import mzFile
+    _worker_extractor = _extractor_(mzFile(datafile), datafile, *extractor_args)
+
+def _extract_chunk(task):
+    warmup, chunk = task
+    extractor = _worker_extractor
+    extractor.calibrant = RAW_CAL_MASS
+    for _ in extractor.run(warmup):
+        pass
+    start_calibrant = extractor.calibrant
+    results = list(extractor.run(chunk))
+    return (start_calibrant, extractor.calibrant, results,
+            extractor.inconsistent_precursors, extractor.scans_written)
+
+def run_parallel(extractor, datafile, extractor_args, processes,
+                 chunk_scans = EXTRACTION_CHUNK_SCANS):
+    """
+    Equivalent to extractor.run(), with the scans split over a pool of
+    processes; extractor_args are the arguments the extractor was
+    constructed with, following data and filename.
+    """
+    import multiprocessing
+    
+    chunks = extraction_chunks(extractor.scanInfo, chunk_scans)
+    inconsistent_precursors = scans_written = 0
+    calibrant = RAW_CAL_MASS
+    
+    pool = multiprocessing.Pool(processes, initializer = _init_extraction_worker,
+                                initargs = (datafile, extractor_args))
+    try:
+        for (warmup, chunk), result in zip(chunks, pool.imap(_extract_chunk, chunks)):
+            start_calibrant, end_calibrant, results, inconsistent, written = result
+            if start_calibrant != calibrant:
+                extractor.calibrant = calibrant
+                results = list(extractor.run(chunk))
+                end_calibrant = extractor.calibrant
+                inconsistent = extractor.inconsistent_precursors
+                written = extractor.scans_written
+            calibrant = end_calibrant
+            inconsistent_precursors += inconsistent
+            scans_written += written
+            for entry in results:
+                yield entry
+    finally:
+        pool.terminate()
+    
+    extractor.calibrant = calibrant
+    extractor.inconsistent_precursors = inconsistent_precursors
+    extractor.scans_written = scans_written
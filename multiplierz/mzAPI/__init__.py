@@ -29,7 +29,7 @@ mzML, and mzURL (web-based data access)
 
 __author__ = 'Jignesh Parikh, James Webber, William Max Alexander'
 
-__all__ = ['mzFile']
+__all__ = ['mzFile', 'mzScan']
 
 #While these comtype imports are only needed for some filetypes, importing them only after other types, can crash due to changing thread mode
 try:
@@ -43,40 +43,347 @@ import os
 import re
 import sys
 
+import numpy as np
+
 from multiplierz import logger_message
 
-class mzScan(list):
-    """A subclass of the list object to represent a raw data scan.
+
+def cumulative_scan(mzs, intensities):
+    '''Returns the m/z-sorted m/z array of a scan, and the cumulative sum of
+    its intensities (with a leading zero), such that the summed intensity
+    between any two positions is the difference of two entries.'''
+    mzs = np.asarray(mzs, dtype = float)
+    intensities = np.asarray(intensities, dtype = float)
+    if len(mzs) > 1 and (np.diff(mzs) < 0).any():
+        order = np.argsort(mzs, kind = 'mergesort')
+        mzs, intensities = mzs[order], intensities[order]
+    cumulative = np.zeros(len(intensities) + 1)
+    np.cumsum(intensities, out = cumulative[1:])
+    return mzs, cumulative
+
+
+def scan_size(scan):
+    '''Estimates the memory used by a scan, in bytes; handles mzScans, numpy
+    arrays, lists of (m/z, intensity, ...) points, and tuples of either.'''
+    if isinstance(scan, (np.ndarray, mzScan)):
+        return scan.nbytes
+    if isinstance(scan, tuple):
+        return sys.getsizeof(scan) + sum(scan_size(x) for x in scan)
+    if isinstance(scan, list):
+        size = sys.getsizeof(scan)
+        if scan:
+            # Points within a scan are uniform, so the first stands for all.
+            point = scan[0]
+            if isinstance(point, (tuple, list)):
+                size += len(scan) * (sys.getsizeof(point) +
+                                     sum(sys.getsizeof(x) for x in point))
+            else:
+                size += len(scan) * sys.getsizeof(point)
+        return size
+    return sys.getsizeof(scan)
+
+
+class ScanCache(object):
+    """Least-recently-used cache of scans, bounded by an estimate of the
+    total memory used (see scan_size()) rather than by number of scans.
+
+    hits, misses and evictions count cache activity since the cache was
+    created (or last cleared.)
     """
 
-    def __init__(self, s, time, mode='p', mz=0.0, z=0):
+    def __init__(self, max_bytes = 256 * 1024 * 1024):
+        from collections import OrderedDict
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default = None):
+        try:
+            scan, size = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return scan
+
+    def put(self, key, scan, size = None):
+        if size is None:
+            size = scan_size(scan)
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        if size > self.max_bytes:
+            return # Would only flush everything else out.
+        self.entries[key] = scan, size
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, oldsize) = self.entries.popitem(last = False)
+            self.size -= oldsize
+            self.evictions += 1
+
+    def resize(self, max_bytes):
+        """Changes the memory budget, evicting scans as need be to fit."""
+        self.max_bytes = max_bytes
+        while self.size > self.max_bytes:
+            _, (_, oldsize) = self.entries.popitem(last = False)
+            self.size -= oldsize
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        return {'hits' : self.hits, 'misses' : self.misses,
+                'evictions' : self.evictions, 'scans' : len(self.entries),
+                'bytes' : self.size, 'max_bytes' : self.max_bytes}
+
+class mzScan(object):
+    """A spectrum, stored as contiguous numpy arrays of m/z and intensity
+    values (and optionally noise and charge, as from RAW lscan() data.)
+
+    mzScan behaves as a list of (m/z, intensity) pairs for iteration,
+    indexing, len(), comparison, concatenation (in either order) and
+    append/extend/sort, so it can be passed wherever a list-of-tuples scan
+    is expected; slicing returns another mzScan.  It is not a list
+    subclass, though, so isinstance(scan, list) is False; use tolist() where
+    an actual list is required.
+
+    Points are kept in the order given, as with a list, unless sort=True is
+    passed.  Scans that are in m/z order (as they are from the file readers)
+    get binary searches in peak() and window() rather than linear scans.
+    """
+
+    def __init__(self, s, time, mode='p', mz=0.0, z=0, sort=False):
         '''Create a scan object.
 
-        - s is an iterable of (m/z, intensity) pairs
+        - s is an iterable of (m/z, intensity) pairs, or of (m/z, intensity,
+          noise, charge) tuples
         - time is the time of acquisition
         - mode is 'p' or 'c' for profile or centroid scans respectively
         - mz is the m/z of the targeted peak (0.0 if not known/applicable)
         - z is the charge of the targeted peak (0 if not known/applicable)
+        - sort puts the points in m/z order; otherwise they're kept as given
         '''
-        list.__init__(self, s)
+        if isinstance(s, mzScan):
+            mzs, intensities, noise, charge = s.mzs, s.intensities, s.noise, s.charge
+        else:
+            points = np.asarray(list(s) if not isinstance(s, np.ndarray) else s,
+                                dtype = float)
+            if not len(points):
+                points = np.zeros((0, 2))
+            mzs, intensities = points[:,0], points[:,1]
+            if points.shape[1] >= 4:
+                noise, charge = points[:,2], points[:,3].astype(int)
+            else:
+                noise = charge = None
+        self._set_arrays(mzs, intensities, noise, charge, sort = sort)
         self.time = time
         self.mode = mode
         self.mz = mz
         self.z = z
 
+    @classmethod
+    def from_arrays(cls, mzs, intensities, time=None, mode='p', mz=0.0, z=0,
+                    noise=None, charge=None, sort=False):
+        '''Create a scan object directly from arrays of values, without
+        going through (m/z, intensity) tuples.  As with the constructor, the
+        points are kept in the order given unless sort=True.'''
+        scan = cls.__new__(cls)
+        scan._set_arrays(mzs, intensities, noise, charge, sort=sort)
+        scan.time = time
+        scan.mode = mode
+        scan.mz = mz
+        scan.z = z
+        return scan
+
+    def _set_arrays(self, mzs, intensities, noise=None, charge=None, sort=False):
+        mzs = np.ascontiguousarray(mzs, dtype = float)
+        intensities = np.ascontiguousarray(intensities, dtype = float)
+        if noise is not None:
+            noise = np.ascontiguousarray(noise, dtype = float)
+        if charge is not None:
+            charge = np.ascontiguousarray(charge, dtype = int)
+        unsorted = len(mzs) > 1 and (np.diff(mzs) < 0).any()
+        if unsorted and sort:
+            order = np.argsort(mzs, kind = 'mergesort')
+            mzs, intensities = mzs[order], intensities[order]
+            if noise is not None:
+                noise = noise[order]
+            if charge is not None:
+                charge = charge[order]
+        self.mzs = mzs
+        self.intensities = intensities
+        self.noise = noise
+        self.charge = charge
+        self._mz_sorted = sort or not unsorted
+
+    def _subset(self, selector):
+        # Keeps the existing order, whatever it is.
+        scan = mzScan.__new__(mzScan)
+        scan._set_arrays(self.mzs[selector], self.intensities[selector],
+                         None if self.noise is None else self.noise[selector],
+                         None if self.charge is None else self.charge[selector],
+                         sort = False)
+        scan.time = self.time
+        scan.mode = self.mode
+        scan.mz = self.mz
+        scan.z = self.z
+        return scan
+
+    # List compatibility.
+
+    def __len__(self):
+        return len(self.mzs)
+
+    def __iter__(self):
+        return zip(self.mzs.tolist(), self.intensities.tolist())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._subset(index)
+        return float(self.mzs[index]), float(self.intensities[index])
+
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and all(a == tuple(b) for a, b in zip(self, other))
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __add__(self, other):
+        return self.tolist() + list(other)
+
+    def __radd__(self, other):
+        return list(other) + self.tolist()
+
+    def __repr__(self):
+        return 'mzScan(%d peaks, time=%s, mode=%r)' % (len(self), self.time, self.mode)
+
+    def __array__(self, dtype=None, copy=None):
+        points = np.column_stack([self.mzs, self.intensities])
+        return points if dtype is None else points.astype(dtype)
+
+    def append(self, point):
+        point = tuple(point)
+        self.mzs = np.append(self.mzs, point[0])
+        self.intensities = np.append(self.intensities, point[1])
+        if self.noise is not None:
+            self.noise = np.append(self.noise, point[2] if len(point) > 2 else 0.0)
+        if self.charge is not None:
+            self.charge = np.append(self.charge, point[3] if len(point) > 3 else 0)
+        if len(self.mzs) > 1 and self.mzs[-1] < self.mzs[-2]:
+            self._mz_sorted = False
+
+    def extend(self, points):
+        for point in points:
+            self.append(point)
+
+    def sort(self, key=None, reverse=False):
+        '''As list.sort(); with no key, sorts by m/z.'''
+        if key is None and not reverse:
+            order = np.argsort(self.mzs, kind = 'mergesort')
+        else:
+            points = list(self)
+            order = sorted(range(len(points)),
+                           key = (lambda i: key(points[i])) if key else points.__getitem__,
+                           reverse = reverse)
+            order = np.asarray(order, dtype = int)
+        self.mzs = self.mzs[order]
+        self.intensities = self.intensities[order]
+        if self.noise is not None:
+            self.noise = self.noise[order]
+        if self.charge is not None:
+            self.charge = self.charge[order]
+        self._mz_sorted = bool(len(self.mzs) < 2 or (np.diff(self.mzs) >= 0).all())
+
+    def copy(self):
+        '''Returns a copy of the scan, with its own arrays.'''
+        return self._subset(np.arange(len(self))) # Fancy indexing copies.
+
+    def tolist(self, extra=False):
+        '''Returns the scan as a list of (m/z, intensity) tuples, or with
+        extra, (m/z, intensity, noise, charge) tuples where available.'''
+        if extra and self.noise is not None:
+            return list(zip(self.mzs.tolist(), self.intensities.tolist(),
+                            self.noise.tolist(), self.charge.tolist()))
+        return list(zip(self.mzs.tolist(), self.intensities.tolist()))
+
+    @property
+    def nbytes(self):
+        return sum(x.nbytes for x in (self.mzs, self.intensities, self.noise, self.charge)
+                   if x is not None)
+
+    # Vectorized operations.
+
+    def _window_bounds(self, start_mz, stop_mz):
+        if self._mz_sorted:
+            return (int(np.searchsorted(self.mzs, start_mz, side = 'left')),
+                    int(np.searchsorted(self.mzs, stop_mz, side = 'right')))
+        return np.nonzero((self.mzs >= start_mz) & (self.mzs <= stop_mz))[0]
+
+    def window(self, start_mz, stop_mz):
+        '''Returns the peaks within [start_mz, stop_mz] as an mzScan'''
+        bounds = self._window_bounds(start_mz, stop_mz)
+        if isinstance(bounds, tuple):
+            return self._subset(slice(*bounds))
+        return self._subset(bounds)
+
     def peak(self, mz, tolerance):
         '''Returns the max intensity within a tolerance of a target m/z'''
-        return max([i for m,i in self if abs(m-mz) <= tolerance] or [0])
+        bounds = self._window_bounds(mz - tolerance, mz + tolerance)
+        if isinstance(bounds, tuple):
+            intensities = self.intensities[bounds[0]:bounds[1]]
+        else:
+            intensities = self.intensities[bounds]
+        return float(intensities.max()) if len(intensities) else 0
+
+    def top(self, count):
+        '''Returns the count most intense peaks, in m/z order'''
+        if count >= len(self):
+            return self.copy()
+        selected = np.argpartition(self.intensities, len(self) - count)[len(self) - count:]
+        return self._subset(np.sort(selected))
+
+    def threshold(self, min_intensity):
+        '''Returns the peaks with intensity of at least min_intensity'''
+        return self._subset(np.nonzero(self.intensities >= min_intensity)[0])
+
+    def take(self, selector):
+        '''Returns the peaks picked out by an array of positions (in the
+        order given) or a boolean mask, as an mzScan'''
+        selector = np.asarray(selector)
+        if selector.dtype == bool:
+            selector = np.nonzero(selector)[0]
+        return self._subset(selector)
 
 
 class mzFile(object):
     """Base class for access to MS data files"""
 
-    def __init__(self, data_file, numThreads=0, **kwargs):
+    def __init__(self, data_file, numThreads=0, scan_cache=None, **kwargs):
         """Initializes mzAPI and opens a new file of a specified type
 
         file_type can be 'raw', 'wiff', 'mzml', or 'mzurl'
 
+        scan_cache, if given, is a memory budget in bytes for caching
+        scans (see enable_scan_cache()); True uses the default budget.
+
         Example:
         >>> data_file = 'C:\\Documents and Settings\\User\\Desktop\\example.RAW'
         >>> mz_file = mzAPI.mzFile(data_file)
@@ -151,7 +458,81 @@ class mzFile(object):
             mzT2D.mzFile.__init__(self, data_file, **kwargs)
         else:
             raise NotImplementedError("Can't open %s; extension not recognized." % data_file)
-        
+
+        if scan_cache:
+            if scan_cache is True:
+                self.enable_scan_cache()
+            else:
+                self.enable_scan_cache(scan_cache)
+
+    def enable_scan_cache(self, max_bytes = 256 * 1024 * 1024):
+        """Memoizes scan() and array_scan() calls, keeping the most recently
+        used scans up to an estimated max_bytes of memory.
+
+        Scans are keyed by scan name and the remaining arguments to scan()
+        (i.e., the centroid flag), so this works identically for every
+        file type.  Each call returns a fresh copy of a cached list or
+        mzScan, so callers may sort or modify their scans freely.
+
+        Example:
+        >>> mz_file.enable_scan_cache(512 * 1024 * 1024)
+        >>> mz_file.scan(2165, centroid = True) # Read from file.
+        >>> mz_file.scan(2165, centroid = True) # Read from cache.
+        >>> mz_file.scan_cache_stats()['hits']
+        1
+
+        """
+
+        self.disable_scan_cache()
+        self._scan_cache = ScanCache(max_bytes)
+        self._uncached_scan = self.scan
+        self._uncached_array_scan = self.array_scan
+        # Shadows the class's methods for this object only.
+        self.scan = self._cached_scan
+        self.array_scan = self._cached_array_scan
+
+    def disable_scan_cache(self):
+        """Stops caching scans and discards any that were cached."""
+        if '_uncached_scan' in self.__dict__:
+            del self.scan, self.array_scan
+            del self._uncached_scan, self._uncached_array_scan
+        self._scan_cache = None
+
+    def clear_scan_cache(self):
+        """Discards all cached scans and resets the cache counters."""
+        if getattr(self, '_scan_cache', None) is not None:
+            self._scan_cache.clear()
+
+    def scan_cache_stats(self):
+        """Returns a dict of the scan cache's hits, misses, evictions,
+        number of scans held, estimated bytes held, and budget, or None
+        if the scan cache is not enabled."""
+        if getattr(self, '_scan_cache', None) is None:
+            return None
+        return self._scan_cache.stats()
+
+    def _cached_call(self, method, scan_name, args, kwargs):
+        key = (method.__name__, scan_name, args, tuple(sorted(kwargs.items())))
+        try:
+            scan = self._scan_cache.get(key)
+        except TypeError: # Unhashable arguments; not cacheable.
+            return method(scan_name, *args, **kwargs)
+        if scan is None:
+            scan = method(scan_name, *args, **kwargs)
+            self._scan_cache.put(key, scan)
+        if isinstance(scan, list):
+            import copy
+            return copy.copy(scan)
+        elif isinstance(scan, mzScan):
+            return scan.copy()
+        return scan
+
+    def _cached_scan(self, scan_name, *args, **kwargs):
+        return self._cached_call(self._uncached_scan, scan_name, args, kwargs)
+
+    def _cached_array_scan(self, scan_name, *args, **kwargs):
+        return self._cached_call(self._uncached_array_scan, scan_name, args, kwargs)
+
     def __enter__(self):
         # this method allows mzFiles to be used in with-statements
         # e.g.: with mzFile(file_name) as m: ...
@@ -224,6 +605,26 @@ class mzFile(object):
 
         raise NotImplementedError('Subclasses must implement this method')
 
+    def array_scan(self, scan_name, *args, **kwargs):
+        """Gets a scan as an mzScan, which holds its peaks in numpy arrays
+
+        Takes the same arguments as scan(); file types which can read
+        arrays directly do so without building a list of tuples first.
+
+        Example:
+        >>> scan = mz_file.array_scan(2165, centroid = True)
+        >>> scan.peak(435.91, 0.01)
+
+        """
+
+        # Cached (if at all) as an mzScan, not also as a list.
+        scan = getattr(self, '_uncached_scan', self.scan)(scan_name, *args, **kwargs)
+        try:
+            time = self.scan_time_from_scan_name(scan_name)
+        except (NotImplementedError, IndexError, KeyError):
+            time = None
+        return mzScan(scan, time, 'c' if kwargs.get('centroid') else 'p')
+
     def xic(self, start_time, stop_time, start_mz, stop_mz, filter=None):
         """Generates eXtracted Ion Chromatogram (XIC) for given time and mz range
 
@@ -237,6 +638,60 @@ class mzFile(object):
 
         raise NotImplementedError('Subclasses must implement this method')
 
+    def xics(self, windows):
+        """Generates XICs for many (start_time, stop_time, start_mz, stop_mz) windows
+
+        Each MS1 scan is read once, and its intensities summed into every
+        window that contains it; this is much faster than separate xic()
+        calls for large numbers of overlapping windows.  Returns a list
+        of XICs (lists of (time, intensity) pairs) in the order of the
+        windows given.
+
+        Example:
+        >>> light, heavy = mz_file.xics([(31.4, 32.4, 435.82, 436.00),
+        ...                              (31.4, 32.4, 439.83, 440.01)])
+
+        """
+
+        if not len(windows):
+            return []
+        bounds = np.array(windows, dtype = float).reshape(-1, 4)
+        # With windows sorted by start time, those which may contain a
+        # given scan are always a prefix of the sorted list.
+        order = np.argsort(bounds[:,0], kind = 'mergesort')
+        starts = bounds[order, 0]
+        last_stop = bounds[:,1].max()
+
+        results = [[] for _ in range(len(bounds))]
+        for rt, scan in self._xic_ms1_scans():
+            if rt > last_stop:
+                break
+            candidates = order[:np.searchsorted(starts, rt, side = 'right')]
+            active = candidates[bounds[candidates, 1] >= rt]
+            if not len(active):
+                continue
+
+            mzs, cumulative = self._xic_scan_arrays(scan)
+            lows = np.searchsorted(mzs, bounds[active, 2], side = 'left')
+            highs = np.searchsorted(mzs, bounds[active, 3], side = 'right')
+            sums = cumulative[np.maximum(highs, lows)] - cumulative[lows]
+            for window, intensity in zip(active.tolist(), sums.tolist()):
+                results[window].append((rt, intensity))
+
+        return results
+
+    def _xic_ms1_scans(self):
+        # (time, scan name) of every MS1 scan, in order of time.
+        return sorted((rt, scan) for rt, mz, scan, level, mode
+                      in self.scan_info() if level == 'MS1')
+
+    def _xic_scan_arrays(self, scan):
+        # Output of cumulative_scan() for the given scan.
+        peaks = np.asarray(self.scan(scan), dtype = float)
+        if not len(peaks):
+            return np.zeros(0), np.zeros(1)
+        return cumulative_scan(peaks[:,0], peaks[:,1])
+
     def time_range(self):
         """Returns a pair of times corresponding to the first and last scan time
 
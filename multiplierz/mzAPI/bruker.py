@@ -10,6 +10,8 @@ from bisect import bisect_left, bisect_right
 from pathlib import Path
 from enum import Enum
 
+from multiplierz.mzAPI import mzFile as baseFile, cumulative_scan
+
 if sys.platform[:5] == "win32": libname = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'brukerlib', "timsdata.dll")
 elif sys.platform[:5] == "linux": libname = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'brukerlib', "libtimsdata.so")
 else: raise Exception("Unsupported platform.")
@@ -342,7 +344,7 @@ class TimsData:
 
         if rc == 0: throwLastTimsDataError(self.dll)
 
-class mzBruker(object):
+class mzBruker(baseFile):
     def __init__(self, d_directory, numThreads=0):
         self.data_file = d_directory
         tdfFile = os.path.join(d_directory, 'analysis.tdf')
@@ -530,6 +532,14 @@ class mzBruker(object):
             
         return xic
     
+    # Frame-based versions of the mzFile.xics() hooks; the XICs span the
+    # full mobility range of each MS1 frame.
+    def _xic_ms1_scans(self):
+        return sorted((rt, framenum) for framenum, rt in self.ms1_frames)
+    
+    def _xic_scan_arrays(self, framenum):
+        return cumulative_scan(*self.scan(framenum, mzIntsReturnOnly = True))
+    
     def mobiligram(self, start_rt, stop_rt, start_mz, stop_mz, start_k0=-1, stop_k0=-1):
     
         #WARNING/TODO: THIS CODE HAS NOT BEEN VALIDATED SINCE BEING UPDATED
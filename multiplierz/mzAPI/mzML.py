@@ -1,9 +1,11 @@
 import multiplierz.mzAPI
-from multiplierz.mzml import mzmlToSqlite, demarshal
+from multiplierz.mzAPI import cumulative_scan, mzScan
+from multiplierz.mzml import mzmlToSqlite, mzmlsql_reader, mzmlIndexedReader
 import os, sys
 
+import bisect
+import shutil
 import tempfile
-import sqlite3 as sqlite
 import warnings
 
 
@@ -13,103 +15,172 @@ import warnings
 
 class mzFile(multiplierz.mzAPI.mzFile):
     """
-    mzAPI access to mzFile files. Loads everything from the XML into a SQLite
-    database, which is a slow startup procedure but allows fast random-access
-    to the data without tremendous RAM usage. For once-through sequential
-    processing, this is NOT the way to go- try the iterator functions in
-    multiplierz.mzML instead.
-    
+    mzAPI access to mzML files.  By default spectra are read straight from
+    the mzML, using the file's byte-offset index (or one built in a single
+    pass, for non-indexed mzML) to decode individual spectra on demand; this
+    makes opening a file fast and doesn't require any additional disk space.
+
+    Alternately, with cache = True, everything is loaded from the XML into a
+    SQLite database, which is a slow startup procedure but allows fast
+    random-access to the data without tremendous RAM usage; set workers to
+    spread the conversion over that many processes. For once-through
+    sequential processing, neither is the way to go- try the iterator
+    functions in multiplierz.mzML instead.
+
     The intermediary SQLite files can be saved for later use by calling
     the .save_cache() function; these files are fully portable between
     computers and mostly portable between software versions, and also
     slightly smaller than their source mzML.  (Usually larger than
     the source raw data, however.)
     """
-    
-    def __init__(self, data_file, *etc, **etcetc):
-        if data_file.lower().endswith('mzml'):
+
+    def __init__(self, data_file, cache = False, workers = 1, *etc, **etcetc):
+        self.data_file = data_file
+        self.workers = workers
+        self.file_type = 'mzml'
+        self.cachename = None
+        self._headers = None
+        self._xic_arrays = {}
+
+        lowername = data_file.lower()
+        if lowername.endswith('mzmlsql'):
+            print("Opening previously prepared SQLite file...")
+            self.reader = mzmlsql_reader(data_file)
+            self.cachename = data_file
+        elif (lowername.endswith('mzml') or lowername.endswith('mzml.gz')) and cache:
             flptr, flname = tempfile.mkstemp(suffix = '.mzmlsql')
-            #flptr.close()
+            os.close(flptr)
             print("Parsing mzML to SQLite... (this may take some time.)")
-            mzmlToSqlite(data_file, flname)
-            self.connection = sqlite.connect(flname)
-            self.cursor = self.connection.cursor()
+            mzmlToSqlite(data_file, flname, workers = workers)
+            self.reader = mzmlsql_reader(flname)
             self.cachename = flname
-        elif data_file.lower().endswith('mzmlsql'):
-            print("Opening previously prepared SQLite file...")
-            self.connection = sqlite.connect(data_file)
-            self.cursor = self.connection.cursor()
-            self.cachename = data_file
+        elif lowername.endswith('mzml') or lowername.endswith('mzml.gz'):
+            self.reader = mzmlIndexedReader(data_file)
         else:
-            raise NotImplementedError('%s is not a recognized file type for mzML reader!' % data_file)    
-    
+            raise NotImplementedError('%s is not a recognized file type for mzML reader!' % data_file)
+
     def save_cache(self, save_file):
-        self.connection.close()
-        os.move(self.cachename, save_file)
-        self.connection = sqlite.connect(save_file)
-        self.cursor = self.connection.cursor()
-        self.cachename = save_file
-        
-    
-    def scan_info(self, start_mz = None, stop_mz = None, start_rt = None, stop_rt = None):
-        if not any([start_mz, stop_mz, start_rt, stop_rt]):
-            self.cursor.execute('SELECT ind, mz, rt FROM spectra')
+        """
+        Saves the SQLite form of the data to save_file; if the mzML is being
+        read directly, the conversion is run at this point.
+        """
+        if self.cachename is None:
+            mzmlToSqlite(self.data_file, save_file, workers = self.workers)
         else:
-            self.cursor.execute('SELECT ind, mz, rt FROM spectra WHERE mz >= %s AND mz <= %s AND rt >= %s AND rt <= %s'
-                                % (start_mz, stop_mz, start_rt, stop_rt))
-        manifest = list(self.cursor.fetchall())
-        manifest = [(r, m, i, 'MS1' if not m else 'MS2', None) for i, m, r in manifest]
+            self.reader.close()
+            shutil.move(self.cachename, save_file)
+        self.reader = mzmlsql_reader(save_file)
+        self.cachename = save_file
+
+    def close(self):
+        self.reader.close()
+
+    def _scan_headers(self):
+        # (index, precursor m/z, time, level) for every spectrum, by index.
+        if self._headers is None:
+            self._headers = sorted(self.reader.scan_headers())
+        return self._headers
+
+    def scan_info(self, start_time = 0, stop_time = 999999, start_mz = 0, stop_mz = 99999):
+        """
+        Gets a list of [(time, mz, scan_name, scan_type, scan_mode)] in the
+        time and mz range provided.  MS1 scans are included regardless of
+        the mz range.
+        """
+        manifest = [(r, m, i, level, None) for i, m, r, level in self._scan_headers()
+                    if start_time <= r <= stop_time
+                    and (level == 'MS1' or start_mz <= m <= stop_mz)]
         return sorted(manifest)
-    
+
+    def headers(self):
+        return self.scan_info()
+
     def scan(self, scan_name, centroid = None):
         """
         Returns the scan with the specified index.  Set centroid to True for
         centroided data, or False for uncentroided data.
         """
-        self.cursor.execute('SELECT data FROM spectra WHERE ind=%s' % str(scan_name))
-        scandata = demarshal(self.cursor.fetchone()[0])
-        
+        scandata = self.reader.scan(scan_name)
+
         if centroid and not scandata['centroid']:
             raise NotImplementedError("Requires general centroiding function!")
         elif centroid == False and scandata['centroid']:
             warnings.warn("Non-centroid data requested but only centroided data available.", RuntimeWarning)
-        
+
         return scandata['spectrum']
-    
-    
+
+    def array_scan(self, scan_name, centroid = None):
+        scandata = self.reader.scan(scan_name, as_arrays = True)
+        if centroid and not scandata['centroid']:
+            raise NotImplementedError("Requires general centroiding function!")
+        return mzScan.from_arrays(scandata['mz array'], scandata['intensity array'],
+                                  scandata['time'], 'c' if scandata['centroid'] else 'p',
+                                  scandata['precursor'] or 0.0, scandata.get('charge') or 0)
+
     def scan_for_time(self, time, tolerance = 0.0001):
         # Float inprecision spoils the exact value of RT keys when they
         # get into Python scope, requiring the addition of a tolerance factor.
-        self.cursor.execute('SELECT ind, rt FROM spectra WHERE rt >= %s AND rt <= %s'
-                            % (time - (tolerance/2), time + (tolerance/2)))
-        return min(self.cursor.fetchall(), key = lambda x: abs(x[1] - time))[0]
-    
+        matches = [(i, r) for i, m, r, level in self._scan_headers()
+                   if abs(r - time) <= tolerance/2]
+        return min(matches, key = lambda x: abs(x[1] - time))[0]
+
     def time_for_scan(self, scan):
-        self.cursor.execute('SELECT rt FROM spectra WHERE ind=%s' % scan)
-        return self.cursor.fetchone()[0]
-    
+        headers = self._scan_headers()
+        position = bisect.bisect_left(headers, (scan,))
+        if position == len(headers) or headers[position][0] != scan:
+            raise IndexError("No scan %s in %s" % (scan, self.data_file))
+        return headers[position][2]
+
     def scan_time_from_scan_name(self, scan):
         return self.time_for_scan(scan)
-    
+
+    # Alias matching the RAW mzFile.
+    timeForScan = time_for_scan
+
     def scan_range(self):
-        self.cursor.execute('SELECT MAX(ind) FROM spectra')
-        topscan = self.cursor.fetchone()[0]
-        self.cursor.execute('SELECT MIN(ind) FROM spectra')
-        botscan = self.cursor.fetchone()[0]
-        return botscan, topscan
-    
+        headers = self._scan_headers()
+        return headers[0][0], headers[-1][0]
+
     def time_range(self):
-        self.cursor.execute('SELECT MAX(rt) FROM spectra')
-        toprt = self.cursor.fetchone()[0]
-        self.cursor.execute('SELECT MIN(rt) FROM spectra')
-        botrt = self.cursor.fetchone()[0]
-        return botrt, toprt
-    
-    
-    def xic(self, start_time = None, stop_time = None, start_mz = None, stop_mz = None):
-        if any([start_time, stop_time, start_mz, stop_mz]):
-            raise NotImplementedError("Uncertain how to deal with custom XICs from mzML data.")
-        else:
-            self.cursor.execute('SELECT data FROM chromato WHERE ind=0 AND startmz=0 AND stopmz=0 AND startrt=0 AND stopmz=0')
-            return demarshal(self.cursor.fetchone()[0])[1]
-        
\ No newline at end of file
+        times = [r for i, m, r, level in self._scan_headers()]
+        return min(times), max(times)
+
+
+    def _xic_ms1_scans(self):
+        return sorted((r, i) for i, m, r, level in self._scan_headers() if level == 'MS1')
+
+    def _xic_scan_arrays(self, scan):
+        # Kept for reuse, so that repeated XICs over the same scans cost
+        # only a pair of binary searches per scan.
+        arrays = self._xic_arrays.get(scan)
+        if arrays is None:
+            arrays = cumulative_scan(*self.reader.scan_arrays(scan))
+            self._xic_arrays[scan] = arrays
+        return arrays
+
+    def clear_xic_cache(self):
+        """
+        Discards the per-scan arrays kept to speed up repeated XIC calls.
+        """
+        self._xic_arrays = {}
+
+    def xic(self, start_time = None, stop_time = None, start_mz = None, stop_mz = None,
+            filter = None):
+        """
+        Generates the eXtracted Ion Chromatogram of the given time and mz
+        range, summing the MS1 intensities within the mz range for each scan.
+
+        With no range given, the file's total ion chromatogram is returned
+        if it has one.
+        """
+        if not any([start_time, stop_time, start_mz, stop_mz]):
+            try:
+                return self.reader.total_xic()[1]
+            except IOError:
+                pass # No stored TIC; compute it.
+
+        window = (start_time if start_time is not None else 0,
+                  stop_time if stop_time is not None else 999999,
+                  start_mz if start_mz is not None else 0,
+                  stop_mz if stop_mz is not None else 999999)
+        return self.xics([window])[0]
@@ -1,182 +1,371 @@
-from multiplierz.mzAPI import mzFile
-import sys
+from multiplierz.mzAPI import mzFile, ScanCache, scan_size
+from collections import deque
+from queue import Empty
+import traceback
 
+import numpy as np
 
+try:
+    from multiprocessing import shared_memory
+except ImportError: # Python < 3.8
+    shared_memory = None
 
-# Its not clear if sys.getsizeof() will work on mzScan objects or etc; careful!
 
 
+# A background reader for mzAPI files.  A worker process owns the mzFile and
+# answers calls made through the async_mzFile proxy; between calls, it reads
+# ahead along whatever access pattern has been declared with prefetch(), so
+# that by the time a scan is asked for it's usually already in memory.
+#
+# Results of scan(), xic() and the other read-only methods are kept in an LRU
+# cache.  Prefetched results are held apart from it until they're asked for,
+# so reading ahead can't push out data that's about to be used (and reading
+# a scan doesn't make it more recent than the scans still to come); the LRU
+# gets whatever of size_cap bytes they don't take up.  Prefetching stops when
+# unclaimed prefetched data fills half the cap.
+#
+# Large scans are passed back through a shared memory block rather than being
+# pickled through the result queue; the client copies the data out and
+# unlinks the block.
 
-# Substantial voodoo; the class stores cached data in the scope of a
-# multiprocess-threaded function; the function loops, responding to commands
-# or otherwise loading data unless it has hit the size cap (or exhausted
-# the data file of easily cachable things.)
 
-# For a proof-of-concept, at least, don't do the autonomous-data-intake;
-# getting results from calls and caching results from preorder commands is
-# enough.
-#
-# It may be tricky making those interleave properly; a call can wait while
-# preorders or whatever else retrieve data, but the next output on the queue
-# has to always be from the most recent command (we *presume* no ones going to
-# be silly enough to hand two copies of the main class to different threads.)
+CACHED_METHODS = set(['scan', 'lscan', 'rscan', 'xic', 'scan_info',
+                      'headers', 'filters', 'scan_range', 'time_range'])
+
 
+def callkey(method, args, kwargs):
+    return method, tuple(args), tuple(sorted(kwargs.items()))
 
-# The thread should only block on the command queue when there's nothing else
-# left for it to do!
+def _float_points(value):
+    # True for lists of all-float (mz, intensity, ...) points; those can go
+    # through a float array and back without changing.
+    if type(value) is not list or not value:
+        return False
+    point = value[0]
+    return (isinstance(point, tuple) and
+            all(isinstance(x, float) for x in point))
 
+def pack_result(value, shm_threshold):
+    """
+    Returns ('value', value), or for large arrays and scans, ('shm', (name,
+    shape, dtype, kind)) describing a shared memory block holding the data.
+    """
+    if shared_memory is None or shm_threshold is None:
+        return 'value', value
 
-def arghash(method, args):
-    """Argh!"""
-    foo, bar = args
-    bar = tuple((x, y) for x, y in list(bar.items()))
-    return hash((method, foo, bar))
+    if isinstance(value, np.ndarray):
+        array, kind = value, 'array'
+    elif _float_points(value) and scan_size(value) > shm_threshold:
+        try:
+            array, kind = np.array(value, dtype = float), 'list'
+        except ValueError: # Ragged.
+            return 'value', value
+    else:
+        return 'value', value
+    if array.nbytes <= shm_threshold or array.dtype.hasobject:
+        return 'value', value
 
-def async_mzFile_internal(datafile, size_cap, input, output):
+    block = shared_memory.SharedMemory(create = True, size = array.nbytes)
+    shared = np.ndarray(array.shape, dtype = array.dtype, buffer = block.buf)
+    shared[...] = array
+    del shared
+    name = block.name
+    block.close() # The client unlinks it once it's been read.
+    _untrack(block)
+    return 'shm', (name, array.shape, array.dtype.str, kind)
+
+def _untrack(block):
+    # The block outlives this process, and gets unlinked by the client; the
+    # worker's resource tracker would otherwise "clean it up" a second time.
     try:
-        from collections import deque
-        from Queue import Empty
-        
-        data = mzFile(datafile)
-        cacheRecord = deque()
-        cache = {}
-        commands = []
-        
-        while True:
-            if not commands:
-                commands = [input.get(block = True)]
-                
-            while True:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(block._name, 'shared_memory')
+    except (ImportError, AttributeError):
+        pass
+
+def unpack_result(form, value):
+    if form == 'value':
+        return value
+
+    name, shape, dtype, kind = value
+    block = shared_memory.SharedMemory(name = name)
+    try:
+        array = np.ndarray(shape, dtype = dtype, buffer = block.buf).copy()
+    finally:
+        block.close()
+        block.unlink()
+    if kind == 'list':
+        return [tuple(x) for x in array.tolist()]
+    return array
+
+
+def prefetch_plan(data, pattern, scans = None, start = None):
+    """
+    Lists the scans to read ahead for an access pattern: 'sequential' (all
+    scans, in order of time), 'MS1' (MS1 scans only, in order of time) or
+    'scans' (the given list of scans, in order.)  With start, the plan begins
+    at that scan.
+    """
+    if pattern == 'scans':
+        plan = list(scans)
+    elif pattern in ('sequential', 'MS1'):
+        plan = []
+        for time, mz, scanNum, scanLevel, scanMode in sorted(data.scan_info()):
+            if pattern == 'MS1' and scanLevel != 'MS1':
+                continue
+            # Same convention as the MGF extractor.
+            plan.append(scanNum if isinstance(scanNum, int) else time)
+    else:
+        raise ValueError("Prefetch pattern must be one of 'sequential', 'MS1' "
+                         "or 'scans'; got %s" % pattern)
+
+    if start is not None:
+        try:
+            plan = plan[plan.index(start):]
+        except ValueError:
+            pass
+    return plan
+
+
+def async_mzFile_internal(datafile, size_cap, shm_threshold, file_kwargs,
+                          commands, results):
+    try:
+        data = mzFile(datafile, **file_kwargs)
+    except Exception as err:
+        results.put((None, 'error', (err, traceback.format_exc())))
+        return
+    results.put((None, 'ready', None))
+
+    cache = ScanCache(size_cap)
+    prefetching = deque()
+    unclaimed = {} # Prefetched but not yet asked for; key -> (value, size).
+    unclaimed_size = 0
+
+    while True:
+        if prefetching and unclaimed_size < size_cap / 2:
+            try:
+                command = commands.get_nowait()
+            except Empty:
+                key = prefetching.popleft()
+                if key in cache or key in unclaimed:
+                    continue
+                method, args, kwargs = key
                 try:
-                    commands.append(input.get_nowait())
-                except Empty:
-                    break
-            
-            if any(x[0] == 'close' for x in commands):
-                break
-                
-            
-            call = next((x for x in commands if x[0] == 'call'), None)
-            if call:
-                commands.remove(call)
-
-                _, method, argkwarg = call
-                callhash = arghash(method, argkwarg)
-                if callhash in cache:
-                    output.put((call, cache[callhash]))
+                    value = getattr(data, method)(*args, **dict(kwargs))
+                except Exception:
+                    continue # Prefetches are only hints.
+                size = scan_size(value)
+                unclaimed[key] = value, size
+                unclaimed_size += size
+                cache.resize(max(size_cap - unclaimed_size, 0))
+                continue
+        else:
+            command = commands.get()
+
+        kind = command[0]
+        if kind == 'close':
+            break
+        elif kind == 'prefetch':
+            _, pattern, scans, start, scan_kwargs = command
+            try:
+                plan = prefetch_plan(data, pattern, scans, start)
+            except Exception:
+                continue
+            # A new pattern replaces the old one; what was read ahead for
+            # that becomes ordinary cache contents.
+            prefetching = deque(callkey('scan', (scan,), scan_kwargs) for scan in plan)
+            cache.resize(size_cap)
+            for key, (value, size) in unclaimed.items():
+                cache.put(key, value, size)
+            unclaimed, unclaimed_size = {}, 0
+        elif kind == 'preorder':
+            _, method, args, kwargs = command
+            prefetching.append(callkey(method, args, kwargs))
+        elif kind == 'stats':
+            stats = cache.stats()
+            stats['prefetch_queued'] = len(prefetching)
+            stats['prefetch_unclaimed'] = len(unclaimed)
+            stats['prefetch_unclaimed_bytes'] = unclaimed_size
+            results.put((command[1], 'value', stats))
+        elif kind == 'clear':
+            cache.clear()
+            cache.resize(size_cap)
+            prefetching.clear()
+            unclaimed, unclaimed_size = {}, 0
+        elif kind == 'call':
+            _, callid, method, args, kwargs = command
+            try:
+                key = None
+                if method in CACHED_METHODS:
+                    key = callkey(method, args, kwargs)
+                    if key in unclaimed:
+                        value, size = unclaimed.pop(key)
+                        unclaimed_size -= size
+                        cache.resize(max(size_cap - unclaimed_size, 0))
+                        cache.put(key, value, size)
+                        cache.hits += 1
+                    else:
+                        value = cache.get(key)
+                    if value is None:
+                        value = getattr(data, method)(*args, **kwargs)
+                        cache.put(key, value)
                 else:
-                    args, kwargs = argkwarg
-                    returnval = getattr(data, method)(*args, **kwargs)
-                    cache[callhash] = returnval
-                    output.put((call, returnval))
-            
-            else:
-                assert commands
-                com = commands[0]
-                _, method, argkwarg = com
-                callhash = arghash(method, argkwarg)
-                commands = commands[1:]
-                if callhash in cache:
-                    continue
-                args, kwargs = argkwarg
-                returnval = getattr(data, method)(*args, **kwargs)
-                cache[callhash] = returnval
-        
-        return
-    except Exception as err:
-        import traceback
-        traceback.print_exc()
-        print('------------------')
-        raise err        
-            
-            
-        
-        
+                    value = getattr(data, method)(*args, **kwargs)
+                results.put((callid,) + pack_result(value, shm_threshold))
+            except Exception as err:
+                results.put((callid, 'error', (err, traceback.format_exc())))
+        else:
+            raise ValueError("Unknown command %s" % str(command))
+
+    data.close()
+
 
 class async_mzFile(object):
-    def __init__(self, filename, size_cap = 1000 * 1000 * 1000):
+    """
+    mzFile proxy whose data is read by a background process.
+
+    Method calls are forwarded to an mzFile in the worker process, and
+    behave the same as they would on the mzFile itself.  Between calls the
+    worker reads ahead along the pattern given to prefetch(), and results
+    are cached (least-recently-used, up to size_cap bytes) so that repeated
+    calls are answered from memory.
+
+    Example:
+    >>> data = async_mzFile('example_file.raw')
+    >>> data.prefetch('MS1', centroid = True)
+    >>> for time, mz, scanNum, level, mode in data.scan_info():
+    ...     if level == 'MS1':
+    ...         scan = data.scan(scanNum, centroid = True)
+    >>> data.close()
+    """
+
+    def __init__(self, filename, size_cap = 1000 * 1000 * 1000,
+                 shm_threshold = 64 * 1024, **kwargs):
         import multiprocessing
-        
+
         self.data_file = filename
-        
+        self.size_cap = size_cap
+        self.callcount = 0
+
         self.commands = multiprocessing.Queue()
         self.results = multiprocessing.Queue()
-        
+
         self.source = multiprocessing.Process(target = async_mzFile_internal,
-                                              args = (filename, size_cap,
-                                                      self.commands, self.results))
+                                              args = (filename, size_cap, shm_threshold,
+                                                      kwargs, self.commands, self.results))
+        self.source.daemon = True
         self.source.start()
-        
-        
-    def proxycall(self, method, *args, **kwargs):
+
+        callid, form, value = self._result()
+        if form == 'error':
+            self.source.join()
+            err, trace = value
+            raise IOError("Could not open %s:\n%s" % (filename, trace))
+
+    def _result(self):
+        # Polls, rather than blocking outright, so that a crashed worker
+        # is reported instead of hanging.
+        while True:
+            try:
+                return self.results.get(timeout = 1)
+            except Empty:
+                if not self.source.is_alive():
+                    raise IOError("Data retrieval process for %s exited (code %s)."
+                                  % (self.data_file, self.source.exitcode))
+
+    def _check(self):
         if not self.source.is_alive():
-            err, returnval = self.source.get()
-            print("Data retrieval thread crashed with the following error:\n\n")
-            print(returnval)
-            raise err
-            
-        
-        allargs = args, kwargs
-        
-        self.commands.put(('call', method, allargs))
-        
-        foo = self.results.get()
-        command, returnval = foo
-        assert command == ('call', method, allargs)
-        
-        return returnval
-    
+            raise IOError("Data retrieval process for %s exited (code %s)."
+                          % (self.data_file, self.source.exitcode))
+
+    def proxycall(self, method, *args, **kwargs):
+        self._check()
+        self.callcount += 1
+        self.commands.put(('call', self.callcount, method, args, kwargs))
+
+        callid, form, value = self._result()
+        assert callid == self.callcount, "Out-of-order result from data retrieval process."
+        if form == 'error':
+            raise value[0]
+        return unpack_result(form, value)
+
+    def prefetch(self, pattern = 'sequential', scans = None, start = None, **scan_kwargs):
+        """
+        Declares the order scans are going to be read in, so that the
+        worker can read ahead.  pattern is 'sequential' (every scan, by
+        time), 'MS1' (only MS1 scans, by time) or 'scans' (the scan names
+        given in scans, in order); start skips ahead to the given scan.
+        scan_kwargs are passed to each scan() call, and must match those of
+        the later calls for the prefetched scans to be used (e.g.,
+        centroid = True.)
+        """
+        if scans is not None and pattern == 'sequential':
+            pattern = 'scans'
+        self._check()
+        self.commands.put(('prefetch', pattern,
+                           list(scans) if scans is not None else None,
+                           start, scan_kwargs))
+
     def preorder(self, method, *args, **kwargs):
-        if not self.source.is_alive():
-            err, returnval = self.source.get()
-            print("Data retrieval thread crashed with the following error:\n\n")
-            print(returnval)
-            raise err        
-        
-        allargs = args, kwargs
-        
-        self.commands.put(('preorder', method, allargs))
-        #ack = self.results.get()
-        #assert ack == (method, allargs)
-        
+        """
+        Requests that the given call be run in the background, so that a
+        later identical call returns immediately.
+        """
+        self._check()
+        self.commands.put(('preorder', method, args, kwargs))
+
+    def cache_stats(self):
+        """
+        Returns the worker's cache hits, misses, evictions, etc.
+        """
+        self._check()
+        self.callcount += 1
+        self.commands.put(('stats', self.callcount))
+        return self._result()[2]
+
+    def clear_cache(self):
+        self._check()
+        self.commands.put(('clear',))
+
     def __getattr__(self, method):
-        # Non-method attributes may be problematic.
-        
-        #if not self.check_method(method):
-            #raise NotImplementedError, "Only method attributes are represented in async_mzFile objects!"
-        
+        # Non-method attributes of the mzFile are not accessible.
+        if method.startswith('__'):
+            raise AttributeError(method)
         def proxymethod(*args, **kwargs):
             return self.proxycall(method, *args, **kwargs)
         return proxymethod
-    
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def close(self):
-        self.commands.put(('close', None, None))
-        #self.source.wait()
+        if self.source.is_alive():
+            self.commands.put(('close',))
         self.source.join()
-        
+
     def __del__(self):
-        if self.source.is_alive():
+        source = self.__dict__.get('source')
+        if source is not None and source.is_alive():
             self.close()
-        
-        
-        
-        
-        
-        
-        
-        
+
+
+
+
 if __name__ == '__main__':
     from multiplierz.mzAPI.mzMemo import async_mzFile
-    from time import clock, sleep
+    from time import perf_counter, sleep
     foo = async_mzFile('example_file.raw')
-    start = clock()
-    foo.preorder('xic', 0, 999999)
-    print((clock() - start))
-    
+    foo.prefetch('MS1', centroid = True)
+
     sleep(3)
-    start = clock()
-    bar = foo.xic(0, 999999)
-    print((clock() - start))
-    
-    foo.close()
\ No newline at end of file
+    start = perf_counter()
+    for time, mz, scanNum, level, mode in foo.scan_info():
+        if level == 'MS1':
+            foo.scan(scanNum, centroid = True)
+    print((perf_counter() - start))
+    print(foo.cache_stats())
+
+    foo.close()
@@ -1,7 +1,7 @@
 import os
 from collections import defaultdict
 import warnings
-from multiplierz.mzAPI import mzScan, mzFile as mzAPImzFile
+from multiplierz.mzAPI import mzScan, mzFile as mzAPImzFile, cumulative_scan
 from multiplierz.internalAlgorithms import centroid as centroid_func
 from multiplierz.internalAlgorithms import (ProximityIndexedSequence, select)
 
@@ -326,6 +326,12 @@ class mzFile_explicit_numbering(mzAPImzFile):
         xic = list(zip(*self.source.XicByExp(sample-1, experiment-1, float(start_mz), float(stop_mz))))
         return [x for x in xic if start_time <= x[0] <= stop_time]
     
+    def _xic_scan_arrays(self, scan):
+        # scan_info() scan names are (cycle, experiment, sample) triples.
+        cycle, experiment, sample = scan
+        peaks = self.scan(cycle, experiment, sample)
+        return cumulative_scan([x[0] for x in peaks], [x[1] for x in peaks])
+    
     def tic(self, start_time = None, stop_time = None, sample = None, experiment = None):
         """
         Get the Total Ion Chromatogram of the given time range in the given sample
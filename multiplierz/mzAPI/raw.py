@@ -2,6 +2,8 @@ import clr
 import sys, os
 import numpy as np
 
+from multiplierz.mzAPI import mzFile as baseFile, mzScan
+
 dll_path = 'rawdlls'
 dlls = ['ThermoFisher.CommonCore.Data',
         'ThermoFisher.CommonCore.RawFileReader',
@@ -30,13 +32,16 @@ from ThermoFisher.CommonCore.RawFileReader import RawFileReaderAdapter
 
 from ThermoFisher.CommonCore.Data import Extensions 
 
+# Most windows traced in one GetChromatogramData call by xics().
+XICS_BATCH_SIZE = 64
+
 def besttype(x):
     try:
         return float(x)
     except ValueError:
         return x
 
-class mzFile(object):
+class mzFile(baseFile):
     def __init__(self, filename, *etc, **etcetc):
         self.source = RawFileReaderAdapter.FileFactory(filename)
         if self.source.InstrumentCount > 1:
@@ -132,6 +137,20 @@ class mzFile(object):
             if not mzIntsReturnOnly: return list(zip(scan.Positions, scan.Intensities))
             else: return np.array(list(scan.Positions)), np.array(list(scan.Intensities))
         
+    def array_scan(self, scannum, centroid = False, mzIntsReturnOnly = False):
+        # Centroid streams carry noise and charge values, which are kept.
+        if centroid:
+            stream = self.source.GetCentroidStream(scannum, False)
+            if stream.Masses is not None and stream.Intensities is not None:
+                return mzScan.from_arrays(np.array(list(stream.Masses)),
+                                          np.array(list(stream.Intensities)),
+                                          self.source.RetentionTimeFromScanNumber(scannum), 'c',
+                                          noise = np.array(list(stream.Noises)),
+                                          charge = np.array(list(stream.Charges)))
+        mzs, ints = self.scan(scannum, centroid = centroid, mzIntsReturnOnly = True)
+        return mzScan.from_arrays(mzs, ints, self.source.RetentionTimeFromScanNumber(scannum),
+                                  'c' if centroid else 'p')
+    
     def lscan(self, scannum):
         stream = self.source.GetCentroidStream(scannum, False)
         return list(zip(stream.Masses, stream.Intensities, 
@@ -176,6 +195,46 @@ class mzFile(object):
         xic_trace = ChromatogramSignal.FromChromatogramData(xic_data)[0]
         return list(zip(xic_trace.Times, xic_trace.Intensities))
     
+    def xics(self, windows, filter = 'Full ms'):
+        # RawFileReader can trace any number of m/z ranges in one call, over
+        # one scan range.  Windows are grouped by overlapping scan ranges
+        # (at most XICS_BATCH_SIZE to a group), so each call only reads the
+        # span its own group covers; traces are then trimmed back to each
+        # window's range.  This keeps memory to about the size of the
+        # results, rather than every window times the whole run.
+        if not len(windows):
+            return []
+        scan_bounds = [(self.scan_from_time(start_time), self.scan_from_time(stop_time))
+                       for start_time, stop_time, _, _ in windows]
+        order = sorted(range(len(windows)), key = lambda i: scan_bounds[i])
+        
+        groups = []
+        group_stop = None
+        for i in order:
+            start_scan, stop_scan = scan_bounds[i]
+            if (group_stop is None or start_scan > group_stop
+                or len(groups[-1]) >= XICS_BATCH_SIZE):
+                groups.append([])
+                group_stop = stop_scan
+            groups[-1].append(i)
+            group_stop = max(group_stop, stop_scan)
+        
+        results = [None] * len(windows)
+        for group in groups:
+            settings = [ChromatogramTraceSettings(filter, [Range.Create(windows[i][2],
+                                                                        windows[i][3])])
+                        for i in group]
+            xic_data = self.source.GetChromatogramData(settings,
+                                                       min(scan_bounds[i][0] for i in group),
+                                                       max(scan_bounds[i][1] for i in group))
+            xic_traces = ChromatogramSignal.FromChromatogramData(xic_data)
+            for i, trace in zip(group, xic_traces):
+                start_scan, stop_scan = scan_bounds[i]
+                results[i] = [(t, inten) for t, inten, s
+                              in zip(trace.Times, trace.Intensities, trace.Scans)
+                              if start_scan <= s <= stop_scan]
+        return results
+    
     def extra_info(self, scan):
         trailer = self.source.GetTrailerExtraInformation(scan)
         # Labels come with trailing ':'s that are annoying; those are removed.
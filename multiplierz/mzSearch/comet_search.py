@@ -327,7 +327,7 @@ def mgf_to_ms2(mgfFile, outputfile = None):
     if not outputfile:
         outputfile = mgfFile[:-4]+'.ms2'
     
-    mgf = parse_mgf(mgfFile, header = False)
+    mgf = parse_mgf(mgfFile, header = False, arrays = True)
     ms2 = MS2Writer(outputfile, date = time.localtime(),
                     extractor = 'Converted from MGF by Multiplierz',
                     extractorVersion = __version__,
@@ -5,14 +5,22 @@ import time
 import multiplierz.mzReport as mzReport
 import os
 import pickle
+import sqlite3
 import re
 from multiplierz.internalAlgorithms import (ProximityIndexedSequence, inPPM, average, 
                                             pts_to_bins, select)
 from multiplierz import vprint, verbose_mode
 
-from multiplierz.mzTools.featureUtilities import save_feature_database, FeatureInterface
+from multiplierz.mzTools.featureUtilities import (save_feature_database, FeatureInterface,
+                                                  FeatureIndex, write_feature_tables,
+                                                  open_detection_checkpoint, checkpointed_scans,
+                                                  save_scan_isotopes, load_scan_isotopes,
+                                                  detection_setting, set_detection_setting,
+                                                  has_feature_tables, has_detection_checkpoint,
+                                                  drop_detection_checkpoint, DETECTION_SCAN_COLUMNS)
 from multiplierz.internalAlgorithms import peak_pick_PPM
 import multiprocessing
+from multiplierz.scan_transport import ScanRing, scan_columns
 
 from multiplierz.mgf import standard_title_parse
 
@@ -22,7 +30,7 @@ except ImportError:
     kurtosis = lambda x: 'NA'
     skew = lambda x: 'NA'
 
-__all__ = ['feature_analysis', 'detect_features']
+__all__ = ['feature_analysis', 'detect_features', 'merge_feature_files']
 
 # These (and the spectrumDescriptionTo... functions) will be modified when invoked by the GUI.
 signalToNoiseThreshold = 15
@@ -167,6 +175,51 @@ class Feature():
             return '; '.join(edge)
         else:
             return ""
+
+
+class StoredFeature(Feature):
+    """
+    A Feature read from a version 2 feature database (see
+    featureUtilities.save_feature_database.)  Its bounds, intensity and
+    shape statistics are loaded with it; its envelope points (regions and
+    scans) are only read from the database when first used, by calling
+    loader(index).
+    """
+    def __init__(self, row, loader):
+        Feature.__init__(self)
+        (self.index, self.mz, self.charge, startscan, endscan,
+         self.starttime, self.endtime, self.intensity,
+         self.skewness, self.kurtosis, wasSplit) = row
+        self.scanrange = startscan, endscan
+        self.wasSplit = bool(wasSplit)
+        self._regions = None
+        self._loader = loader
+    
+    def _load(self):
+        if self._regions is None:
+            self._regions = self._loader(self.index)
+        return self._regions
+    
+    @property
+    def regions(self):
+        return self._load()
+    @regions.setter
+    def regions(self, value):
+        self._regions = value
+    
+    @property
+    def scans(self):
+        return [scan for scan, _ in self._load()]
+    
+    def c12Intensity(self):
+        return self.intensity
+    
+    def __getstate__(self):
+        # Pickles as a complete feature, without the database connection.
+        self._load()
+        state = self.__dict__.copy()
+        state['_loader'] = None
+        return state
       
       
       
@@ -267,6 +320,8 @@ def binByFullFeature(datafile, featureDB, results):
     featureItems = defaultdict(list)
     edgeItems = defaultdict(list)
     inexplicableItems = []
+    
+    points = []
     for result in results:
         #mz = spectrumDescriptionToMZ(result['Spectrum Description'])
         #scan = spectrumDescriptionToScanNumber(result['Spectrum Description']) 
@@ -277,29 +332,30 @@ def binByFullFeature(datafile, featureDB, results):
             scan = ms2toms1[scan]
         except:
             continue
+        points.append((result, mz, scan, charge))
+    
+    # All PSMs are matched to the features at once; each goes to the
+    # nearest feature containing it, or failing that to the nearest one
+    # it borders.
+    if not isinstance(featureDB, FeatureIndex):
+        featureDB = FeatureIndex(featureDB)
+    matches = featureDB.assign([x[1] for x in points], [x[2] for x in points],
+                               [x[3] for x in points], width = 0.01, border_width = 1)
+    
+    for (result, _, _, _), match in zip(points, matches):
+        if match is None:
+            inexplicableItems.append(result)
+            continue
         
-        features = [(i, x) for i, x in featureDB.mz_range(mz - 0.01, mz + 0.01)
-                    if x.containsPoint(mz, scan, charge)]
-        if features:
-            index, feature = min(features, key = lambda x: abs(x[1].mz - mz))
-            scans = min(feature.scans), max(feature.scans)
-            intensity = feature.c12Intensity()
-            kurtosis = feature.kurtosis
-            skew = feature.skewness
+        index, feature, edge = match
+        scans = min(feature.scans), max(feature.scans)
+        intensity = feature.c12Intensity()
+        kurtosis = feature.kurtosis
+        skew = feature.skewness
+        if edge is None:
             featureItems[index].append((result, scans, intensity, kurtosis, skew))
         else:
-            features = [(i, x) for i, x in featureDB.mz_range(mz - 1, mz + 1)
-                        if x.bordersPoint(mz, scan, charge)]
-            if features:
-                index, feature = min(features, key = lambda x: abs(x[1].mz - mz))
-                edge = feature.bordersPoint(mz, scan, charge)
-                scans = min(feature.scans), max(feature.scans)
-                intensity = feature.c12Intensity()
-                kurtosis = feature.kurtosis
-                skew = feature.skewness                
-                edgeItems[index].append((result, edge, scans, intensity, kurtosis, skew))
-            else:
-                inexplicableItems.append(result)
+            edgeItems[index].append((result, edge, scans, intensity, kurtosis, skew))
                 
         
         
@@ -458,127 +514,235 @@ def feature_analysis(datafile, resultFiles,
 
 
 
-def dataReaderProc(datafile, que, scanNumbers):
+def dataReaderProc(datafile, ring, scanNumbers):
     try:
         data = mzFile(datafile)
         
         for scanNum in scanNumbers:
             scan = data.scan(scanNum, centroid = True)
-            que.put((scanNum, scan), block = True)
+            ring.send(scanNum, *scan_columns(scan))
     
-        que.put('done')
+        ring.finish()
         data.close()
     except Exception as err:
         import traceback
         print("READ THREAD ERROR.")
         traceback.print_exc()
         print('------------------')
+        ring.fail()
         raise err
 
-    
 
+PEAK_PICK_CHUNK_SCANS = 50
 
-    
-    
-def detect_features(datafile, **constants):
+def _init_peak_pick_worker(datafile):
+    global _worker_data
+    _worker_data = mzFile(datafile)
+
+def _peak_pick_chunk(task):
+    scanNumbers, peak_pick_params = task
+    isotopeData = []
+    for scanNum in scanNumbers:
+        mzs, ints = scan_columns(_worker_data.scan(scanNum, centroid = True))
+        scan = list(zip(mzs.tolist(), ints.tolist()))
+        isotopeData.append((scanNum, peak_pick_PPM(scan, **peak_pick_params)[0]))
+    return isotopeData
+
+def pick_isotopes(datafile, scanNumbers, peak_pick_params, processes = 1,
+                  chunk_scans = PEAK_PICK_CHUNK_SCANS):
     """
-    Runs the feature detection algorithm on the target data file (currently,
-    only Thermo .RAW is supported.)  Returns the path to the feature data
-    file.
+    Yields (scan number, isotopic envelopes by charge) for each of the given
+    scans, in order.  With processes > 1 the scans are read and peak-picked
+    by a pool of that many processes, chunk_scans scans at a time; otherwise
+    a single reader process feeds peak picking in this one.
+    """
+    if processes > 1:
+        chunks = [(scanNumbers[i:i+chunk_scans], peak_pick_params)
+                  for i in range(0, len(scanNumbers), chunk_scans)]
+        pool = multiprocessing.Pool(processes, initializer = _init_peak_pick_worker,
+                                    initargs = (datafile,))
+        try:
+            for isotopeData in pool.imap(_peak_pick_chunk, chunks):
+                for scanData in isotopeData:
+                    yield scanData
+        finally:
+            pool.terminate()
+        return
     
-    Optional arguments:
-    - tolerance (default 10): MZ tolerance in parts-per-million for all determinations
-    of peak identity.  Should usually correspond to the mass precision of the
-    source instrument.
-    - force (default False): If True, feature detection is run even if a
-    feature data file already exists for the target data.
+    ring = ScanRing(slot_count = 20)
+    reader = multiprocessing.Process(target = dataReaderProc,
+                                     args = (datafile, ring, scanNumbers))
+    reader.start()
+    try:
+        for scanNum, (mzs, ints) in ring.scans([reader]):
+            scan = list(zip(mzs.tolist(), ints.tolist()))
+            yield scanNum, peak_pick_PPM(scan, **peak_pick_params)[0]
+    except BaseException:
+        # Including GeneratorExit; the reader would otherwise wait forever
+        # for ring slots to free up.
+        reader.terminate()
+        raise
+    finally:
+        reader.join()
+        ring.close()
+
+
+def trace_features(candidates, seeds, scanRTs, tolerance, dropoutTimeTolerance):
     """
+    Assembles features from isotopic envelopes.  candidates is a list of
+    (envelope, scan index, charge) for every envelope; seeds is a list of
+    (envelope, scan index, charge, rank) of those that may start a feature,
+    in order of increasing priority (they're taken from the end.)  scanRTs
+    gives the retention time of each scan index.
     
+    Returns a list of (rank, charge, [[scan index, envelope], ...]) for each
+    feature found, in the order they were found.
+    """
+    isotopesByChargePoint = defaultdict(lambda: defaultdict(lambda: ProximityIndexedSequence([], lambda x: x[0][0])))
+    for isoSeq, scanIndex, charge in candidates:
+        isotopesByChargePoint[charge][scanIndex].add(isoSeq)
     
-    if 'outputfile' in constants:
-        featurefile = constants['outputfile']
-    else:
-        featurefile = datafile + '.features'
+    seenIsotopes = set()
+    # Can assume isotopic sequences are unique because floats.
+    # (But it may not be a valid assumption, because detectors
+    # and floating point approximations!)
     
-    if 'tolerance' in constants and constants['tolerance']:
-        global tolerance
-        tolerance = constants['tolerance']
-        if tolerance < 1:
-            print("\n\n\nWARNING- tolerance value for SILAC analysis should now be in PPM!\n\n\n")
-    else:
-        tolerance = 10
-        
-    if 'partial' in constants:
-        # This is primarily for testing purposes only.
-        scanrange = constants['partial']
-    else:
-        scanrange = None
+    seeds = list(seeds)
+    featureList = []
+    while seeds:
+        highIso, highScan, highChg, rank = seeds.pop()
+        if tuple(highIso) in seenIsotopes:
+            continue
         
-    if 'force' in constants:
-        force = constants['force']
-    else:
-        force = False
+        centerIndex, (centerMZ, _) = max(enumerate(highIso), 
+                                         key = lambda x: x[1][1])
         
-    if 'whitelist_psms' in constants:
-        whitelist_mzs = constants['whitelist_psms']
-        featurefile = datafile + '.partial%s.features' % (str(hash(frozenset(whitelist_mzs)))[:5])
-    else:
-        whitelist_mzs = None
+        newFeature = [[highScan, highIso]]
+        # Trailing the feature backwards, then forwards.
+        for step in (-1, 1):
+            curScan = highScan
+            continuing = True
+            lastSeen = scanRTs[curScan]
+            while continuing:
+                curScan += step
+                if not 0 <= curScan < len(scanRTs):
+                    break
+                curRT = scanRTs[curScan]
+                
+                scanSeqs = isotopesByChargePoint[highChg][curScan].returnRange(centerMZ - 2, centerMZ + 1.5)
+                scanSeqs.sort(key = lambda x: x[centerIndex][1], reverse = True)
+                
+                found = False
+                for iso in scanSeqs: # These are known to have centerMZ in common.
+                    # The indexes between iso and highIso may not be equivalent
+                    # if there's sub-C12 peak(s) in either.  For a first draft
+                    # this can be considered a feature, since C12s should be
+                    # consistent throughout features, but in some cases like
+                    # single-scan-dropouts of the C12 this is insufficient
+                    # and such discrepancies should be accounted for.
+                    
+                    if (inPPM(tolerance, iso[0][0], highIso[0][0])
+                        and inPPM(tolerance, iso[1][0], highIso[1][0])
+                        and tuple(iso) not in seenIsotopes):
+                        newFeature.append([curScan, iso])
+                        found = True
+                        break # From "for iso in scanSeqs"                    
+                
+                if found:
+                    lastSeen = curRT
+                elif abs(curRT - lastSeen) > dropoutTimeTolerance:
+                    continuing = False
+
+        if len(newFeature) > 1:
+            featureList.append((rank, highChg, newFeature))
         
-    if 'peak_picking_params' in constants:
-        peak_pick_params = constants['peak_picking_params']
-    elif 'tolerance' in constants and constants['tolerance']:
-        peak_pick_params = {'tolerance':constants['tolerance']}
-    else:
-        peak_pick_params = {'tolerance' : 10}
-    
-    if os.path.exists(featurefile) and not force:
-        vprint("Feature data file already exists: %s" % featurefile)
-        return featurefile
+        for _, iso in newFeature:
+            seenIsotopes.add(tuple(iso))
     
-    setGlobals(constants)
+    return featureList
 
+def isotope_bands(candidates, tolerance, bands):
+    """
+    Splits the indices of candidates (as for trace_features) into at most
+    bands groups, each a run of m/z values cut only at gaps between
+    consecutive envelope C12 m/zs too wide for any two envelopes across the
+    gap to be matched at the given PPM tolerance.  trace_features on each
+    band therefore finds exactly the features it would on the whole set.
+    """
+    order = sorted(range(len(candidates)), key = lambda i: candidates[i][0][0][0])
+    components = []
+    previous = None
+    for i in order:
+        mz = candidates[i][0][0][0]
+        # Twice the tolerance, so that no envelope on either side is within
+        # tolerance of one on the other, with room for rounding.
+        if previous is None or mz - previous > 2 * (mz / 1000000.0) * tolerance:
+            components.append([])
+        components[-1].append(i)
+        previous = mz
     
-    times = []
-    times.append(time.clock())
-    data = mzFile(datafile)
-    
-    times.append(time.clock())
-    vprint("Opened data file; getting isotopes...")
+    target = max(len(candidates) // max(bands, 1), 1)
+    groups = [[]]
+    for component in components:
+        if len(groups[-1]) >= target and len(groups) < bands:
+            groups.append([])
+        groups[-1] += component
+    return [sorted(group) for group in groups if group]
 
-    scaninfo = [x for x in data.scan_info(0, 99999999) if x[3] == 'MS1']
-    rtLookup = dict([(x[2], x[0]) for x in scaninfo])
-    scaninfo = [x[2] for x in scaninfo]
-    
-    if scanrange:
-        scaninfo = [x for x in scaninfo if scanrange[0] < x < scanrange[1]]
+def _trace_band(task):
+    return trace_features(*task)
 
-    data.close()
+def trace_features_parallel(candidates, seeds, scanRTs, tolerance,
+                            dropoutTimeTolerance, processes):
+    """
+    Equivalent to trace_features, with the envelopes split into m/z bands
+    (see isotope_bands) that are traced by a pool of processes; features
+    are merged back into the order the serial version would find them.
+    Here each seed's last element is its index in candidates, and the
+    returned ranks are positions in seeds.
+    """
+    bands = isotope_bands(candidates, tolerance, processes * 4)
+    if len(bands) < 2:
+        seeds = [(isoSeq, scanIndex, charge, position) for position, (isoSeq, scanIndex, charge, _)
+                 in enumerate(seeds)]
+        return trace_features(candidates, seeds, scanRTs, tolerance, dropoutTimeTolerance)
     
-    que = multiprocessing.Queue(maxsize = 20)
-    reader = multiprocessing.Process(target = dataReaderProc,
-                                     args = (datafile, que, scaninfo))
-    reader.start()
+    bandOf = {}
+    for band, indices in enumerate(bands):
+        for i in indices:
+            bandOf[i] = band
+    # Seeds are ranked by their position in the full list.
+    bandSeeds = [[] for _ in bands]
+    for position, (isoSeq, scanIndex, charge, index) in enumerate(seeds):
+        bandSeeds[bandOf[index]].append((isoSeq, scanIndex, charge, position))
     
-    isotopeData = deque()
-    thing = que.get(block = True)
-    bar = 0
-    while thing != 'done':
-        scanNum, scan = thing
-        foo = time.clock()
-        isotopeData.append((scanNum, peak_pick_PPM(scan, **peak_pick_params)[0]))
-        bar += time.clock() - foo
-        
-        thing = que.get(block = True)
-        
-        if verbose_mode and len(isotopeData) % 100 == 0:
-            print((len(isotopeData))) # Shielded by explicit verbose_mode check.
+    tasks = [([candidates[i] for i in indices], bandSeeds[band], scanRTs,
+              tolerance, dropoutTimeTolerance)
+             for band, indices in enumerate(bands)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        featureList = sum(pool.map(_trace_band, tasks), [])
+    finally:
+        pool.terminate()
     
-    reader.join()
-    # Could just discard the un-feature'd peaks immediately.
-    vprint("Isotopic features acquired; finding features over time...")
+    # Seeds are taken from the end of the list, so the serial version
+    # finds features in descending order of rank.
+    featureList.sort(key = lambda x: x[0], reverse = True)
+    return featureList
+
+
 
-    times.append(time.clock())
+    
+DETECTION_CHECKPOINT_SCANS = 100
+
+def _features_from_isotopes(isotopeData, tolerance, whitelist_mzs = None, processes = 1):
+    """
+    Traces features through isotopeData, a list of (scan number, retention
+    time, isotopic envelopes by charge) for each MS1 scan in order of time;
+    returns the list of Feature objects.
+    """
+    scaninfo = [scanNum for scanNum, _, _ in isotopeData]
+    rtLookup = dict((scanNum, rt) for scanNum, rt, _ in isotopeData)
 
     ms1ToIndex = {}
     indexToMS1 = {}
@@ -586,22 +750,15 @@ def detect_features(datafile, **constants):
         ms1ToIndex[scanNum] = index
         indexToMS1[index] = scanNum
 
-            
-    isotopesByChargePoint = defaultdict(lambda: defaultdict(lambda: ProximityIndexedSequence([], lambda x: x[0][0])))
-    allIsotopes = []
-    for scanNum, isotopesByCharge in isotopeData:
+    candidates = []
+    for scanNum, _, isotopesByCharge in isotopeData:
         scanIndex = ms1ToIndex[scanNum]
         for charge, isotopes in list(isotopesByCharge.items()):
             for isoSeq in isotopes:
-                isotopesByChargePoint[charge][scanIndex].add(isoSeq)
-                allIsotopes.append((isoSeq, scanIndex, charge))
+                candidates.append((isoSeq, scanIndex, charge))
     
-    del isotopeData
-
-    for scanlookup in list(isotopesByChargePoint.values()):
-        for proxseq in list(scanlookup.values()):
-            proxseq.rebalance()
-            
+    # Each with its index in candidates.
+    allIsotopes = [iso + (i,) for i, iso in enumerate(candidates)]
 
     if whitelist_mzs:
         vprint("Screening out irrelevant MZs; starting with %s..." % len(allIsotopes))
@@ -624,98 +781,14 @@ def detect_features(datafile, **constants):
     
     allIsotopes.sort(key = lambda x: x[0][0][1])
     
-
-    
-    times.append(time.clock())    
-    
-    seenIsotopes = set()
-    # Can assume isotopic sequences are unique because floats.
-    # (But it may not be a valid assumption, because detectors
-    # and floating point approximations!)
-    
-    featureList = []
-    while allIsotopes:
-        highIso, highScan, highChg = allIsotopes.pop()
-        if tuple(highIso) in seenIsotopes:
-            continue
-        
-        centerIndex, (centerMZ, _) = max(enumerate(highIso), 
-                                         key = lambda x: x[1][1])
-        
-        newFeature = [[highScan, highIso]]
-        curScan = highScan
-        continuing = True
-        lastSeen = rtLookup[indexToMS1[curScan]]
-        while continuing: # Trailing the feature backwards.
-            curScan -= 1
-            try:
-                curRT = rtLookup[indexToMS1[curScan]]
-            except KeyError:
-                assert curScan < max(indexToMS1.keys())
-                break
-            
-            
-            scanSeqs = isotopesByChargePoint[highChg][curScan].returnRange(centerMZ - 2, centerMZ + 1.5)
-            scanSeqs.sort(key = lambda x: x[centerIndex][1], reverse = True)
-            
-            found = False
-            for iso in scanSeqs: # These are known to have centerMZ in common.
-                # The indexes between iso and highIso may not be equivalent
-                # if there's sub-C12 peak(s) in either.  For a first draft
-                # this can be considered a feature, since C12s should be
-                # consistent throughout features, but in some cases like
-                # single-scan-dropouts of the C12 this is insufficient
-                # and such discrepancies should be accounted for.
-                
-                if (inPPM(tolerance, iso[0][0], highIso[0][0])
-                    and inPPM(tolerance, iso[1][0], highIso[1][0])
-                    and tuple(iso) not in seenIsotopes):
-                    newFeature.append([curScan, iso])
-                    found = True
-                    break # From "for iso in scanSeqs"                    
-            
-            if found:
-                lastSeen = curRT
-            elif abs(curRT - lastSeen) > dropoutTimeTolerance:
-                continuing = False
-        
-        curScan = highScan
-        continuing = True
-        lastSeen = rtLookup[indexToMS1[curScan]]
-        while continuing: # Trailing the feature forwards; mostly repeat code.
-            curScan += 1
-            try:
-                curRT = rtLookup[indexToMS1[curScan]]
-            except KeyError:
-                assert curScan > max(indexToMS1.keys())
-                break
-            
-            
-            scanSeqs = isotopesByChargePoint[highChg][curScan].returnRange(centerMZ - 2, centerMZ + 1.5)
-            scanSeqs.sort(key = lambda x: x[centerIndex][1], reverse = True)
-            
-            found = False
-            for iso in scanSeqs: # These are known to have centerMZ in common.
-                # Ditto.
-                               
-                if (inPPM(tolerance, iso[0][0], highIso[0][0])
-                    and inPPM(tolerance, iso[1][0], highIso[1][0])
-                    and tuple(iso) not in seenIsotopes):
-                    newFeature.append([curScan, iso])
-                    found = True
-                    break # From "for iso in scanSeqs"                    
-
-            if found:
-                lastSeen = curRT
-            elif abs(curRT - lastSeen) > dropoutTimeTolerance:
-                continuing = False
-
-        if len(newFeature) > 1:
-            featureList.append((highChg, newFeature))
-        
-        for _, iso in newFeature:
-            seenIsotopes.add(tuple(iso))
-    times.append(time.clock())
+    scanRTs = [rtLookup[indexToMS1[index]] for index in range(len(scaninfo))]
+    if processes > 1:
+        featureList = trace_features_parallel(candidates, allIsotopes, scanRTs, tolerance,
+                                              dropoutTimeTolerance, processes)
+    else:
+        featureList = trace_features(candidates, allIsotopes, scanRTs, tolerance,
+                                     dropoutTimeTolerance)
+    featureList = [(chg, feature) for _, chg, feature in featureList]
     
     for chg, feature in featureList:
         for stage in feature:
@@ -726,9 +799,6 @@ def detect_features(datafile, **constants):
             return thing
     lookup = idLookup()
 
-    if scanrange:
-        featurefile = datafile + ('%s-%s.features' % scanrange)
-
     featureObjects = []
     for chg, feature in featureList:
         newfeature = Feature()
@@ -748,14 +818,237 @@ def detect_features(datafile, **constants):
         #assert test.mz == newfeature.mz and test.charge == newfeature.charge
         
         featureObjects.append(newfeature)
-    save_feature_database(featureObjects, featurefile)
+    return featureObjects
+
+def _merge_whitelists(first, second):
+    # A run without a whitelist covers every m/z.
+    if first is None or second is None:
+        return None
+    return sorted(set(first) | set(second))
+
+def _save_detected_features(checkpoint, isotopeData, tolerance, whitelist_mzs, processes):
+    featureObjects = _features_from_isotopes(isotopeData, tolerance, whitelist_mzs, processes)
+    # Settings and features are committed together.
+    set_detection_setting(checkpoint, 'tolerance', tolerance)
+    set_detection_setting(checkpoint, 'whitelist_psms',
+                          sorted(set(whitelist_mzs)) if whitelist_mzs is not None else None)
+    write_feature_tables(checkpoint, featureObjects,
+                         scan_times = dict((scanNum, rt) for scanNum, rt, _ in isotopeData))
+
+    
+def detect_features(datafile, **constants):
+    """
+    Runs the feature detection algorithm on the target data file (currently,
+    only Thermo .RAW is supported.)  Returns the path to the feature data
+    file.
+    
+    The isotopic envelopes found in each scan are checkpointed to the
+    feature file as peak picking proceeds; if detection is interrupted,
+    running it again resumes from the checkpoint instead of starting over.
+    
+    Optional arguments:
+    - tolerance (default 10): MZ tolerance in parts-per-million for all determinations
+    of peak identity.  Should usually correspond to the mass precision of the
+    source instrument.
+    - force (default False): If True, feature detection is run even if a
+    feature data file already exists for the target data, and any checkpoint
+    in it is discarded.
+    - extend (default False): If True and the feature file already exists,
+    its features are re-traced over both the scans it covers and the
+    requested ones (e.g., a new partial range); only scans not already in
+    the file are peak-picked.
+    - processes (default 1): Number of processes to use for peak picking
+    and for tracing features (which is split into independent m/z bands.)
+    The result is the same for any number of processes.
+    - outputfile: Feature file to write (or resume, or extend); by default
+    this is named after the data file, and the partial range or whitelist.
+    - keep_checkpoint (default True): If False, the checkpointed envelopes
+    are dropped from the feature file once detection is finished, which
+    makes the file much smaller but means it can't later be extended or
+    merged.
+    
+    Feature files from separate partial or whitelist_psms runs over the
+    same data can be combined with merge_feature_files.
+    """
+    
+    if 'tolerance' in constants and constants['tolerance']:
+        global tolerance
+        tolerance = constants['tolerance']
+        if tolerance < 1:
+            print("\n\n\nWARNING- tolerance value for SILAC analysis should now be in PPM!\n\n\n")
+    else:
+        tolerance = 10
+        
+    if 'partial' in constants:
+        # This is primarily for testing purposes only.
+        scanrange = constants['partial']
+    else:
+        scanrange = None
+        
+    force = constants.get('force', False)
+    extend = constants.get('extend', False)
+    keep_checkpoint = constants.get('keep_checkpoint', True)
+        
+    if 'whitelist_psms' in constants:
+        whitelist_mzs = constants['whitelist_psms']
+    else:
+        whitelist_mzs = None
+    
+    if 'outputfile' in constants:
+        featurefile = constants['outputfile']
+    elif scanrange:
+        featurefile = datafile + ('%s-%s.features' % tuple(scanrange))
+    elif whitelist_mzs is not None:
+        featurefile = datafile + '.partial%s.features' % (str(hash(frozenset(whitelist_mzs)))[:5])
+    else:
+        featurefile = datafile + '.features'
+        
+    if 'peak_picking_params' in constants:
+        peak_pick_params = constants['peak_picking_params']
+    elif 'tolerance' in constants and constants['tolerance']:
+        peak_pick_params = {'tolerance':constants['tolerance']}
+    else:
+        peak_pick_params = {'tolerance' : 10}
+    
+    if os.path.exists(featurefile):
+        if force:
+            os.remove(featurefile)
+        elif not extend and has_feature_tables(featurefile):
+            vprint("Feature data file already exists: %s" % featurefile)
+            return featurefile
+        elif extend and not has_detection_checkpoint(featurefile):
+            raise IOError("%s has no detection checkpoint to extend; run with "
+                          "force = True to redo detection." % featurefile)
+    
+    setGlobals(constants)
+    processes = constants.get('processes', 1)
+
+    
+    times = []
+    times.append(time.perf_counter())
+    data = mzFile(datafile)
+    
+    times.append(time.perf_counter())
+    vprint("Opened data file; getting isotopes...")
+
+    scaninfo = [x for x in data.scan_info(0, 99999999) if x[3] == 'MS1']
+    rtLookup = dict([(x[2], x[0]) for x in scaninfo])
+    scaninfo = [x[2] for x in scaninfo]
+    
+    if scanrange:
+        scaninfo = [x for x in scaninfo if scanrange[0] < x < scanrange[1]]
+
+    data.close()
+    
+    checkpoint = open_detection_checkpoint(featurefile, peak_pick_params)
+    try:
+        done = set(checkpointed_scans(checkpoint))
+        remaining = [x for x in scaninfo if x not in done]
+        if len(remaining) < len(scaninfo):
+            vprint("Resuming from checkpoint; %s of %s scans remain." % (len(remaining),
+                                                                       len(scaninfo)))
+        
+        pending = []
+        for count, (scanNum, isotopesByCharge) in enumerate(pick_isotopes(datafile, remaining,
+                                                                          peak_pick_params,
+                                                                          processes), 1):
+            pending.append((scanNum, rtLookup[scanNum], isotopesByCharge))
+            if len(pending) >= DETECTION_CHECKPOINT_SCANS:
+                save_scan_isotopes(checkpoint, pending)
+                pending = []
+            
+            if verbose_mode and count % 100 == 0:
+                print(count) # Shielded by explicit verbose_mode check.
+        save_scan_isotopes(checkpoint, pending)
+        
+        # Could just discard the un-feature'd peaks immediately.
+        vprint("Isotopic features acquired; finding features over time...")
+        times.append(time.perf_counter())
+        
+        if extend:
+            isotopeData = load_scan_isotopes(checkpoint)
+            if has_feature_tables(featurefile):
+                whitelist_mzs = _merge_whitelists(detection_setting(checkpoint, 'whitelist_psms'),
+                                                  whitelist_mzs)
+        else:
+            isotopeData = load_scan_isotopes(checkpoint, scaninfo)
+        
+        _save_detected_features(checkpoint, isotopeData, tolerance, whitelist_mzs, processes)
+        if not keep_checkpoint:
+            drop_detection_checkpoint(checkpoint)
+    finally:
+        checkpoint.close()
     
     vprint("Saved feature file.")
-    times.append(time.clock())
+    times.append(time.perf_counter())
     
     return featurefile
 
 
+def merge_feature_files(featurefiles, outputfile, tolerance = None, processes = 1,
+                        keep_checkpoint = True):
+    """
+    Combines feature files made from the same data file- e.g., by separate
+    partial or whitelist_psms runs of detect_features- into outputfile,
+    tracing features across all of their scans.  The files' checkpointed
+    envelopes are reused, so nothing is peak-picked again; they must have
+    been made with the same peak picking parameters.  Whitelists are
+    combined (if any of the files had none, neither does the result.)
+    tolerance defaults to the one the files were made with.  With
+    keep_checkpoint = False, the merged file's checkpoint is dropped once
+    its features are saved.
+    """
+    if os.path.abspath(outputfile) in [os.path.abspath(x) for x in featurefiles]:
+        raise ValueError("Output file %s is one of the files being merged." % outputfile)
+    
+    sources = [sqlite3.connect(x) for x in featurefiles]
+    try:
+        settings = []
+        for filename, conn in zip(featurefiles, sources):
+            tables = [x[0] for x in conn.execute("SELECT name FROM sqlite_master")]
+            if 'detection_settings' not in tables:
+                raise IOError("%s has no detection checkpoint to merge." % filename)
+            settings.append(dict((name, detection_setting(conn, name)) for name in
+                                 ['peak_picking_params', 'tolerance', 'whitelist_psms']))
+        
+        peak_pick_params = settings[0]['peak_picking_params']
+        if any(x['peak_picking_params'] != peak_pick_params for x in settings):
+            raise ValueError("Feature files were made with different peak picking parameters.")
+        if tolerance is None:
+            tolerances = set(x['tolerance'] for x in settings)
+            if len(tolerances) != 1:
+                raise ValueError("Feature files were made with different tolerances; "
+                                 "specify one for the merged file.")
+            tolerance = tolerances.pop()
+        whitelist_mzs = settings[0]['whitelist_psms']
+        for x in settings[1:]:
+            whitelist_mzs = _merge_whitelists(whitelist_mzs, x['whitelist_psms'])
+        
+        if os.path.exists(outputfile):
+            os.remove(outputfile)
+        merged = open_detection_checkpoint(outputfile, peak_pick_params)
+        try:
+            for conn in sources:
+                # Scans in more than one file are taken from the first.
+                merged.executemany("INSERT OR IGNORE INTO detection_scans VALUES "
+                                   "(?, ?, ?, ?, ?, ?, ?)",
+                                   conn.execute("SELECT %s FROM detection_scans"
+                                                % DETECTION_SCAN_COLUMNS))
+                merged.commit()
+            
+            _save_detected_features(merged, load_scan_isotopes(merged), tolerance,
+                                    whitelist_mzs, processes)
+            if not keep_checkpoint:
+                drop_detection_checkpoint(merged)
+        finally:
+            merged.close()
+    finally:
+        for conn in sources:
+            conn.close()
+    
+    return outputfile
+
+
 
 # Old-naming-convention alias, for legacy purposes.
 detectFeatures = detect_features
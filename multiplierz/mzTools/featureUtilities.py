@@ -8,6 +8,9 @@ import pickle
 import sqlite3
 import os
 import base64
+import json
+
+import numpy as np
 
 
 
@@ -57,6 +60,11 @@ def getScanFeatureDicts(datafile, featureData, absScanFeatures = False):
     return dict(scanToFeature), scanFeatureToPeaks, featureToMS1s
 
 def getMS2FeatureDict(datafile, featureData, absScanFeatures = False):
+    """
+    Returns a dict of feature number -> list of the MS2 scans whose
+    precursor m/z is among the feature's peaks in the preceding MS1.
+    featureData can be anything FeatureIndex takes, or a FeatureIndex.
+    """
     scans = datafile.scan_info(0, 9999999)
     ms2toms1s = {}
     currentMS1 = None
@@ -66,29 +74,24 @@ def getMS2FeatureDict(datafile, featureData, absScanFeatures = False):
         else:
             ms2toms1s[scan[2]] = currentMS1    
     
+    # Feature regions are indexed either by scan number, or by position
+    # among the MS1 scans.
     if absScanFeatures:
-        ms1ScanLookup = idLookup()
+        ms1ToRegion = idLookup()
     else:
-        ms1ScanLookup = dict(enumerate([x[2] for x in scans if x[3] == 'MS1']))    
+        ms1ToRegion = dict((x, i) for i, x in enumerate([x[2] for x in scans if x[3] == 'MS1']))
     
-    scanToFeature = defaultdict(list)    
-    for featureNumber, feature in enumerate(featureData):
-        for relativeMs1, peaks in feature.regions:
-            absMS1 = ms1ScanLookup[relativeMs1]
-            scanToFeature[absMS1].append(featureNumber)
-            scanFeatureToPeaks[absMS1, featureNumber] = peaks
+    if not isinstance(featureData, FeatureIndex):
+        featureData = FeatureIndex(featureData)
+    
+    ms2s = [x for x in scans if x[3] == 'MS2' and ms2toms1s[x[2]] is not None]
+    matches = featureData.envelope_matches([x[1] for x in ms2s],
+                                           [ms1ToRegion[ms2toms1s[x[2]]] for x in ms2s])
             
     featureToMS2s = defaultdict(list)
-    for index, ms2 in [(x[2], x) for x in scans if x[3] == 'MS2']:
-        ms1 = ms2toms1s[index]
-        features = scanToFeature[ms1]
-        for featureNum, feature in [(x, featureData[x]) for x in features]:
-            for scanNum, peaks in feature.regions:
-                if ms1ScanLookup[scanNum] == ms1:
-                #if scanNum == ms1:
-                    if any([abs(x[0] - ms2[1]) < 0.05 for x in peaks]):
-                        featureToMS2s[featureNum].append(ms2[2])
-                    break    
+    for ms2, features in zip(ms2s, matches):
+        for featureNum in sorted(index for index, _ in features):
+            featureToMS2s[featureNum].append(ms2[2])
                 
     return dict(featureToMS2s)
 
@@ -138,10 +141,81 @@ def featureToPSM(resultFile, featureData, groupSILAC = False):
     
 
 
-def save_feature_database(features, outputfile, overwrite = None):
+FEATURE_DB_VERSION = 2
+
+# Rows read from the database per fetch, when iterating over query results.
+FEATURE_FETCH_SIZE = 1000
+
+# Columns of the version 2 features table, in the order StoredFeature takes them.
+FEATURE_COLUMNS = ('ind, mz, charge, startscan, endscan, starttime, endtime, '
+                   'intensity, skewness, kurtosis, split')
+
+def pack_regions(regions):
+    """
+    Packs a feature's regions (list of (scan, [(mz, intensity, ...), ...]))
+    into (scans, counts, points, width): arrays of each region's scan and
+    number of points, and of all points (width values each), as bytes.
+    """
+    scans = np.array([scan for scan, _ in regions], dtype = np.int64)
+    counts = np.array([len(points) for _, points in regions], dtype = np.int32)
+    width = len(regions[0][1][0]) if regions and regions[0][1] else 2
+    points = np.array([pt for _, pts in regions for pt in pts], dtype = np.float64)
+    return scans.tobytes(), counts.tobytes(), points.tobytes(), width
+
+def unpack_regions(scans, counts, points, width):
+    scans = np.frombuffer(scans, dtype = np.int64).tolist()
+    counts = np.frombuffer(counts, dtype = np.int32)
+    points = [tuple(pt) for pt in np.frombuffer(points, dtype = np.float64).reshape(-1, width).tolist()]
+    bounds = np.concatenate([[0], np.cumsum(counts)]).tolist()
+    return [(scan, points[bounds[i]:bounds[i+1]]) for i, scan in enumerate(scans)]
+
+def pack_isotopes(isotopesByCharge):
+    """
+    Packs a scan's isotopic envelopes by charge (dict of charge to a list of
+    envelopes, each a list of (mz, intensity, ...) points) into (charges,
+    envelopes, counts, points, width): arrays of each charge, the number of
+    envelopes of each charge, the number of points in each envelope, and of
+    all points (width values each), as bytes.
+    """
+    charges = np.array(list(isotopesByCharge.keys()), dtype = np.int32)
+    envelopes = np.array([len(x) for x in isotopesByCharge.values()], dtype = np.int32)
+    allEnvelopes = [env for x in isotopesByCharge.values() for env in x]
+    counts = np.array([len(env) for env in allEnvelopes], dtype = np.int32)
+    width = next((len(env[0]) for env in allEnvelopes if env), 2)
+    points = np.array([pt for env in allEnvelopes for pt in env], dtype = np.float64)
+    return charges.tobytes(), envelopes.tobytes(), counts.tobytes(), points.tobytes(), width
+
+def unpack_isotopes(charges, envelopes, counts, points, width):
+    charges = np.frombuffer(charges, dtype = np.int32).tolist()
+    envelopes = np.frombuffer(envelopes, dtype = np.int32)
+    counts = np.frombuffer(counts, dtype = np.int32)
+    points = [tuple(pt) for pt in np.frombuffer(points, dtype = np.float64).reshape(-1, width).tolist()]
+    pointBounds = np.concatenate([[0], np.cumsum(counts)]).tolist()
+    allEnvelopes = [points[pointBounds[i]:pointBounds[i+1]] for i in range(len(counts))]
+    envBounds = np.concatenate([[0], np.cumsum(envelopes)]).tolist()
+    return dict((charge, allEnvelopes[envBounds[i]:envBounds[i+1]])
+                for i, charge in enumerate(charges))
+
+def _nullable(value):
+    # NaN is stored as NULL; skewness and kurtosis may also be 'NA' strings
+    # (when scipy is unavailable), which SQLite keeps as text.
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+def save_feature_database(features, outputfile, overwrite = None,
+                          scan_times = None, version = FEATURE_DB_VERSION):
     """
     Saves a SQLite-mode feature database. Result file will have the
     extension '.features' .
+    
+    In the version 2 format each feature's bounds (m/z, charge, scan and
+    retention time range), C12 intensity, skewness and kurtosis are typed
+    columns of the features table, also indexed by an R-tree over (m/z,
+    scan); the envelope points of each scan of the feature are stored in
+    the envelopes table as packed arrays.  scan_times, if given, maps scan
+    numbers to retention times.  version = 1 writes the previous format,
+    of pickled Feature objects.
     """
     
     if os.path.exists(outputfile):
@@ -150,6 +224,68 @@ def save_feature_database(features, outputfile, overwrite = None):
         else:
             raise IOError("Target file %s already exists!" % outputfile)
     
+    if version == 1:
+        return save_feature_database_v1(features, outputfile)
+    
+    conn = sqlite3.connect(outputfile)
+    write_feature_tables(conn, features, scan_times)
+    conn.close()
+
+def write_feature_tables(conn, features, scan_times = None):
+    """
+    Writes the version 2 feature tables to an open database connection,
+    replacing any already there; other tables (e.g., detection checkpoints)
+    are left alone.  This is done in a single transaction, so the file
+    holds either the previous features or the new ones.
+    """
+    cur = conn.cursor()
+    if not conn.in_transaction:
+        cur.execute("BEGIN")
+    for table in ('features', 'envelopes', 'feature_boxes'):
+        cur.execute("DROP TABLE IF EXISTS %s" % table)
+    
+    cur.execute("CREATE TABLE features(ind INTEGER PRIMARY KEY, mz REAL, charge INTEGER, "
+                "startscan INTEGER, endscan INTEGER, starttime REAL, endtime REAL, "
+                "intensity REAL, skewness REAL, kurtosis REAL, split INTEGER)")
+    cur.execute("CREATE TABLE envelopes(ind INTEGER PRIMARY KEY, scans BLOB, counts BLOB, "
+                "points BLOB, width INTEGER)")
+    try:
+        cur.execute("CREATE VIRTUAL TABLE feature_boxes USING rtree(ind, minmz, maxmz, "
+                    "minscan, maxscan)")
+        boxes = True
+    except sqlite3.OperationalError: # SQLite built without R-tree support.
+        boxes = False
+    vprint("Created table.")
+    
+    for index, feature in enumerate(features):
+        startscan, endscan = feature.scanrange
+        if scan_times:
+            starttime, endtime = scan_times.get(startscan), scan_times.get(endscan)
+        else:
+            starttime = endtime = None
+        cur.execute("INSERT INTO features VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (index, feature.mz, feature.charge, startscan, endscan,
+                     starttime, endtime, _nullable(feature.c12Intensity()),
+                     _nullable(feature.skewness), _nullable(feature.kurtosis),
+                     int(bool(feature.wasSplit))))
+        cur.execute("INSERT INTO envelopes VALUES (?, ?, ?, ?, ?)",
+                    (index,) + pack_regions(feature.regions))
+        if boxes:
+            cur.execute("INSERT INTO feature_boxes VALUES (?, ?, ?, ?, ?)",
+                        (index, feature.mz, feature.mz, startscan, endscan))
+    
+    vprint("Indexing...")
+    cur.execute("CREATE INDEX mzindex ON features(mz, startscan)")
+    cur.execute("CREATE INDEX scanindex ON features(startscan, endscan)")
+    cur.execute("CREATE INDEX timeindex ON features(starttime, endtime)")
+    cur.execute("PRAGMA user_version = %d" % FEATURE_DB_VERSION)
+    vprint("Analyzing...")
+    cur.execute("ANALYZE")
+    
+    vprint("Final SQLite commit...")
+    conn.commit()
+
+def save_feature_database_v1(features, outputfile):
     conn = sqlite3.connect(outputfile)
     cur = conn.cursor()
     
@@ -188,6 +324,106 @@ def save_feature_database(features, outputfile, overwrite = None):
     
     
 
+# Feature detection checkpoints: the isotopic envelopes found in each MS1 scan
+# are kept in the feature file (in the detection_scans table, as packed arrays)
+# as detection proceeds, so that an interrupted run can pick up where it left
+# off, and so that a feature file can be extended to more scans, or merged
+# with another, without peak-picking the same scans again.  Once detection is
+# finished the checkpoint may be dropped, if that won't be needed.
+
+DETECTION_SCAN_COLUMNS = 'scan, rt, charges, envelopes, counts, points, width'
+
+def open_detection_checkpoint(featurefile, peak_pick_params):
+    """
+    Opens the feature file's detection checkpoint, creating it if need be.
+    Checkpointed envelopes found with peak picking parameters other than
+    peak_pick_params are discarded.  Returns the database connection.
+    """
+    conn = sqlite3.connect(featurefile)
+    conn.execute("CREATE TABLE IF NOT EXISTS detection_scans(scan INTEGER PRIMARY KEY, "
+                 "rt REAL, charges BLOB, envelopes BLOB, counts BLOB, points BLOB, "
+                 "width INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS detection_settings(name TEXT PRIMARY KEY, "
+                 "value TEXT)")
+    previous = detection_setting(conn, 'peak_picking_params')
+    if previous is not None and previous != json.loads(json.dumps(peak_pick_params)):
+        vprint("Peak picking parameters differ from those of %s's checkpoint; "
+               "discarding it." % featurefile)
+        conn.execute("DELETE FROM detection_scans")
+    set_detection_setting(conn, 'peak_picking_params', peak_pick_params)
+    conn.commit()
+    return conn
+
+def detection_setting(conn, name, default = None):
+    row = conn.execute("SELECT value FROM detection_settings WHERE name=?", (name,)).fetchone()
+    return json.loads(row[0]) if row else default
+
+def set_detection_setting(conn, name, value):
+    conn.execute("INSERT OR REPLACE INTO detection_settings VALUES (?, ?)",
+                 (name, json.dumps(value, sort_keys = True)))
+
+def checkpointed_scans(conn):
+    return [x[0] for x in conn.execute("SELECT scan FROM detection_scans")]
+
+def save_scan_isotopes(conn, scanData):
+    """
+    Checkpoints (scan number, retention time, isotopes by charge) of each
+    of the given scans, and commits.
+    """
+    conn.executemany("INSERT OR REPLACE INTO detection_scans VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     [(scan, rt) + pack_isotopes(isotopes) for scan, rt, isotopes in scanData])
+    conn.commit()
+
+def load_scan_isotopes(conn, scans = None):
+    """
+    Returns (scan number, retention time, isotopes by charge) for each
+    checkpointed scan (or each of the given scans), in order of time.
+    """
+    wanted = set(scans) if scans is not None else None
+    cursor = conn.execute("SELECT %s FROM detection_scans ORDER BY rt, scan"
+                          % DETECTION_SCAN_COLUMNS)
+    return [(row[0], row[1], unpack_isotopes(*row[2:])) for row in cursor
+            if wanted is None or row[0] in wanted]
+
+def drop_detection_checkpoint(conn):
+    """
+    Removes the detection checkpoint from an open feature file, and
+    reclaims the space it took.  The file can't then be resumed, extended
+    or merged.
+    """
+    conn.execute("DROP TABLE IF EXISTS detection_scans")
+    conn.execute("DROP TABLE IF EXISTS detection_settings")
+    conn.commit()
+    conn.execute("VACUUM")
+
+def has_detection_checkpoint(featurefile):
+    conn = sqlite3.connect(featurefile)
+    try:
+        return bool(conn.execute("SELECT name FROM sqlite_master WHERE type='table' "
+                                 "AND name='detection_settings'").fetchone())
+    finally:
+        conn.close()
+
+def has_feature_tables(featurefile):
+    """
+    True if the file holds a finished set of features (as opposed to only
+    a detection checkpoint.)
+    """
+    conn = sqlite3.connect(featurefile)
+    try:
+        return bool(conn.execute("SELECT name FROM sqlite_master WHERE type='table' "
+                                 "AND name='features'").fetchone())
+    finally:
+        conn.close()
+
+
+def _stored_feature(featureClass, row, loader):
+    row = list(row)
+    for i in (7, 8, 9): # NULL for NaN intensity, skewness or kurtosis.
+        if row[i] is None:
+            row[i] = float('nan')
+    return featureClass(row, loader)
+
 def newMarshal(x):
     return pickle.loads(base64.b64decode(x))
 def oldMarshal(x):
@@ -208,11 +444,17 @@ class FeatureInterface(object):
     > data[100]
     < Feature object at  ...>
     
-    Commands mz_range and scan_range return iterators over features
-    that fall within the specified ranges.
+    Commands mz_range, box_range, scan_range and time_range return
+    iterators over features that fall within the specified ranges; rows
+    are read from the file fetch_size at a time as the iterator proceeds.
+    
+    Both versions of the SQLite format are read; features from version 2
+    files are StoredFeature objects, which load their envelope points from
+    the file only when they're needed.
     """
-    def __init__(self, filename):
+    def __init__(self, filename, fetch_size = FEATURE_FETCH_SIZE):
         self.filename = filename
+        self.fetch_size = fetch_size
         assert os.path.exists(filename)
         if filename.lower().endswith('featurepickle'):
             vprint("Legacy mode enabled.")
@@ -232,60 +474,372 @@ class FeatureInterface(object):
             #else:
                 #self.decoder = newMarshal
             
+            self.version = self.connection.execute("PRAGMA user_version").fetchone()[0] or 1
+            if self.version >= 2:
+                from multiplierz.mzTools.featureDetector import StoredFeature
+                self._stored = StoredFeature
+                tables = [x[0] for x in self.connection.execute("SELECT name FROM sqlite_master")]
+                self.boxes = 'feature_boxes' in tables
             
+    def _load_regions(self, index):
+        row = self.connection.execute("SELECT scans, counts, points, width FROM envelopes "
+                                      "WHERE ind=?", (index,)).fetchone()
+        return unpack_regions(*row)
+    
+    def _feature(self, row):
+        # Row of (ind, data) for version 1, or of FEATURE_COLUMNS.
+        if self.version < 2:
+            return row[0], self.decoder(str(row[1]))
+        return row[0], _stored_feature(self._stored, row, self._load_regions)
+    
+    def _select(self, condition = '', args = ()):
+        # Yields (index, feature) of each feature matching the condition.
+        columns = 'ind, data' if self.version < 2 else FEATURE_COLUMNS
+        cursor = self.connection.execute("SELECT %s FROM features %s" % (columns, condition),
+                                         args)
+        cursor.arraysize = self.fetch_size
+        sublist = cursor.fetchmany()
+        while sublist:
+            for row in sublist:
+                yield self._feature(row)
+            sublist = cursor.fetchmany()
         
     def __getitem__(self, index):
         if self.mode == 'pickle':
             assert isinstance(index, int)
             return self.data[index]
         
-        command = "SELECT data FROM features WHERE ind=%s" % index
-        self.data.execute(command)
-        feature = self.decoder(str(self.data.fetchone()[0]))
-        return feature
+        for _, feature in self._select("WHERE ind=?", (index,)):
+            return feature
+        raise IndexError("No feature %s in %s" % (index, self.filename))
         
     def __iter__(self):
         assert self.mode == 'sql'
-        self.data.execute('SELECT ind, data FROM features')
-        sublist = self.data.fetchmany()
-        while sublist:
-            for i_f in sublist:
-                yield i_f[0], self.decoder(str(i_f[1]))
-            sublist = self.data.fetchmany()        
+        return self._select()
     
     def mz_range(self, start_mz, end_mz):
         assert self.mode == 'sql', 'Requires SQLite mode!'
         
-        command = "SELECT ind, data FROM features WHERE mz >= %s AND mz <= %s" % (start_mz, end_mz)
-        self.data.execute(command)
- 
-        sublist = self.data.fetchmany()
-        while sublist:
-            for i_f in sublist:
-                yield i_f[0], self.decoder(str(i_f[1]))
-            sublist = self.data.fetchmany()
+        return self._select("WHERE mz >= ? AND mz <= ?", (start_mz, end_mz))
+    
+    def box_range(self, start_mz, end_mz, start_scan, end_scan):
+        """
+        Iterates over features with m/z in the given range, whose scan
+        range overlaps the given one; uses the R-tree index of version 2
+        feature files.
+        """
+        assert self.mode == 'sql', 'Requires SQLite mode!'
+        if self.version >= 2 and self.boxes:
+            # R-tree coordinates are rounded outwards to 32-bit floats, so
+            # the bounds are checked again against the exact columns.
+            return self._select("WHERE ind IN (SELECT ind FROM feature_boxes "
+                                "WHERE maxmz >= ? AND minmz <= ? "
+                                "AND maxscan >= ? AND minscan <= ?) "
+                                "AND mz >= ? AND mz <= ? "
+                                "AND endscan >= ? AND startscan <= ?",
+                                (start_mz, end_mz, start_scan, end_scan) * 2)
+        return self._select("WHERE mz >= ? AND mz <= ? AND endscan >= ? AND startscan <= ?",
+                            (start_mz, end_mz, start_scan, end_scan))
     
     def scan_range(self, start_scan, end_scan):
-        # Returns features fully enclosed in the specified scan range.
-        command = "SELECT ind, data FROM features where start_scan >= %s AND end_scan <= %s" % (start_scan, end_scan)
-        sublist = self.data.fetchmany()
-        while sublist:
-            for i_f in sublist:
-                yield i_f[0], self.decoder(str(i_f[1]))
-            sublist = self.data.fetchmany()                
+        """
+        Iterates over features fully enclosed in the specified scan range.
+        """
+        assert self.mode == 'sql', 'Requires SQLite mode!'
+        return self._select("WHERE startscan >= ? AND endscan <= ?", (start_scan, end_scan))
+    
+    def time_range(self, start_time, end_time):
+        """
+        Iterates over features fully enclosed in the specified retention
+        time range; requires a version 2 feature file saved with scan times.
+        """
+        assert self.mode == 'sql', 'Requires SQLite mode!'
+        if self.version < 2:
+            raise NotImplementedError("%s does not store feature retention times "
+                                      "(version 1 feature file.)" % self.filename)
+        return self._select("WHERE starttime >= ? AND endtime <= ?", (start_time, end_time))
         
     def close(self):
         if self.mode == 'sql':
-            self.conection.close()
+            self.connection.close()
+    
+
+
+def _window_pairs(values, lows, highs):
+    # (query, position) pairs for each position of the sorted array values
+    # within [lows[query], highs[query]], ordered by query then position.
+    starts = np.searchsorted(values, lows, 'left')
+    counts = np.maximum(np.searchsorted(values, highs, 'right') - starts, 0)
+    queries = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return queries, np.repeat(starts, counts) + offsets
+
+def _point_arrays(mzs, scans, charges):
+    return (np.asarray(mzs, dtype = float), np.asarray(scans, dtype = float),
+            np.asarray(charges, dtype = float))
+
+
+class FeatureIndex(object):
+    """
+    In-memory index of feature bounding boxes (C12 m/z, charge and scan
+    range), for matching many points- e.g. the precursors of a file's PSMs-
+    to features at once.  features may be a FeatureInterface, a feature
+    file, a list of Feature objects or a sequence of (index, feature) pairs.
+    
+    Boxes are held as arrays sorted by m/z; the query methods take arrays
+    of point m/z, (MS1) scan and charge, and find the candidate features for
+    all points in one pass of binary searches and array comparisons, so
+    that only features actually near a point are examined individually.
+    Results are in the same order, and pick the same features, as the
+    per-point FeatureInterface.mz_range queries they replace.
+    """
+    def __init__(self, features):
+        if isinstance(features, str):
+            features = FeatureInterface(features)
+        if isinstance(features, FeatureInterface) and features.mode == 'pickle':
+            features = features.data
+        if isinstance(features, list) and features and not isinstance(features[0], tuple):
+            features = enumerate(features)
+        items = list(features)
+        
+        mzs = np.array([f.mz for _, f in items], dtype = float)
+        starts = np.array([f.scanrange[0] for _, f in items], dtype = float)
+        indices = np.array([i for i, _ in items])
+        # Same order as the (mz, startscan) index of the feature database.
+        order = np.lexsort((indices, starts, mzs)) if items else np.zeros(0, dtype = int)
+        
+        self.indices = indices[order].tolist()
+        self.features = [items[i][1] for i in order]
+        self.mzs = mzs[order]
+        self.starts = starts[order]
+        self.ends = np.array([f.scanrange[1] for f in self.features], dtype = float)
+        self.charges = np.array([f.charge for f in self.features], dtype = float)
+        self._envelopes = None
+        
+    def __len__(self):
+        return len(self.features)
+    
+    def _pairs(self, mzs, scans, charges, lows, highs):
+        # Point/feature pairs within the m/z windows, with matching charge
+        # and a scan range including the point's scan.
+        queries, positions = _window_pairs(self.mzs, lows, highs)
+        keep = ((self.charges[positions] == charges[queries])
+                & (self.starts[positions] <= scans[queries])
+                & (self.ends[positions] >= scans[queries]))
+        return queries[keep], positions[keep]
+    
+    def _contained_pairs(self, mzs, scans, charges, width):
+        # As Feature.containsPoint.
+        from multiplierz.mzTools.featureDetector import featureMatchupTolerance
+        queries, positions = self._pairs(mzs, scans, charges, mzs - width, mzs + width)
+        keep = ((np.abs(mzs[queries] - self.mzs[positions]) < featureMatchupTolerance)
+                & (self.starts[positions] < scans[queries])
+                & (self.ends[positions] > scans[queries]))
+        return queries[keep], positions[keep]
+    
+    def _by_distance(self, mzs, queries, positions):
+        # Pairs ordered by point, then m/z distance, then index order.
+        distance = np.abs(self.mzs[positions] - mzs[queries])
+        order = np.lexsort((positions, distance, queries))
+        return queries[order], positions[order]
+    
+    def containing(self, mzs, scans, charges, width = 0.01):
+        """
+        For each point, the list of (index, feature) of features with m/z
+        within width (which may be an array, one per point) of the point's
+        that contain it (per Feature.containsPoint), in m/z order.
+        """
+        mzs, scans, charges = _point_arrays(mzs, scans, charges)
+        matches = [[] for _ in range(len(mzs))]
+        for query, position in zip(*[x.tolist() for x in
+                                     self._contained_pairs(mzs, scans, charges, width)]):
+            matches[query].append((self.indices[position], self.features[position]))
+        return matches
+    
+    def nearest(self, mzs, scans, charges, width = 0.01):
+        """
+        For each point, (index, feature) of the feature nearest in m/z of
+        those that contain it within width, or None.
+        """
+        mzs, scans, charges = _point_arrays(mzs, scans, charges)
+        queries, positions = self._by_distance(mzs, *self._contained_pairs(mzs, scans,
+                                                                          charges, width))
+        first = np.ones(len(queries), dtype = bool)
+        first[1:] = queries[1:] != queries[:-1]
+        matches = [None] * len(mzs)
+        for query, position in zip(queries[first].tolist(), positions[first].tolist()):
+            matches[query] = self.indices[position], self.features[position]
+        return matches
+    
+    def bordering(self, mzs, scans, charges, width = 1.0):
+        """
+        For each point, (index, feature, edge) of the feature nearest in
+        m/z of those within width for which Feature.bordersPoint gives an
+        edge description, or None.  bordersPoint is only called for features
+        whose charge and bounding box fit the point.
+        """
+        points = list(zip(mzs, scans, charges))
+        mzs, scans, charges = _point_arrays(mzs, scans, charges)
+        queries, positions = self._by_distance(mzs, *self._pairs(mzs, scans, charges,
+                                                                mzs - width, mzs + width))
+        matches = [None] * len(mzs)
+        for query, position in zip(queries.tolist(), positions.tolist()):
+            if matches[query] is not None:
+                continue
+            feature = self.features[position]
+            edge = feature.bordersPoint(*points[query])
+            if edge:
+                matches[query] = self.indices[position], feature, edge
+        return matches
+    
+    def assign(self, mzs, scans, charges, width = 0.01, border_width = 1.0):
+        """
+        Assigns each point to a feature: the nearest containing it within
+        width, as (index, feature, None), or failing that the nearest
+        bordering it within border_width, as (index, feature, edge).  Points
+        matching neither are None.
+        """
+        matches = [x + (None,) if x else None
+                   for x in self.nearest(mzs, scans, charges, width)]
+        unmatched = [i for i, x in enumerate(matches) if x is None]
+        if unmatched:
+            borders = self.bordering([mzs[i] for i in unmatched], [scans[i] for i in unmatched],
+                                     [charges[i] for i in unmatched], border_width)
+            for i, match in zip(unmatched, borders):
+                matches[i] = match
+        return matches
     
+    def _envelope_bounds(self):
+        # Lowest and highest m/z of each feature's envelope points; loads
+        # the envelopes of every feature.
+        if self._envelopes is None:
+            lows, highs = [], []
+            for feature in self.features:
+                peakMZs = [pt[0] for _, points in feature.regions for pt in points]
+                lows.append(min(peakMZs) if peakMZs else feature.mz)
+                highs.append(max(peakMZs) if peakMZs else feature.mz)
+            self._envelopes = np.array(lows, dtype = float), np.array(highs, dtype = float)
+        return self._envelopes
+    
+    def envelope_matches(self, mzs, scans, tolerance = 0.05):
+        """
+        For each point, the list of (index, feature) of features (of any
+        charge) with an envelope peak within tolerance of the point's m/z
+        in the point's scan, in m/z order.
+        """
+        mzs, scans = np.asarray(mzs, dtype = float), np.asarray(scans, dtype = float)
+        matches = [[] for _ in range(len(mzs))]
+        if not len(self.features):
+            return matches
+        lows, highs = self._envelope_bounds()
+        below = (self.mzs - lows).max() + 2 * tolerance
+        above = (highs - self.mzs).max() + 2 * tolerance
+        queries, positions = _window_pairs(self.mzs, mzs - above, mzs + below)
+        keep = ((self.starts[positions] <= scans[queries])
+                & (self.ends[positions] >= scans[queries])
+                & (lows[positions] - tolerance <= mzs[queries])
+                & (highs[positions] + tolerance >= mzs[queries]))
+        for query, position in zip(queries[keep].tolist(), positions[keep].tolist()):
+            feature, mz, scan = self.features[position], mzs[query], scans[query]
+            for regionScan, points in feature.regions:
+                if regionScan == scan:
+                    if any([abs(x[0] - mz) < tolerance for x in points]):
+                        matches[query].append((self.indices[position], feature))
+                    break
+        return matches
 
 
 class FeatureInterface_preload(object):
+    """
+    In-memory snapshot of a feature file, with the same query methods as
+    FeatureInterface.  The features' bounds are held as columns (a dict of
+    arrays, by FEATURE_COLUMNS name, in m/z order), and queries are
+    answered from these; no connection to the file is kept open.  For
+    version 2 files the envelope points are kept packed, and unpacked for
+    each feature when first used.
+    """
     def __init__(self, filename):
+        from multiplierz.mzTools.featureDetector import StoredFeature
+        
         source = FeatureInterface(filename)
-        self.features = source.mz_range(0, 5000)
+        self.filename = filename
+        if source.mode == 'pickle':
+            items = list(enumerate(source.data))
+            self.version = None
+        elif source.version < 2:
+            items = list(source)
+            self.version = source.version
+        else:
+            self.version = source.version
+            self._envelopes = dict((row[0], row[1:]) for row in
+                                   source.connection.execute("SELECT ind, scans, counts, "
+                                                             "points, width FROM envelopes"))
+            rows = source.connection.execute("SELECT %s FROM features" % FEATURE_COLUMNS)
+            items = [(row[0], _stored_feature(StoredFeature, row, self._load_regions))
+                     for row in rows]
+        if source.mode == 'sql':
+            source.close()
         
+        def column(values):
+            return np.array([np.nan if x is None else x for x in values], dtype = float)
+        mzs = column([f.mz for _, f in items])
+        starts = column([f.scanrange[0] for _, f in items])
+        indices = np.array([i for i, _ in items], dtype = np.int64)
+        order = np.lexsort((indices, starts, mzs))
         
+        self.features = [items[i][1] for i in order]
+        self.columns = {'ind' : indices[order], 'mz' : mzs[order], 'startscan' : starts[order],
+                        'charge' : column([f.charge for f in self.features]),
+                        'endscan' : column([f.scanrange[1] for f in self.features]),
+                        'starttime' : column([getattr(f, 'starttime', None) for f in self.features]),
+                        'endtime' : column([getattr(f, 'endtime', None) for f in self.features])}
+        self._positions = dict((ind, i) for i, ind in enumerate(self.columns['ind'].tolist()))
     
-            
-
+    def _load_regions(self, index):
+        return unpack_regions(*self._envelopes[index])
+    
+    def _items(self, positions):
+        indices = self.columns['ind']
+        for position in positions:
+            yield int(indices[position]), self.features[position]
+    
+    def __len__(self):
+        return len(self.features)
+    
+    def __getitem__(self, index):
+        try:
+            return self.features[self._positions[index]]
+        except KeyError:
+            raise IndexError("No feature %s in %s" % (index, self.filename))
+    
+    def __iter__(self):
+        return self._items(range(len(self.features)))
+    
+    def mz_range(self, start_mz, end_mz):
+        mzs = self.columns['mz']
+        return self._items(range(np.searchsorted(mzs, start_mz, 'left'),
+                                 np.searchsorted(mzs, end_mz, 'right')))
+    
+    def box_range(self, start_mz, end_mz, start_scan, end_scan):
+        mzs = self.columns['mz']
+        low, high = np.searchsorted(mzs, start_mz, 'left'), np.searchsorted(mzs, end_mz, 'right')
+        inBox = ((self.columns['endscan'][low:high] >= start_scan)
+                 & (self.columns['startscan'][low:high] <= end_scan))
+        return self._items((np.flatnonzero(inBox) + low).tolist())
+    
+    def scan_range(self, start_scan, end_scan):
+        enclosed = ((self.columns['startscan'] >= start_scan)
+                    & (self.columns['endscan'] <= end_scan))
+        return self._items(np.flatnonzero(enclosed).tolist())
+    
+    def time_range(self, start_time, end_time):
+        if self.version is None or self.version < 2:
+            raise NotImplementedError("%s does not store feature retention times "
+                                      "(version 1 feature file.)" % self.filename)
+        enclosed = ((self.columns['starttime'] >= start_time)
+                    & (self.columns['endtime'] <= end_time))
+        return self._items(np.flatnonzero(enclosed).tolist())
+    
+    def close(self):
+        pass
+        
@@ -14,11 +14,11 @@ from multiplierz.mass_biochem import mz, unimod
         #return float('NaN'), float('NaN')
 def pearsonr(x, y):
     return float('NaN'), float('NaN')        
-from numpy import average, median, floor, ceil
+from numpy import average, median, floor, ceil, array
 import os
 import re
 from multiplierz.internalAlgorithms import ProximityIndexedSequence, inPPM, select
-from multiplierz.mzTools.featureUtilities import FeatureInterface
+from multiplierz.mzTools.featureUtilities import FeatureInterface, FeatureIndex
 from multiplierz.mgf import standard_title_parse
 import warnings
 
@@ -81,6 +81,13 @@ class FeatureMemo(object):
     def __init__(self, featurefile):
         self.features = FeatureInterface(featurefile)
         self.bins = defaultdict(list)
+        self._index = None
+    
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = FeatureIndex(self.features)
+        return self._index
     
     def get_bin(self, down, up):
         key = down, up
@@ -89,6 +96,18 @@ class FeatureMemo(object):
     def mzs_around(self, mz, width):
         low, high = mz - (width/2), mz + (width/2)
         return self.get_bin(low, high)
+    
+    def containing(self, points, pointTol):
+        """
+        For each (mz, scan, charge) point, the (index, feature) pairs of
+        features containing it within a window of pointTol ppm; as
+        mzs_around followed by Feature.containsPoint, for all points at once.
+        """
+        if not points:
+            return []
+        mzs, scans, charges = unzip(points, 3)
+        daTols = (array(mzs, dtype = float)/1000000) * pointTol
+        return self.index.containing(mzs, scans, charges, width = daTols/2)
             
         
         
@@ -526,17 +545,15 @@ def featureIntensities(points, pointTol, features):
     #assert isinstance(features, ProximityIndexedSequenceAgain)
     #assert isinstance(features, FeatureInterface)
     
-    for pt in points:
+    # FeatureMemo method; candidates for every point are found at once.
+    pointMatches = features.containing(points, pointTol)
+    for pt, allMatches in zip(points, pointMatches):
         try:
             #allMatches = [(i, x) for (i, x) in enumerate(features) if x.containsPoint(*pt)]
             #index, match = max(allMatches, key = lambda x: x[1].totalIntensity())
             #allMatches = features.returnRange(pt[0] - 1, pt[0] + 1)
             #allMatches = features.mz_range(pt[0] - 1, pt[0] + 1)
             
-            daTol = (pt[0]/1000000) * pointTol
-            
-            allMatches = features.mzs_around(pt[0], width = daTol) # FeatureMemo method.
-            allMatches = [(i, x) for (i, x) in allMatches if x.containsPoint(*pt)]
             index, match = max(allMatches, key = lambda x: x[1].totalIntensity())
                 
         except ValueError:
@@ -824,6 +841,7 @@ def getTripleRatios(data, resultIndex, featureList, ms2toms1, tagTuples):
         return ((avgDelta*1000000)/avgMZ) + (peakFindTolPPM/2)               
 
     ratios = []
+    xicRequests = []
     for lights, mediums, heavies in tagTuples:
         if not (lights or mediums or heavies): continue
         
@@ -945,9 +963,10 @@ def getTripleRatios(data, resultIndex, featureList, ms2toms1, tagTuples):
             xicParameters = getXICParametersTriple(lightFeatures, mediumFeatures, 
                                                    heavyFeatures, lightMediumShift,
                                                    lightHeavyShift)
-            (xicByFeature,
-             (totalLightXIC, totalMediumXIC, totalHeavyXIC)) = getRatioXICsTriple(data,
-                                                                                  xicParameters)
+            # Filled in below, once all XICs have been collected.
+            xicRequests.append((len(ratios), xicParameters))
+            xicByFeature = None
+            (totalLightXIC, totalMediumXIC, totalHeavyXIC) = None, None, None
             
             
         else:
@@ -1006,6 +1025,11 @@ def getTripleRatios(data, resultIndex, featureList, ms2toms1, tagTuples):
                        topSignalOverlapHeavy,
                        xicByFeature,
                        totalLightXIC, totalMediumXIC, totalHeavyXIC))
+    
+    # XICs for every ratio are taken in a single pass over the data.
+    xicResults = getRatioXICsTripleBatch(data, [x[1] for x in xicRequests])
+    for (ratioIndex, _), (xicByFeature, totals) in zip(xicRequests, xicResults):
+        ratios[ratioIndex] = ratios[ratioIndex][:-4] + (xicByFeature,) + totals
         
     return ratios
 
@@ -1068,6 +1092,7 @@ def getDoubleRatios(data, resultIndex, featureList, ms2toms1, tagTuples):
     
     
     ratios = []
+    xicRequests = []
     for lights, _, heavies in tagTuples:
         if not (lights or heavies): continue
         
@@ -1137,7 +1162,9 @@ def getDoubleRatios(data, resultIndex, featureList, ms2toms1, tagTuples):
             
         
             xicParameters = getXICParametersDouble(lightFeatures, heavyFeatures, shift)            
-            xicByFeature, (totalLightXIC, totalHeavyXIC) = getRatioXICsDouble(data, xicParameters)
+            # Filled in below, once all XICs have been collected.
+            xicRequests.append((len(ratios), xicParameters))
+            xicByFeature, (totalLightXIC, totalHeavyXIC) = None, (None, None)
         else:
             overlapLight, overlapHeavy = '-', '-'
             xicParameters = []
@@ -1182,6 +1209,11 @@ def getDoubleRatios(data, resultIndex, featureList, ms2toms1, tagTuples):
                        lightIndices, heavyIndices,
                        topSignalOverlapLight, topSignalOverlapHeavy,
                        xicByFeature, totalLightXIC, totalHeavyXIC))
+    
+    # XICs for every ratio are taken in a single pass over the data.
+    xicResults = getRatioXICsDoubleBatch(data, [x[1] for x in xicRequests])
+    for (ratioIndex, _), (xicByFeature, totals) in zip(xicRequests, xicResults):
+        ratios[ratioIndex] = ratios[ratioIndex][:-3] + (xicByFeature,) + totals
         
     return ratios
             
@@ -1580,91 +1612,63 @@ def setGlobals(constants):
         
         
 
+def xicAOC(xic):
+    aoc = 0
+    for i in range(0, len(xic)-1):
+        cur = xic[i]
+        next = xic[i+1]
+        width = next[0] - cur[0]
+        height = cur[1]
+        aoc += width * height
+    return aoc    
+
+def featureRTRange(data, startScan, endScan):
+    try:
+        startRT = data.timeForScan(startScan)
+    except IOError:
+        warnings.warn('Feature scan out of range: %s %s' % (data.data_file, startScan))
+        startRT = data.timeForScan(startScan+1)
+    try:
+        stopRT = data.timeForScan(endScan)
+    except IOError:
+        warnings.warn('Feature scan out of range: %s %s' % (data.data_file, endScan))
+        stopRT = data.timeForScan(endScan-1)
+    return startRT, stopRT
+
+def ratioXICs(data, xicparameterSets, labelCount):
+    # Takes the XICs for every label of every feature in every set in one
+    # data.xics() call; returns, for each set, the per-feature list of
+    # parameters-plus-AOCs and the total AOC for each label.
+    windows = []
+    for xicparameters in xicparameterSets:
+        for parameters in xicparameters:
+            startRT, stopRT = featureRTRange(data, parameters[1], parameters[2])
+            for labelMZ in parameters[3:3+labelCount]:
+                windows.append((startRT, stopRT, labelMZ - XICTol, labelMZ + XICTol))
+    xics = iter(data.xics(windows))
+    
+    results = []
+    for xicparameters in xicparameterSets:
+        totals = [0] * labelCount
+        xicForFeature = []
+        for parameters in xicparameters:
+            aocs = [xicAOC(next(xics)) for _ in range(labelCount)]
+            totals = [x + y for x, y in zip(totals, aocs)]
+            xicForFeature.append(tuple(parameters) + tuple(aocs))
+        results.append((xicForFeature, tuple(totals)))
+    return results
+
+def getRatioXICsDoubleBatch(data, xicparameterSets):
+    return ratioXICs(data, xicparameterSets, 2)
+
+def getRatioXICsTripleBatch(data, xicparameterSets):
+    return ratioXICs(data, xicparameterSets, 3)
+
 def getRatioXICsDouble(data, xicparameters):
-    def AOC(xic):
-        aoc = 0
-        for i in range(0, len(xic)-1):
-            cur = xic[i]
-            next = xic[i+1]
-            width = next[0] - cur[0]
-            height = cur[1]
-            aoc += width * height
-        return aoc    
-    
-    totalLightAOC = 0
-    totalHeavyAOC = 0
-    #for j in range(0, len(xicparameters)):
-    xicForFeature = []
-    for index, startScan, endScan, lightMZ, heavyMZ in xicparameters:
-        try:
-            startRT = data.timeForScan(startScan)
-        except IOError:
-            warnings.warn('Feature scan out of range: %s %s' % (datafile, startScan))
-            startRT = data.timeForScan(startScan+1)
-        try:
-            stopRT = data.timeForScan(endScan)
-        except IOError:
-            warnings.warn('Feature scan out of range: %s %s' % (datafile, endScan))
-            stopRT = data.timeForScan(endScan-1)
-            
-        try:
-            lightXIC = data.xic(startRT, stopRT, lightMZ - XICTol, lightMZ + XICTol)
-            heavyXIC = data.xic(startRT, stopRT, heavyMZ - XICTol, heavyMZ + XICTol)
-        except AssertionError:
-            lightXIC = []
-            heavyXIC = []
-        
-        lightAOC = AOC(lightXIC)
-        heavyAOC = AOC(heavyXIC)
-        
-        totalLightAOC += lightAOC
-        totalHeavyAOC += heavyAOC
-        
-        xicForFeature.append((index, startScan, endScan, lightMZ, heavyMZ, lightAOC, heavyAOC))
-    
-    return xicForFeature, (totalLightAOC, totalHeavyAOC)
-    
-    
-                
+    return getRatioXICsDoubleBatch(data, [xicparameters])[0]
                 
 def getRatioXICsTriple(data, ratios):
-    def AOC(xic):
-        aoc = 0
-        for i in range(0, len(xic)-1):
-            cur = xic[i]
-            next = xic[i+1]
-            width = next[0] - cur[0]
-            height = cur[1]
-            aoc += width * height
-        return aoc
-    
-    lightAOC = 0
-    mediumAOC = 0
-    heavyAOC = 0
-    
-    xicForFeature = []    
-
-    totalLightAOC = 0
-    totalMediumAOC = 0
-    totalHeavyAOC = 0
-    for index, startScan, endScan, lightMZ, mediumMZ, heavyMZ in ratios:
-        startRT = data.timeForScan(startScan)
-        stopRT = data.timeForScan(endScan)
-        lightXIC = data.xic(startRT, stopRT, lightMZ - XICTol, lightMZ + XICTol)
-        mediumXIC = data.xic(startRT, stopRT, mediumMZ - XICTol, mediumMZ + XICTol)
-        heavyXIC = data.xic(startRT, stopRT, heavyMZ - XICTol, heavyMZ + XICTol)
-        
-        lightAOC = AOC(lightXIC)
-        mediumAOC = AOC(mediumXIC)
-        heavyAOC = AOC(heavyXIC)
-        totalLightAOC += lightAOC
-        totalMediumAOC += mediumAOC
-        totalHeavyAOC += heavyAOC
-        
-        xicForFeature.append((index, startScan, endScan, lightMZ, mediumMZ, heavyMZ, 
-                              lightAOC, mediumAOC, heavyAOC))
-    
-    return xicForFeature, (totalLightAOC, totalMediumAOC, totalHeavyAOC)
+    return getRatioXICsTripleBatch(data, [ratios])[0]
 
 
 
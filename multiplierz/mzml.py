@@ -1,5 +1,7 @@
 from multiplierz.mzAPI import mzFile
 from multiplierz.internalAlgorithms import gzOptOpen
+from multiplierz.scan_transport import ScanRing
+from multiplierz import vprint
 import xml.etree.ElementTree as xml
 import xml.parsers.expat as expat
 import tempfile, sqlite3
@@ -9,6 +11,8 @@ import sqlite3 as sqlite
 import pickle
 import multiprocessing
 import base64
+import numpy as np
+import re
 import sys, os
 
 namespace = '{http://psi.hupo.org/ms/mzml}'
@@ -39,35 +43,62 @@ def uncvp(el):
             'units':el.get('unitName'),
             'value':el.get('value')}
 
-
-    
-def encodeBinaryFloats(floats, compression = False):
-    output = ''
-    for flt in floats:
-        output += struct.pack('d', flt)
-        
+def scan_start_minutes(cvparam):
+    # mzAPI scan times are in minutes, but mzML writers are free to
+    # record them in seconds.
+    time = float(cvparam['value'])
+    if cvparam['units'] == 'second':
+        time = time / 60.0
+    return time
+
+def time_array_minutes(timepts, cvparam):
+    # Likewise for chromatogram time arrays.
+    if cvparam['units'] == 'second':
+        timepts = timepts / 60.0
+    return timepts
+
+
+    
+# Array dtypes by cvParam name; the mzML spec has binary arrays little-endian.
+binaryDataTypes = {'64-bit float':'<f8',
+                   '32-bit float':'<f4',
+                   '64-bit integer':'<i8',
+                   '32-bit integer':'<i4'}
+
+def arrayDataType(arraycvps):
+    return next((binaryDataTypes[x] for x in arraycvps if x in binaryDataTypes), '<f8')
+
+def encodeBinaryArray(values, dtype = '<f8', compression = True):
+    """
+    Encodes a sequence of numbers as a base64 (optionally zlib-compressed)
+    string of the given dtype, suitable for an mzML <binary> element.
+    """
+    if isinstance(values, np.ndarray):
+        array = values.astype(dtype, copy = False)
+    else:
+        array = np.fromiter(values, dtype = dtype)
+    output = array.tobytes()
     if compression:
         output = zlib.compress(output)
-    hexput = base64.b64encode(output)
-    return hexput
+    return base64.b64encode(output).decode('ascii')
+
+def decodeBinaryArray(binary, dtype = '<f8', compression = True):
+    """
+    Decodes the contents of an mzML <binary> element into a numpy array.
+    The array is read-only, since it views the decoded buffer directly.
+    """
+    data = base64.b64decode(binary)
+    if compression:
+        data = zlib.decompress(data)
+    itemsize = np.dtype(dtype).itemsize
+    # Trailing partial values are dropped, as ever.
+    return np.frombuffer(data, dtype = dtype, count = len(data) // itemsize)
+
+def encodeBinaryFloats(floats, compression = False):
+    return encodeBinaryArray(floats, '<f8', compression)
 
 def decodeBinaryFloats(binary, bit64 = True, compression = True):
-    hexary = base64.b64decode(binary)
-    if compression:
-        hexary = zlib.decompress(hexary)    
-        
-    iterinc = 8 if bit64 else 4
-    structtype = 'd' if bit64 else 'f'
-    output = []
-    for i in range(0, len(hexary), iterinc):
-        try:
-            output.append(struct.unpack(structtype, hexary[i:i+iterinc])[0])
-        except struct.error as err:
-            if len(hexary) - i < iterinc:
-                break
-            else:
-                raise err
-    return output
+    return decodeBinaryArray(binary, '<f8' if bit64 else '<f4', compression).tolist()
 
     
 
@@ -141,20 +172,23 @@ def makeSpectrumXML(specData):
             raise NotImplementedError("Can't encode dissociation mode %s" % specData['dissociation mode'])
         
     
-    encodedMZs = encodeBinaryFloats(x[0] for x in specData['spectrum'])
-    encodedInts = encodeBinaryFloats(x[1] for x in specData['spectrum'])
+    peaks = np.asarray(specData['spectrum'], dtype = float).reshape(-1, 2)
+    encodedMZs = encodeBinaryArray(peaks[:,0], '<f8', compression = True)
+    encodedInts = encodeBinaryArray(peaks[:,1], '<f8', compression = True)
     
-    binaryDataArrayList = xml.SubElement(specEl, ns('binaryDataArrayList'), count = 2)
+    binaryDataArrayList = xml.SubElement(specEl, ns('binaryDataArrayList'), count = '2')
     mzDataArray = xml.SubElement(binaryDataArrayList, ns('binaryDataArray'), 
-                                 arrayLength = len(specData['spectrum']),
-                                 encodedLength = len(encodedMZs))
+                                 arrayLength = str(len(peaks)),
+                                 encodedLength = str(len(encodedMZs)))
+    cvp(mzDataArray, accession='MS:1000523', name='64-bit float')
     cvp(mzDataArray, accession='MS:1000574', name='zlib compression')
     cvp(mzDataArray, accession='MS:1000514', name='m/z array')
     mzBinary = xml.SubElement(mzDataArray, ns('binary'))
     mzBinary.text = encodedMZs
     intDataArray = xml.SubElement(binaryDataArrayList, ns('binaryDataArray'),
-                                  arrayLength = len(specData['spectrum']),
-                                  encodedLength = len(encodedInts))
+                                  arrayLength = str(len(peaks)),
+                                  encodedLength = str(len(encodedInts)))
+    cvp(intDataArray, accession='MS:1000523', name='64-bit float')
     cvp(intDataArray, accession='MS:1000574', name='zlib compression')
     cvp(intDataArray, accession='MS:1000515', name='intensity array')
     intBinary = xml.SubElement(intDataArray, ns('binary'))
@@ -163,7 +197,12 @@ def makeSpectrumXML(specData):
     return specEl
 
 
-def readSpectrumXML(spectrumEl):
+def readSpectrumXML(spectrumEl, as_arrays = False):
+    """
+    Reads a <spectrum> element into a dict.  The peaks are given as a list of
+    (mz, intensity) pairs under 'spectrum', or if as_arrays is set, as numpy
+    arrays under 'mz array' and 'intensity array'.
+    """
     cvparams = [uncvp(x) for x in list(spectrumEl) if x.tag == ns('cvParam')]
     cvparams = dict([(x['name'], x) for x in cvparams])
 
@@ -179,13 +218,25 @@ def readSpectrumXML(spectrumEl):
 
     scan = child(child(spectrumEl, 'scanList'), 'scan')
     scancvps = dict([(uncvp(x)['name'], uncvp(x)) for x in list(scan) if x.tag == ns('cvParam')])
-    specdata['time'] = scancvps['scan start time']['value']
+    specdata['time'] = scan_start_minutes(scancvps['scan start time'])
     if 'filter string' in scancvps:
         specdata['filter'] = scancvps['filter string']['value']    
 
-    if int(cvparams['ms level']['value']) == 2:
-        specdata['precursor'] = cvparams['base peak m/z']['value']
-        specdata['charge'] = 0 # How does one get the precursor charge??
+    specdata['MS Level'] = 'MS%d' % int(cvparams['ms level']['value'])
+    if int(cvparams['ms level']['value']) > 1:
+        selected = spectrumEl.find('.//%s' % ns('selectedIon'))
+        selcvps = {}
+        if selected is not None:
+            selcvps = dict([(uncvp(x)['name'], uncvp(x)) for x in list(selected)
+                            if x.tag == ns('cvParam')])
+        if 'selected ion m/z' in selcvps:
+            specdata['precursor'] = float(selcvps['selected ion m/z']['value'])
+        else:
+            specdata['precursor'] = float(cvparams['base peak m/z']['value'])
+        if 'charge state' in selcvps:
+            specdata['charge'] = int(selcvps['charge state']['value'])
+        else:
+            specdata['charge'] = 0
     else:
         specdata['precursor'] = 0
 
@@ -194,13 +245,12 @@ def readSpectrumXML(spectrumEl):
         assert array.tag == ns('binaryDataArray')
         arraycvps = [uncvp(x)['name'] for x in list(array) if x.tag == ns('cvParam')]
         decompress = 'no compression' not in arraycvps
-        doublefloats = '32-bit float' not in arraycvps
 
         binary = child(array, 'binary')
         if binary.text:
-            spectrum = decodeBinaryFloats(binary.text, doublefloats, decompress)
+            spectrum = decodeBinaryArray(binary.text, arrayDataType(arraycvps), decompress)
         else:
-            spectrum = []
+            spectrum = np.zeros(0)
         
         if 'm/z array' in arraycvps:
             mzspectrum = spectrum
@@ -209,7 +259,11 @@ def readSpectrumXML(spectrumEl):
         else:
             raise Exception('Unidentified array type: %s' % arraycvps)
 
-    specdata['spectrum'] = list(zip(mzspectrum, intspectrum))
+    if as_arrays:
+        specdata['mz array'] = mzspectrum
+        specdata['intensity array'] = intspectrum
+    else:
+        specdata['spectrum'] = list(zip(mzspectrum.tolist(), intspectrum.tolist()))
 
 
     return specdata
@@ -225,20 +279,23 @@ def readChromatoXML(chromatoEl):
 
     for array in list(child(chromatoEl, 'binaryDataArrayList')):
         assert array.tag == ns('binaryDataArray')
-        arraycvps = [uncvp(x)['name'] for x in list(array) if x.tag == ns('cvParam')]
+        arraycvps = dict((x['name'], x) for x in
+                         [uncvp(x) for x in list(array) if x.tag == ns('cvParam')])
         decompress = 'no compression' not in arraycvps
-        doublefloats = '32-bit float' not in arraycvps
+        dtype = arrayDataType(arraycvps)
 
         binary = child(array, 'binary')
         if 'time array' in arraycvps:
-            timepts = decodeBinaryFloats(binary.text, doublefloats, compression = decompress)
+            timepts = time_array_minutes(decodeBinaryArray(binary.text, dtype,
+                                                           compression = decompress),
+                                         arraycvps['time array'])
         elif 'intensity array' in arraycvps:
-            intpts = decodeBinaryFloats(binary.text, doublefloats, compression = decompress)
+            intpts = decodeBinaryArray(binary.text, dtype, compression = decompress)
         else:
-            raise Exception('Unidentified array type: %s' % arraycvps)
+            raise Exception('Unidentified array type: %s' % list(arraycvps))
 
     # This may want to be a more inclusive return type.
-    return span, list(zip(timepts, intpts))
+    return span, list(zip(timepts.tolist(), intpts.tolist()))
 
 
             
@@ -328,66 +385,205 @@ def readXML(xmlfile):
 
 
         
-def mzmlToSqlite_writer(sqlitefile, inputs):            
+# .mzmlsql schema version, recorded as the database's user_version.  Version
+# 1 (user_version 0) files stored each spectrum as a pickled dict; from version
+# 2 peaks are raw little-endian float64 BLOBs, with the remaining per-spectrum
+# fields in a separate table.
+MZMLSQL_VERSION = 2
+
+def create_mzmlsql_tables(cursor):
+    cursor.execute('CREATE TABLE spectra(ind INTEGER PRIMARY KEY, mz REAL, rt REAL, '
+                   'level INTEGER, mzs BLOB, intensities BLOB)')
+    cursor.execute('CREATE TABLE spectrum_metadata(ind INTEGER PRIMARY KEY, id TEXT, '
+                   'source TEXT, centroid INTEGER, charge INTEGER, filter TEXT, '
+                   'lowmz REAL, highmz REAL)')
+    cursor.execute('CREATE TABLE chromato(ind INTEGER, startmz REAL, stopmz REAL, '
+                   'startrt REAL, stoprt REAL, times BLOB, intensities BLOB)')
+    cursor.execute('PRAGMA user_version = %d' % MZMLSQL_VERSION)
+
+def create_mzmlsql_indexes(cursor):
+    # Separate from table creation, since bulk loads go faster without them.
+    cursor.execute('CREATE INDEX spectra_rt ON spectra(rt)')
+    cursor.execute('CREATE INDEX spectra_mz ON spectra(mz)')
+
+def spectrum_arrays(specdata):
+    # Spectra can come in as arrays (readSpectrumXML(..., as_arrays = True))
+    # or as the usual list of (mz, intensity) pairs.
+    if 'mz array' in specdata:
+        return specdata['mz array'], specdata['intensity array']
+    peaks = np.asarray(specdata['spectrum'], dtype = float).reshape(-1, 2)
+    return peaks[:,0], peaks[:,1]
+
+def spectrum_header_rows(specdata):
+    # The spectra row minus its two array BLOBs, and the metadata row.
+    index = int(specdata['index'])
+    level = int(specdata.get('MS Level', 'MS2' if specdata['precursor'] else 'MS1')[2:])
+    spectrumRow = (index, float(specdata['precursor'] or 0), float(specdata['time']), level)
+    lowmz, highmz = specdata.get('mz range') or (None, None)
+    metadataRow = (index, specdata.get('Spectrum Description'), specdata.get('Source'),
+                   int(bool(specdata.get('centroid'))), specdata.get('charge'),
+                   specdata.get('filter'), lowmz, highmz)
+    return spectrumRow, metadataRow
+
+def spectrum_rows(specdata):
+    mzs, ints = spectrum_arrays(specdata)
+    spectrumRow, metadataRow = spectrum_header_rows(specdata)
+    spectrumRow += (np.asarray(mzs, dtype = '<f8').tobytes(),
+                    np.asarray(ints, dtype = '<f8').tobytes())
+    return spectrumRow, metadataRow
+
+def chromatogram_row(chromdata):
+    span, points = chromdata
+    points = np.asarray(points, dtype = float).reshape(-1, 2)
+    if span == 'total':
+        span = (0, 0, 0, 0, 0)
+    return tuple(span) + (np.asarray(points[:,0], dtype = '<f8').tobytes(),
+                          np.asarray(points[:,1], dtype = '<f8').tobytes())
+
+def insert_spectrum(cursor, specdata):
+    spectrumRow, metadataRow = spectrum_rows(specdata)
+    cursor.execute('INSERT INTO spectra VALUES (?,?,?,?,?,?)', spectrumRow)
+    cursor.execute('INSERT INTO spectrum_metadata VALUES (?,?,?,?,?,?,?,?)', metadataRow)
+
+def insert_chromatogram(cursor, chromdata):
+    cursor.execute('INSERT INTO chromato VALUES (?,?,?,?,?,?,?)',
+                   chromatogram_row(chromdata))
+
+def mzmlsql_version(sqlitefile):
+    connection = sqlite.connect(sqlitefile)
+    try:
+        return connection.execute('PRAGMA user_version').fetchone()[0] or 1
+    finally:
+        connection.close()
+
+def upgrade_mzmlsql(sqlitefile):
+    """
+    Converts an old (pickled-spectrum) .mzmlsql file to the current schema,
+    in place.
+    """
     connection = sqlite.connect(sqlitefile)
     cursor = connection.cursor()
-    
-    createSpectrumTable = "CREATE TABLE spectra(ind int, mz real, rt int, data blob)"
-    cursor.execute(createSpectrumTable)
-    createChromatoTable = "CREATE TABLE chromato(ind int, startmz real, stopmz real, startrt real, stoprt real, data blob)"
-    cursor.execute(createChromatoTable)
-    connection.commit()
-    
-    i = 0
-    while True:
-        task, data = inputs.get()
-        if task == 'spectrum':
-            pdata = marshal(data)
-            index, prec, time = data['index'], data['precursor'], data['time']
-            cursor.execute('INSERT INTO spectra VALUES (%s,%s,%s,"%s")' % (index, prec, time, pdata))
-        elif task == 'chromatogram':
-            pdata = marshal(data)
-            if data[0] == 'total':
-                cursor.execute('INSERT INTO chromato VALUES (0,0,0,0,0,"%s")' % pdata)
-            else:
-                cursor.execute('INSERT INTO chromato VALUES (%s,%s,%s,%s,%s,"%s")'
-                               % span + (pdata,))
-        elif task == 'stop':
-            break
-        else:
-            raise NotImplementedError(task)
-    
-        if i > 100:
-            connection.commit()
-            i = 0
-        else:
-            i += 1
-            
+    cursor.execute('ALTER TABLE spectra RENAME TO old_spectra')
+    cursor.execute('ALTER TABLE chromato RENAME TO old_chromato')
+    create_mzmlsql_tables(cursor)
+    
+    reader = connection.cursor()
+    for (data,) in reader.execute('SELECT data FROM old_spectra'):
+        insert_spectrum(cursor, demarshal(data))
+    for (data,) in reader.execute('SELECT data FROM old_chromato'):
+        insert_chromatogram(cursor, demarshal(data))
+    create_mzmlsql_indexes(cursor)
+    cursor.execute('DROP TABLE old_spectra')
+    cursor.execute('DROP TABLE old_chromato')
     connection.commit()
+    cursor.execute('VACUUM')
     connection.close()
+    return sqlitefile
         
+
+
+# Per-process reader for conversion workers, so that each worker opens the
+# mzML just once (and gzipped files only ever seek forwards.)
+def _convert_spectrum_proc(xmlfile, chunks, ring):
+    # Decodes the spectra at the given offsets, passing their arrays back
+    # through the ScanRing.
+    try:
+        reader = mzmlIndexedReader(xmlfile, offsets = ([], []))
+        for offsets in chunks:
+            reader.spectrum_offsets = offsets
+            for i in range(len(offsets)):
+                specdata = reader.scan(i, as_arrays = True)
+                ring.send(spectrum_header_rows(specdata), *spectrum_arrays(specdata))
+        reader.close()
+        ring.finish()
+    except Exception:
+        ring.fail()
+        raise
+
+def mzmlToSqlite(xmlfile, sqlitefile, workers = 1, chunk_size = 250,
+                 commit_every = 20000):
+    """
+    Converts an mzML file to a SQLite database readable by mzmlsql_reader
+    (and mzAPI.)
+    
+    Spectra are split up by their byte offsets into chunks of chunk_size;
+    if workers > 1, the chunks are divided between that many worker
+    processes, which decode the spectra and pass the arrays back through
+    shared memory (see multiplierz.scan_transport.)  The calling process
+    does all the database writes, committing once per commit_every spectra.
+    """
+    indexer = mzmlIndexedReader(xmlfile)
+    spectrum_offsets = indexer.spectrum_offsets
+    chunks = [spectrum_offsets[i:i+chunk_size]
+              for i in range(0, len(spectrum_offsets), chunk_size)]
     
+    connection = sqlite.connect(sqlitefile)
+    cursor = connection.cursor()
+    # It's a cache; durability is no concern until it's finished.
+    cursor.execute('PRAGMA journal_mode = OFF')
+    cursor.execute('PRAGMA synchronous = OFF')
+    create_mzmlsql_tables(cursor)
+    
+    def write_rows(rows):
+        cursor.executemany('INSERT INTO spectra VALUES (?,?,?,?,?,?)',
+                           [x[0] for x in rows])
+        cursor.executemany('INSERT INTO spectrum_metadata VALUES (?,?,?,?,?,?,?,?)',
+                           [x[1] for x in rows])
+    
+    uncommitted = 0
+    if workers > 1:
+        ring = ScanRing(slot_count = 16 * workers, writers = workers)
+        procs = [multiprocessing.Process(target = _convert_spectrum_proc,
+                                         args = (xmlfile, chunks[i::workers], ring))
+                 for i in range(workers)]
+        for proc in procs:
+            proc.daemon = True
+            proc.start()
+        try:
+            rows = []
+            for (spectrumRow, metadataRow), (mzs, ints) in ring.scans(procs):
+                rows.append((spectrumRow + (np.asarray(mzs, dtype = '<f8').tobytes(),
+                                             np.asarray(ints, dtype = '<f8').tobytes()),
+                             metadataRow))
+                if len(rows) >= chunk_size:
+                    write_rows(rows)
+                    uncommitted += len(rows)
+                    rows = []
+                if uncommitted >= commit_every:
+                    connection.commit()
+                    uncommitted = 0
+            write_rows(rows)
+        except BaseException:
+            # The remaining workers would otherwise wait forever for ring
+            # slots to free up.
+            for proc in procs:
+                proc.terminate()
+            raise
+        finally:
+            for proc in procs:
+                proc.join()
+            ring.close()
+    else:
+        for offsets in chunks:
+            indexer.spectrum_offsets = offsets
+            write_rows([spectrum_rows(indexer.scan(i, as_arrays = True))
+                        for i in range(len(offsets))])
+            uncommitted += len(offsets)
+            if uncommitted >= commit_every:
+                connection.commit()
+                uncommitted = 0
+        indexer.spectrum_offsets = spectrum_offsets
+    
+    for chromatoEl in indexer.chromatograms():
+        try:
+            insert_chromatogram(cursor, readChromatoXML(chromatoEl))
+        except NotImplementedError:
+            pass # Only total ion chromatograms are currently read.
+    indexer.close()
     
-def mzmlToSqlite(xmlfile, sqlitefile):
-    parser = xml.iterparse(xmlfile)
-    
-    writeQueue = multiprocessing.Queue()
-    writerProc = multiprocessing.Process(target = mzmlToSqlite_writer,
-                                         args = (sqlitefile, writeQueue))
-    writerProc.start()
-    
-    
-    for evt, obj in parser:
-        if obj.tag == ns('spectrum'):
-            writeQueue.put(('spectrum', readSpectrumXML(obj)))
-            obj.clear()
-        elif obj.tag == ns('chromatogram'):
-            writeQueue.put(('chromatogram', readChromatoXML(obj)))
-            obj.clear()
-        
-    writeQueue.put(('stop', None))
-            
-    writerProc.join()
+    create_mzmlsql_indexes(cursor)
+    connection.commit()
+    connection.close()
     return sqlitefile
     
     
@@ -396,42 +592,276 @@ def mzmlToSqlite(xmlfile, sqlitefile):
     
 
 class mzmlsql_reader(object):
-    """Random-access reader for sql DBs written by mzmlToSqlite."""
+    """
+    Random-access reader for sql DBs written by mzmlToSqlite.  Files in the
+    old pickled-spectrum format are upgraded (in place) when opened.
+    """
     def __init__(self, sqlitefile):
+        if mzmlsql_version(sqlitefile) < MZMLSQL_VERSION:
+            vprint("Upgrading %s to the current mzmlsql format..." % sqlitefile)
+            upgrade_mzmlsql(sqlitefile)
+        self.sqlitefile = sqlitefile
         self.connection = sqlite.connect(sqlitefile)
         self.cursor = self.connection.cursor()
     
-    def scan(self, index):
-        self.cursor.execute('SELECT data FROM spectra WHERE ind=%s' % str(index))
-        return demarshal(self.cursor.fetchone()[0])
+    def _specdata(self, row, as_arrays = False):
+        (index, prec, rt, level, mzs, ints,
+         specid, source, centroid, charge, filt, lowmz, highmz) = row
+        specdata = {'index':index,
+                    'Spectrum Description':specid,
+                    'Source':source,
+                    'centroid':bool(centroid),
+                    'mz range':(lowmz, highmz),
+                    'time':rt,
+                    'precursor':prec,
+                    'MS Level':'MS%d' % level}
+        if as_arrays:
+            specdata['mz array'] = np.frombuffer(mzs, dtype = '<f8')
+            specdata['intensity array'] = np.frombuffer(ints, dtype = '<f8')
+        else:
+            specdata['spectrum'] = list(zip(np.frombuffer(mzs, dtype = '<f8').tolist(),
+                                            np.frombuffer(ints, dtype = '<f8').tolist()))
+        if filt is not None:
+            specdata['filter'] = filt
+        if level > 1:
+            specdata['charge'] = charge
+        return specdata
+    
+    def _spectra_where(self, condition, args, as_arrays = False):
+        self.cursor.execute('SELECT s.ind, s.mz, s.rt, s.level, s.mzs, s.intensities, '
+                            'm.id, m.source, m.centroid, m.charge, m.filter, m.lowmz, m.highmz '
+                            'FROM spectra s JOIN spectrum_metadata m ON s.ind = m.ind '
+                            'WHERE ' + condition, args)
+        return [self._specdata(row, as_arrays) for row in self.cursor.fetchall()]
+    
+    def scan(self, index, as_arrays = False):
+        return self._spectra_where('s.ind = ?', (int(index),), as_arrays)[0]
+    
+    def scan_arrays(self, index):
+        """
+        Returns the m/z and intensity arrays of a spectrum, without building
+        the rest of the spectrum dict.
+        """
+        self.cursor.execute('SELECT mzs, intensities FROM spectra WHERE ind = ?', (int(index),))
+        mzs, ints = self.cursor.fetchone()
+        return np.frombuffer(mzs, dtype = '<f8'), np.frombuffer(ints, dtype = '<f8')
+    
+    def _chromatogram(self, condition, args):
+        self.cursor.execute('SELECT ind, startmz, stopmz, startrt, stoprt, times, intensities '
+                            'FROM chromato WHERE ' + condition, args)
+        row = self.cursor.fetchone()
+        if row is None:
+            raise IOError("No such chromatogram in %s" % self.sqlitefile)
+        span = 'total' if not any(row[:5]) else row[:5]
+        return span, list(zip(np.frombuffer(row[5], dtype = '<f8').tolist(),
+                              np.frombuffer(row[6], dtype = '<f8').tolist()))
     
     def xic(self, index):
-        self.cursor.execute('SELECT data FROM chromato WHERE ind=%s' % str(index))
-        return demarshal(self.cursor.fetchone()[0])
+        return self._chromatogram('ind = ?', (int(index),))
     
     def scans_by_mz(self, mzstart, mzstop):
-        self.cursor.execute('SELECT ind, mz, data FROM spectra WHERE mz >= %s AND mz <= %s' % (mzstart, mzstop))
-        return [(x[0], x[1], demarshal(x[2])) for x in self.cursor.fetchall()]
+        return [(x['index'], x['precursor'], x) for x in
+                self._spectra_where('s.mz >= ? AND s.mz <= ?', (mzstart, mzstop))]
     
     def scans_by_rt(self, rtstart, rtstop):
-        self.cursor.execute('SELECT ind, rt, data FROM spectra WHERE rt >= %s AND rt <= %s' % (rtstart, rtstop))
-        return [(x[0], x[1], demarshal(x[2])) for x in self.cursor.fetchall()]
+        return [(x['index'], x['time'], x) for x in
+                self._spectra_where('s.rt >= ? AND s.rt <= ?', (rtstart, rtstop))]
     
     def scan_manifest(self):
         self.cursor.execute('SELECT ind, mz, rt FROM spectra')
         return list(self.cursor.fetchall())
     
+    def scan_headers(self):
+        self.cursor.execute('SELECT ind, mz, rt, level FROM spectra')
+        return [(i, m, r, 'MS%d' % level) for i, m, r, level in self.cursor.fetchall()]
+    
     def xic_manifest(self):
-        self.cursor.execute('SELECT ind, mzstart, mzstop, rtstart, rtstop FROM chromato')
+        self.cursor.execute('SELECT ind, startmz, stopmz, startrt, stoprt FROM chromato')
         return list(self.cursor.fetchall())
     
     def total_xic(self):
-        self.cursor.execute('SELECT data FROM chromato WHERE ind=0 AND startmz=0 AND stopmz=0 AND startrt=0 AND stopmz=0')
-        return demarshal(self.cursor.fetchone()[0])
+        return self._chromatogram('ind=0 AND startmz=0 AND stopmz=0 AND startrt=0 AND stoprt=0', ())
     
-    def close():
+    def close(self):
         self.connection.close()
 
+
+
+
+# Byte offsets point at the opening '<' of each element; indexedmzML files
+# record them in a trailing <indexList>, which is found via <indexListOffset>.
+indexListOffsetRE = re.compile(br'<indexListOffset>\s*(\d+)\s*</indexListOffset>')
+indexRE = re.compile(br'<index\s+name="(\w+)"\s*>(.*?)</index>', re.DOTALL)
+offsetRE = re.compile(br'<offset\s+idRef="([^"]*)"[^>]*>\s*(\d+)\s*</offset>')
+elementStartRE = re.compile(br'<(spectrum|chromatogram)\s')
+cvParamRE = re.compile(br'<cvParam\s([^>]*)>')
+attributeRE = re.compile(br'([\w:]+)="([^"]*)"')
+
+def read_mzml_index(fileobj):
+    """
+    Reads the indexList of an indexedmzML file, returning lists of spectrum
+    and chromatogram byte offsets in document order.  Returns None if the
+    index is missing or doesn't point at the elements it claims to.
+    """
+    fileobj.seek(0, 2)
+    filesize = fileobj.tell()
+    fileobj.seek(max(0, filesize - 4096))
+    match = indexListOffsetRE.search(fileobj.read())
+    if not match:
+        return None
+
+    fileobj.seek(int(match.group(1)))
+    indexes = dict((name, [int(x[1]) for x in offsetRE.findall(block)])
+                   for name, block in indexRE.findall(fileobj.read()))
+    spectra = indexes.get(b'spectrum', [])
+    chromatograms = indexes.get(b'chromatogram', [])
+    for offsets, tag in [(spectra, b'<spectrum'), (chromatograms, b'<chromatogram')]:
+        if offsets:
+            fileobj.seek(offsets[0])
+            if not fileobj.read(len(tag)) == tag:
+                return None
+    if not spectra:
+        return None
+
+    return spectra, chromatograms
+
+def build_mzml_index(fileobj, blocksize = 4 * 1024 * 1024):
+    """
+    Finds the byte offsets of every spectrum and chromatogram element in
+    a single pass over the file, for mzML files without a (valid) indexList.
+    """
+    spectra = []
+    chromatograms = []
+    overlap = len(b'<chromatogram ') - 1
+
+    fileobj.seek(0)
+    position = 0 # File offset of the end of the previous block.
+    carry = b''
+    while True:
+        block = fileobj.read(blocksize)
+        if not block:
+            break
+        buf = carry + block
+        for match in elementStartRE.finditer(buf):
+            if match.end() <= len(carry):
+                continue # Already seen in the previous block.
+            offset = position - len(carry) + match.start()
+            if match.group(1) == b'spectrum':
+                spectra.append(offset)
+            else:
+                chromatograms.append(offset)
+        position += len(block)
+        carry = buf[-overlap:]
+
+    return spectra, chromatograms
+
+
+class mzmlIndexedReader(object):
+    """
+    Random-access reader for mzML files.  Spectra are located via the
+    indexList of indexedmzML files (or, if that's absent, an offset index
+    built in one pass over the file) and decoded individually on demand,
+    so no conversion step is required.
+    """
+    def __init__(self, xmlfile, offsets = None):
+        self.xmlfile = xmlfile
+        self.fileobj = gzOptOpen(xmlfile, 'rb')
+
+        # Offsets can be given directly, if they're already known.
+        if offsets is None:
+            offsets = read_mzml_index(self.fileobj)
+        if offsets is None:
+            offsets = build_mzml_index(self.fileobj)
+        self.spectrum_offsets, self.chromato_offsets = offsets
+
+    def read_element(self, offset, tag, stop = None, blocksize = 65536):
+        """
+        Returns the raw text of the element starting at offset, through its
+        closing tag; if stop is given, reading ends early at the first
+        occurrence of that string instead.
+        """
+        endtag = b'</' + tag + b'>'
+        self.fileobj.seek(offset)
+        buf = bytearray()
+        while True:
+            block = self.fileobj.read(blocksize)
+            if not block:
+                raise IOError("Unterminated %s element at offset %d of %s"
+                              % (tag.decode(), offset, self.xmlfile))
+            searchfrom = max(0, len(buf) - len(endtag))
+            buf += block
+            if stop:
+                end = buf.find(stop, searchfrom)
+                if end >= 0:
+                    return bytes(buf[:end])
+            end = buf.find(endtag, searchfrom)
+            if end >= 0:
+                return bytes(buf[:end + len(endtag)])
+            blocksize *= 2
+
+    def element(self, offset, tag):
+        # Fragments lack the document's namespace declaration, which
+        # readSpectrumXML and co. depend upon.
+        text = self.read_element(offset, tag)
+        wrapped = (b'<mzML xmlns="' + namespace[1:-1].encode() + b'">'
+                   + text + b'</mzML>')
+        return xml.fromstring(wrapped)[0]
+
+    def scan(self, index, as_arrays = False):
+        return readSpectrumXML(self.element(self.spectrum_offsets[index], b'spectrum'),
+                               as_arrays = as_arrays)
+
+    def scan_arrays(self, index):
+        specdata = self.scan(index, as_arrays = True)
+        return specdata['mz array'], specdata['intensity array']
+
+    def scan_header(self, index):
+        """
+        Reads the (index, precursor, time, level) of a spectrum from its
+        cvParams, without touching the binary data arrays.
+        """
+        text = self.read_element(self.spectrum_offsets[index], b'spectrum',
+                                 stop = b'<binaryDataArrayList')
+        cvparams = {}
+        for attrtext in cvParamRE.findall(text):
+            attrs = dict(attributeRE.findall(attrtext))
+            cvparams.setdefault(attrs.get(b'name', b'').decode(),
+                                {'value':attrs.get(b'value', b'').decode(),
+                                 'units':attrs.get(b'unitName', b'').decode()})
+
+        level = int(cvparams['ms level']['value'])
+        if level > 1:
+            if 'selected ion m/z' in cvparams:
+                mz = float(cvparams['selected ion m/z']['value'])
+            else:
+                mz = float(cvparams['base peak m/z']['value'])
+        else:
+            mz = 0
+        time = scan_start_minutes(cvparams['scan start time'])
+
+        return index, mz, time, 'MS%d' % level
+
+    def scan_headers(self):
+        return [self.scan_header(i) for i in range(len(self.spectrum_offsets))]
+
+    def scan_manifest(self):
+        return [x[:3] for x in self.scan_headers()]
+
+    def chromatograms(self):
+        for offset in self.chromato_offsets:
+            yield self.element(offset, b'chromatogram')
+
+    def total_xic(self):
+        for chromatoEl in self.chromatograms():
+            try:
+                return readChromatoXML(chromatoEl)
+            except NotImplementedError:
+                continue
+        raise IOError("No total ion chromatogram in %s" % self.xmlfile)
+
+    def close(self):
+        self.fileobj.close()
+
     
 
 def iterate_spectra_simple(xmlfile):
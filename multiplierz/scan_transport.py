@@ -0,0 +1,189 @@
+"""
+Transport for passing scans between processes without pickling them.
+
+A ScanRing is a block of shared memory divided into fixed-size slots.
+Writer processes copy each scan's arrays (m/z, intensity, and any other
+columns) into a free slot, and send only a small descriptor (slot number,
+length, and whatever picklable metadata goes with the scan) through a
+queue; the reading process views the arrays directly in the shared block,
+and the slot returns to the free list when the reader moves on to the
+next scan.  Writers block when no slots are free, so a fast reader can't
+run arbitrarily far ahead of the consumer.
+
+Example:
+>>> ring = ScanRing(writers = 1)
+>>> proc = multiprocessing.Process(target = readerProc, args = (datafile, ring))
+>>> proc.start()
+>>> for scanNum, (mzs, intensities) in ring.scans([proc]):
+...     process(scanNum, mzs, intensities)
+>>> proc.join()
+>>> ring.close()
+
+where readerProc calls ring.send(scanNum, mzs, intensities) for each scan,
+then ring.finish().
+"""
+
+import multiprocessing
+import traceback
+from queue import Empty
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError: # Python < 3.8; scans are pickled as arrays instead.
+    shared_memory = None
+
+__all__ = ['ScanRing', 'scan_columns']
+
+
+def _attach(name):
+    # Writers only attach to the ring's block, which the creating process
+    # unlinks; as in mzMemo, they mustn't leave it registered with their
+    # resource tracker, which would otherwise "clean it up" a second time.
+    try:
+        return shared_memory.SharedMemory(name = name, track = False)
+    except TypeError: # Python < 3.13 always tracks.
+        block = shared_memory.SharedMemory(name = name)
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(block._name, 'shared_memory')
+    except (ImportError, AttributeError):
+        pass
+    return block
+
+def _track(block):
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.register(block._name, 'shared_memory')
+    except (ImportError, AttributeError):
+        pass
+
+
+def scan_columns(scan, columns = 2):
+    """
+    Splits a scan (list of (mz, intensity, ...) points, or an array of same)
+    into a list of the first columns float arrays.
+    """
+    points = np.asarray(scan, dtype = float)
+    if not len(points):
+        return [np.zeros(0) for _ in range(columns)]
+    return [points[:,i] for i in range(columns)]
+
+
+class ScanRing(object):
+    """
+    Shared memory ring of slot_count slots, each of slot_bytes bytes,
+    written by the given number of writer processes and read by a single
+    reader (the process that created the ring.)  Scans too large for a
+    slot are sent through the queue as ordinary arrays.
+    """
+
+    def __init__(self, slot_count = 32, slot_bytes = 4 * 1024 * 1024, writers = 1):
+        self.slot_count = slot_count
+        self.slot_bytes = slot_bytes
+        self.writers = writers
+
+        if shared_memory is not None:
+            self.block = shared_memory.SharedMemory(create = True,
+                                                    size = slot_count * slot_bytes)
+        else:
+            self.block = None
+        self.free = multiprocessing.Queue()
+        for slot in range(slot_count):
+            self.free.put(slot)
+        self.ready = multiprocessing.Queue()
+        self._owner = True
+
+    def __getstate__(self):
+        # The SharedMemory reattaches by name in the receiving process.
+        state = self.__dict__.copy()
+        state['_owner'] = False
+        if state['block'] is not None:
+            state['block'] = state['block'].name
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.block is not None:
+            self.block = _attach(self.block)
+
+    def _view(self, slot, columns, length):
+        return np.ndarray((columns, length), dtype = float, buffer = self.block.buf,
+                          offset = slot * self.slot_bytes)
+
+    def send(self, meta, *arrays):
+        """
+        Writes one scan's arrays to the ring (blocking while the ring is
+        full); meta is passed along with it as-is.
+        """
+        arrays = [np.asarray(x, dtype = float) for x in arrays]
+        length = len(arrays[0]) if arrays else 0
+        if self.block is None or len(arrays) * length * 8 > self.slot_bytes:
+            self.ready.put(('inline', meta, arrays))
+            return
+
+        slot = self.free.get()
+        view = self._view(slot, len(arrays), length)
+        for row, array in zip(view, arrays):
+            row[:] = array
+        del view
+        self.ready.put(('slot', meta, (slot, len(arrays), length)))
+
+    def finish(self):
+        """Called by each writer once it has sent all its scans."""
+        self.ready.put(('done', None, None))
+
+    def fail(self, message = None):
+        """Called by a writer that has hit an error, in place of finish()."""
+        self.ready.put(('error', None, message or traceback.format_exc()))
+
+    def scans(self, processes = ()):
+        """
+        Yields (meta, arrays) for each scan sent to the ring, until every
+        writer has finished.  arrays are views into the shared block, and are
+        only valid until the next scan is requested; copy them to keep them.
+
+        If processes are given, an error is raised if any of them exits
+        without finishing, rather than waiting forever.
+        """
+        finished = 0
+        while finished < self.writers:
+            try:
+                kind, meta, payload = self.ready.get(timeout = 1)
+            except Empty:
+                for proc in processes:
+                    if not proc.is_alive() and proc.exitcode:
+                        raise RuntimeError("Scan reader process exited (code %s)."
+                                           % proc.exitcode)
+                continue
+
+            if kind == 'done':
+                finished += 1
+            elif kind == 'error':
+                raise RuntimeError("Scan reader process failed:\n%s" % payload)
+            elif kind == 'inline':
+                yield meta, payload
+            else:
+                slot, columns, length = payload
+                view = self._view(slot, columns, length)
+                try:
+                    yield meta, list(view)
+                finally:
+                    del view
+                    self.free.put(slot)
+
+    def __iter__(self):
+        return self.scans()
+
+    def close(self):
+        if self.block is None:
+            return
+        try:
+            self.block.close()
+        except BufferError:
+            pass # A caller is still holding on to a view.
+        if self._owner:
+            _track(self.block) # In case an attaching process untracked it.
+            self.block.unlink()
+        self.block = None
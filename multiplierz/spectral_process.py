@@ -1,5 +1,5 @@
 from collections import defaultdict
-from multiplierz.internalAlgorithms import average
+from multiplierz.internalAlgorithms import average, isotope_sweep, check_peak_pick_compatibility
 from multiplierz import protonMass
 
 #Iterable deprecated in python 3.10, import from new location if available
@@ -10,6 +10,7 @@ except ImportError:
 
 from collections import deque
 from numpy import std
+import numpy as np
 
 def centroid(scan, threshold = None):
     """
@@ -79,7 +80,7 @@ isotopicRatios_permissive = {(0, 1) : (0.5, 16.2),
 # represented somewhere in the output (and no new peaks, obviously.)
 def peak_pick(scan, tolerance = 0.005, max_charge = 8, min_peaks = 3, correction = None,
               cleanup = False, recover_peaks = True,
-              enforce_isotopic_ratios = True):
+              enforce_isotopic_ratios = True, compatibility = False):
     """
     Scans a scan and gives back a by-charge dict of lists of isotopic sequences
     found in the scan, as well as a list of the unassigned peaks.
@@ -90,6 +91,42 @@ def peak_pick(scan, tolerance = 0.005, max_charge = 8, min_peaks = 3, correction
     max_charge - Maximum charge of peptides that are searched for.
     min_peaks - Minimum isotopic peaks required for an isotopic feature to be recorded.
     correction - Advanced feature; recalibration factor used for repeated calls on the same file.
+    compatibility - If True, the legacy implementation is also run, and its
+    result is used (with a warning) if the two disagree.
+    """
+    if cleanup: # Not covered by the array-based sweep.
+        return peak_pick_legacy(scan, tolerance, max_charge, min_peaks, correction,
+                                cleanup, recover_peaks, enforce_isotopic_ratios)
+
+    if compatibility:
+        legacyResult = peak_pick_legacy(list(scan), tolerance, max_charge, min_peaks,
+                                        correction, cleanup, recover_peaks,
+                                        enforce_isotopic_ratios)
+
+    if enforce_isotopic_ratios == True:
+        ratios = isotopicRatios
+    elif enforce_isotopic_ratios == 'permissive':
+        ratios = isotopicRatios_permissive
+    else:
+        ratios = defaultdict(lambda: (-1000000, 1000000))
+    chargeFractions = [(x, 1.0/x) for x in range(1, max_charge+1)]
+    scan.sort()
+
+    result = isotope_sweep(scan, tolerance, chargeFractions, min_peaks,
+                           recover_peaks, ratios, ppm = False)
+    if compatibility:
+        result = check_peak_pick_compatibility('peak_pick', result, legacyResult[:2])
+    if correction != None:
+        return result[0], result[1], []
+    else:
+        return result
+
+def peak_pick_legacy(scan, tolerance = 0.005, max_charge = 8, min_peaks = 3, correction = None,
+                     cleanup = False, recover_peaks = True,
+                     enforce_isotopic_ratios = True):
+    """
+    The original pure-Python implementation of peak_pick, kept as a
+    reference for peak_pick(..., compatibility = True).
     """
 
     if enforce_isotopic_ratios == True:
@@ -306,8 +343,19 @@ def top_n_peaks(spectrum, N):
     Takes the most-intense N peaks of the given scan, and discards the rest.
     """
     N = int(N) if N else 0
+    if hasattr(spectrum, 'intensities'): # mzScan
+        # Stable, so ties keep their order as with sorted().
+        return spectrum.take(np.argsort(-spectrum.intensities, kind = 'stable')[:N])
     return sorted(spectrum, key = lambda x: x[1], reverse = True)[:int(N)]
 
+def _scan_arrays(spectrum):
+    if hasattr(spectrum, 'mzs'): # mzScan
+        return spectrum.mzs, spectrum.intensities
+    count = len(spectrum)
+    mzs = np.fromiter((x[0] for x in spectrum), dtype = float, count = count)
+    ints = np.fromiter((x[1] for x in spectrum), dtype = float, count = count)
+    return mzs, ints
+
 def exclusion_radius(spectrum, exclusion):
     """
     For every peak in the spectrum, in order of most-to-least intense, takes
@@ -318,14 +366,36 @@ def exclusion_radius(spectrum, exclusion):
     if not exclusion or not float(exclusion):
         return spectrum
     exclusion = float(exclusion)
+    if not len(spectrum):
+        return []
+    
+    # A peak is taken exactly when no more-intense peak (or equally intense
+    # and earlier in the list, as with max()) has been taken within the
+    # radius; so one pass in order of intensity, marking off the m/z-sorted
+    # neighbors of each taken peak, gives the same result as repeated max().
+    mzs, ints = _scan_arrays(spectrum)
+    byMZ = np.argsort(mzs, kind = 'stable')
+    sortedMZs = mzs[byMZ]
+    position = np.empty(len(mzs), dtype = int)
+    position[byMZ] = np.arange(len(mzs))
+    # Slightly generous bounds; the exact test is applied within them.
+    margin = exclusion * (1 + 1e-9)
+    lows = np.searchsorted(sortedMZs, sortedMZs - margin, side = 'left').tolist()
+    highs = np.searchsorted(sortedMZs, sortedMZs + margin, side = 'right').tolist()
     
-    acc = []
-    while spectrum:
-        peak = max(spectrum, key = lambda x: x[1])
-        acc.append(peak)
-        spectrum = [x for x in spectrum if not abs(x[0] - peak[0]) < exclusion]
+    excluded = np.zeros(len(mzs), dtype = bool) # By m/z-sorted position.
+    taken = []
+    for i in np.argsort(-ints, kind = 'stable').tolist():
+        k = position[i]
+        if excluded[k]:
+            continue
+        taken.append(i)
+        low, high = lows[k], highs[k]
+        excluded[low:high] |= np.abs(sortedMZs[low:high] - sortedMZs[k]) < exclusion
     
-    return acc    
+    if hasattr(spectrum, 'take'): # mzScan
+        return spectrum.take(taken)
+    return [spectrum[i] for i in taken]
 
 def signal_noise(spectrum, minSN):
     """
@@ -334,16 +404,35 @@ def signal_noise(spectrum, minSN):
     ratio and discarding those.
     """
     
-    # Ought to do a binary search!
-    
     if not minSN or not float(minSN):
         return spectrum
     
     minSN = float(minSN)
-    spectrum.sort(key = lambda x: x[1])
-    for i in range(0, len(spectrum)):
-        ints = [x[1] for x in spectrum[i:]]
-        SN = average(ints) / std(ints)
+    if hasattr(spectrum, 'take'): # mzScan
+        spectrum = spectrum.take(np.argsort(spectrum.intensities, kind = 'stable'))
+        ints = spectrum.intensities
+    else:
+        spectrum.sort(key = lambda x: x[1])
+        ints = _scan_arrays(spectrum)[1]
+    if not len(ints):
+        return spectrum
+    
+    # S/N of every suffix of the intensity-sorted peaks, from suffix sums of
+    # intensity and squared intensity.  These can differ from the direct
+    # calculation in the last few bits, so any suffix that comes close is
+    # checked directly, in order, as before.
+    counts = np.arange(len(ints), 0, -1)
+    sums = np.cumsum(ints[::-1])[::-1]
+    squares = np.cumsum((ints * ints)[::-1])[::-1]
+    means = sums / counts
+    variances = np.maximum(squares / counts - means * means, 0)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        ratios = means / np.sqrt(variances)
+    slack = 1e-6 * (abs(minSN) + 1)
+    for i in np.nonzero(~(ratios <= minSN - slack))[0].tolist():
+        suffix = ints[i:]
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            SN = average(suffix) / std(suffix)
         if SN > minSN:
             return spectrum[i:]
     
@@ -355,6 +444,8 @@ def intensity_threshold(spectrum, threshold):
     the specified threshold.
     """
     threshold = float(threshold)
+    if hasattr(spectrum, 'intensities'): # mzScan
+        return spectrum.take(spectrum.intensities > threshold)
     return [x for x in spectrum if float(x[1]) > threshold]
 
 def mz_range(spectrum, range):
@@ -367,6 +458,8 @@ def mz_range(spectrum, range):
         start, stop = [int(x) for x in range.split('-')]
     else:
         start, stop = range
+    if hasattr(spectrum, 'mzs'): # mzScan
+        return spectrum.take((spectrum.mzs >= start) & (spectrum.mzs <= stop))
     return [x for x in spectrum if start <= x[0] <= stop]
 
 